@@ -0,0 +1,87 @@
+import asyncio
+
+from sqlalchemy import Boolean, Column, DateTime, Float, Integer, String, Table
+
+# Shared by the benchmarks: event-loop lag sampling, and the tables the jobs
+# read and write, for create_all on a scratch database. The columns match the
+# app's models; extra Index objects are passed through to Table.
+
+
+async def measure_loop_lag(stop: asyncio.Event, samples: list, interval: float = 0.01):
+    # How late each sleep of `interval` wakes up, in ms, until stop is set
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append((loop.time() - started - interval) * 1000)
+
+
+def virtual_wallets_table(metadata, *extra) -> Table:
+    return Table(
+        "virtual_wallets", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("user_id", Integer),
+        Column("balance", Float),
+        Column("card_number", String),
+        Column("status", String),
+        *extra
+    )
+
+
+def wallet_transactions_table(metadata, *extra) -> Table:
+    return Table(
+        "wallet_transactions", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("wallet_id", Integer),
+        Column("amount", Float),
+        Column("transaction_type", String),
+        Column("description", String),
+        Column("status", String),
+        Column("reference", String),
+        Column("counterparty_wallet_id", Integer),
+        Column("created_at", DateTime),
+        *extra
+    )
+
+
+def savings_goals_table(metadata, *extra) -> Table:
+    return Table(
+        "savings_goals", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("user_id", Integer),
+        Column("target_amount", Float),
+        Column("current_amount", Float),
+        Column("auto_save_frequency", String),
+        *extra
+    )
+
+
+def savings_rules_table(metadata, *extra) -> Table:
+    return Table(
+        "savings_rules", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("user_id", Integer),
+        Column("rule_type", String),
+        Column("amount", Float),
+        Column("target_goal_id", Integer),
+        Column("is_active", Boolean),
+        Column("frequency", String),
+        Column("next_run_at", DateTime),
+        Column("last_period", String),
+        *extra
+    )
+
+
+def watermark_tables(metadata):
+    # Where the ledger consumers keep their marks and the pending rows they passed
+    Table(
+        "ledger_watermarks", metadata,
+        Column("name", String, primary_key=True),
+        Column("last_transaction_id", Integer),
+        Column("updated_at", DateTime),
+    )
+    Table(
+        "ledger_pending", metadata,
+        Column("name", String, primary_key=True),
+        Column("transaction_id", Integer, primary_key=True),
+    )
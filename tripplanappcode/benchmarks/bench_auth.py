@@ -0,0 +1,94 @@
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from password_hashing import PasswordHasher
+
+from _common import measure_loop_lag
+
+# Sign-up and login throughput for bcrypt run inline on the event loop versus
+# on PasswordHasher's thread pool, with event-loop lag sampled alongside: the
+# lag is how long every other request on the worker would have waited. The
+# last run logs in with hashes made at a lower cost, so each one is rehashed.
+#   python benchmarks/bench_auth.py --operations 200 --rounds 12 --workers 8
+
+
+async def measure(label: str, operations: int, operation):
+    latencies = []
+
+    async def one(index: int):
+        started = time.perf_counter()
+        await operation(index)
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    stop = asyncio.Event()
+    lag_samples = []
+    lag_task = asyncio.create_task(measure_loop_lag(stop, lag_samples))
+    await asyncio.sleep(0)
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(operations)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await lag_task
+
+    latencies.sort()
+    print(f"{label:<24} {operations / elapsed:7.1f} ops/s   p50 {statistics.median(latencies):7.1f} ms   "
+          f"loop lag max {max(lag_samples, default=0):7.1f} ms")
+
+
+async def run(args):
+    hasher = PasswordHasher(rounds=args.rounds, max_workers=args.workers)
+    passwords = [f"correct horse battery {i}" for i in range(args.operations)]
+    hashes = [hasher.context.hash(password) for password in passwords]
+
+    async def inline_hash(i):
+        hasher.context.hash(passwords[i])
+
+    async def inline_verify(i):
+        assert hasher.context.verify(passwords[i], hashes[i])
+
+    async def pooled_hash(i):
+        await hasher.hash(passwords[i])
+
+    async def pooled_login(i):
+        matches, new_hash = await hasher.verify_and_update(passwords[i], hashes[i])
+        assert matches and new_hash is None
+
+    await measure("register, inline", args.operations, inline_hash)
+    await measure("login, inline", args.operations, inline_verify)
+    await measure("register, thread pool", args.operations, pooled_hash)
+    await measure("login, thread pool", args.operations, pooled_login)
+
+    # Users whose hashes predate a cost increase
+    old = PasswordHasher(rounds=args.rounds - 1, max_workers=1)
+    old_hashes = [old.context.hash(password) for password in passwords]
+    old.close()
+    rehashed = 0
+
+    async def login_with_rehash(i):
+        nonlocal rehashed
+        matches, new_hash = await hasher.verify_and_update(passwords[i], old_hashes[i])
+        assert matches and new_hash is not None and not hasher.needs_rehash(new_hash)
+        rehashed += 1
+
+    await measure("login + rehash", args.operations, login_with_rehash)
+    print(f"rehashed {rehashed} of {args.operations} hashes from cost {args.rounds - 1} to {args.rounds}")
+    hasher.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--operations", type=int, default=64)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import Column, Float, Integer, MetaData, String, Table, create_engine, insert, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session
+
+from database import pool_options, sync_url
+
+from _common import measure_loop_lag
+
+# Compares the old pattern (one module-global synchronous session shared by
+# every async handler) with per-request AsyncSessions from a pooled async
+# engine. Each simulated request reads a wallet by primary key and records a
+# transaction row. Run against Postgres for representative numbers:
+#   DATABASE_URL=postgresql+asyncpg://... python benchmarks/bench_db_sessions.py --requests 5000
+
+metadata = MetaData()
+wallets = Table(
+    "bench_wallets", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("user_id", Integer),
+    Column("balance", Float),
+)
+transactions = Table(
+    "bench_wallet_transactions", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("wallet_id", Integer),
+    Column("amount", Float),
+    Column("description", String),
+)
+
+
+async def drive(name: str, handler, requests: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(index: int):
+        async with semaphore:
+            started = time.perf_counter()
+            await handler(index)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    stop = asyncio.Event()
+    lag = []
+    lag_task = asyncio.create_task(measure_loop_lag(stop, lag, interval=0.005))
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await lag_task
+
+    latencies.sort()
+    print(f"{name:<28} {requests / elapsed:>10.1f} {statistics.median(latencies):>10.2f} "
+          f"{latencies[int(len(latencies) * 0.99) - 1]:>10.2f} {max(lag, default=0):>12.2f}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--wallets", type=int, default=1000)
+    args = parser.parse_args()
+
+    url = os.getenv("DATABASE_URL")
+    if url is None:
+        url = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+
+    sync_engine = create_engine(sync_url(url), **pool_options(sync_url(url)))
+    metadata.drop_all(sync_engine)
+    metadata.create_all(sync_engine)
+    with sync_engine.begin() as connection:
+        connection.execute(insert(wallets), [
+            {"id": i, "user_id": i, "balance": 100.0} for i in range(1, args.wallets + 1)
+        ])
+
+    # Old pattern: one shared synchronous session, blocking the loop on every query
+    shared = Session(sync_engine)
+
+    async def shared_sync_handler(index: int):
+        wallet_id = index % args.wallets + 1
+        shared.execute(select(wallets).where(wallets.c.id == wallet_id)).first()
+        shared.execute(insert(transactions).values(wallet_id=wallet_id, amount=1.0, description="bench"))
+        shared.commit()
+
+    # New pattern: a pooled async engine and a session per request
+    async_engine = create_async_engine(url, **pool_options(url))
+    session_factory = async_sessionmaker(async_engine, expire_on_commit=False)
+
+    async def per_request_async_handler(index: int):
+        wallet_id = index % args.wallets + 1
+        async with session_factory() as session:
+            (await session.execute(select(wallets).where(wallets.c.id == wallet_id))).first()
+            await session.execute(insert(transactions).values(wallet_id=wallet_id, amount=1.0, description="bench"))
+            await session.commit()
+
+    print(f"database: {url}")
+    print(f"{'mode':<28} {'req/s':>10} {'p50 ms':>10} {'p99 ms':>10} {'loop lag ms':>12}")
+    await drive("shared sync session", shared_sync_handler, args.requests, args.concurrency)
+    await drive("per-request AsyncSession", per_request_async_handler, args.requests, args.concurrency)
+
+    shared.close()
+    await async_engine.dispose()
+    metadata.drop_all(sync_engine)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import itinerary
+
+from _common import measure_loop_lag
+
+# Itinerary quality and latency on random stops scattered over a state-sized
+# area, with straight-line travel times: total driving for the order given,
+# for nearest neighbour alone and after 2-opt/Or-opt, and the event-loop lag
+# while several large requests run in the process pool.
+#   python benchmarks/bench_itinerary.py --stops 10 20 40 --trials 5
+
+
+def random_stops(rng: random.Random, count: int):
+    return [(33.0 + rng.random() * 4, -114.0 + rng.random() * 5) for _ in range(count)]
+
+
+async def concurrent_requests(args, rng: random.Random):
+    stop = asyncio.Event()
+    lag_samples = []
+    lag_task = asyncio.create_task(measure_loop_lag(stop, lag_samples))
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        itinerary.optimize(random_stops(rng, max(args.stops)), [60] * max(args.stops), 5,
+                           time_budget=args.time_budget)
+        for _ in range(args.concurrent)
+    ))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await lag_task
+    itinerary.close_pool()
+    print(f"{args.concurrent} concurrent {max(args.stops)}-stop requests in {elapsed:.1f}s, "
+          f"loop lag max {max(lag_samples, default=0):.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stops", type=int, nargs="+", default=[10, 20, 40])
+    parser.add_argument("--trials", type=int, default=5)
+    parser.add_argument("--time-budget", type=float, default=itinerary.TIME_BUDGET_S)
+    parser.add_argument("--concurrent", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=11)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    for count in args.stops:
+        given, nearest, optimized, latencies = [], [], [], []
+        for _ in range(args.trials):
+            points = random_stops(rng, count)
+            durations, _ = itinerary.travel_matrices(points)
+            costs = durations.tolist()
+            nearest.append(itinerary._tour_cost(costs, itinerary.nearest_neighbour(costs, 0, range(count))) / 60)
+            started = time.perf_counter()
+            plan = itinerary.plan_itinerary(points, [60] * count, 5, round_trip=True, time_budget=args.time_budget)
+            latencies.append(time.perf_counter() - started)
+            given.append(itinerary._tour_cost(costs, list(range(count))) / 60)
+            optimized.append(plan["drive_minutes"])
+        print(f"{count:>3} stops: given {statistics.mean(given):7.0f} min   "
+              f"nearest neighbour {statistics.mean(nearest):7.0f} min   "
+              f"optimized {statistics.mean(optimized):7.0f} min   in {statistics.mean(latencies):.2f}s")
+
+    asyncio.run(concurrent_requests(args, rng))
+
+
+if __name__ == "__main__":
+    main()
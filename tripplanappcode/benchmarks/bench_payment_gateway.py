@@ -0,0 +1,87 @@
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_stripe import make_server
+from payment_gateway import StripeGateway, PaymentGatewayError
+
+from _common import measure_loop_lag
+
+# Load-tests the async payment gateway against the local fake Stripe server.
+# Alongside request latency it samples event-loop lag, which stays near zero as
+# long as no Stripe call blocks the loop.
+#   python benchmarks/bench_payment_gateway.py --requests 2000 --latency-ms 150
+
+
+async def run(args, base_url: str):
+    gateway = StripeGateway(
+        api_key="sk_test_fake",
+        base_url=base_url,
+        timeout=args.timeout,
+        max_connections=args.concurrency,
+        max_concurrency=args.concurrency,
+        max_retries=args.retries,
+        backoff_base=0.05
+    )
+    latencies = []
+    failures = 0
+
+    async def one(index: int):
+        nonlocal failures
+        started = time.perf_counter()
+        try:
+            await gateway.create_payment_intent(
+                amount_cents=1000 + index, metadata={"trip_id": index % 100, "user_id": index}
+            )
+        except PaymentGatewayError:
+            failures += 1
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    stop = asyncio.Event()
+    lag_samples = []
+    lag_task = asyncio.create_task(measure_loop_lag(stop, lag_samples))
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(args.requests)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await lag_task
+    await gateway.close()
+
+    latencies.sort()
+    print(f"requests      {args.requests} ({failures} failed after retries)")
+    print(f"throughput    {args.requests / elapsed:.1f} req/s")
+    print(f"latency p50   {statistics.median(latencies):.1f} ms")
+    print(f"latency p99   {latencies[int(len(latencies) * 0.99) - 1]:.1f} ms")
+    print(f"loop lag max  {max(lag_samples, default=0):.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=100.0)
+    parser.add_argument("--jitter-ms", type=float, default=25.0)
+    parser.add_argument("--failure-rate", type=float, default=0.02)
+    parser.add_argument("--timeout", type=float, default=5.0)
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--port", type=int, default=12111)
+    args = parser.parse_args()
+
+    server = make_server(port=args.port, latency_ms=args.latency_ms,
+                         jitter_ms=args.jitter_ms, failure_rate=args.failure_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        asyncio.run(run(args, f"http://127.0.0.1:{args.port}"))
+    finally:
+        server.shutdown()
+    print(f"server saw    {server.request_count} requests, created {server.intent_count} intents")
+
+
+if __name__ == "__main__":
+    main()
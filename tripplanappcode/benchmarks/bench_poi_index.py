@@ -0,0 +1,127 @@
+import argparse
+import csv
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+import poi_index
+
+# Bulk-loads random places over a state-sized area, then times corridor
+# queries along random routes: the whole route, near an hour into the drive,
+# and near an hour with rating and price filters. A sample of the answers is
+# checked against a scan of every place.
+#   python benchmarks/bench_poi_index.py --places 300000 --queries 200
+
+
+def write_places(path: str, count: int, rng: random.Random):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "name", "category", "lat", "lon", "rating", "price"])
+        for i in range(count):
+            writer.writerow([
+                i, f"place {i}", rng.choice(poi_index.CATEGORIES), 33 + rng.random() * 5, -115 + rng.random() * 6,
+                round(rng.uniform(1, 5), 1) if rng.random() < 0.9 else "",
+                rng.randint(40, 400) if rng.random() < 0.9 else "",
+            ])
+
+
+def random_route(rng: random.Random, points: int = 1000):
+    # A wavy drive of about 600 km at 90 km/h
+    lat, lon = 33.5 + rng.random(), -114.5 + rng.random()
+    heading = rng.uniform(0, math.pi / 2)
+    geometry, elapsed = [], []
+    for i in range(points):
+        angle = heading + 0.4 * math.sin(i / 40)
+        geometry.append([lat + i * 0.0045 * math.sin(angle), lon + i * 0.0055 * math.cos(angle)])
+        elapsed.append(i * 24.0)
+    return geometry, elapsed
+
+
+def scan(index: poi_index.PoiIndex, categories, geometry, elapsed, category, k, radius_km,
+         hour=None, window_hours=1.0, min_rating=None, max_price=None):
+    # Ids of the k best-rated places, by measuring every place against the route
+    points, seconds = np.array(geometry), np.array(elapsed)
+    starts, ends = points[:-1], points[1:]
+    if hour is not None:
+        at = min(max(hour * 3600, 0.0), seconds[-1])
+        keep = (seconds[1:] >= at - window_hours * 3600) & (seconds[:-1] <= at + window_hours * 3600)
+        starts, ends = starts[keep], ends[keep]
+    rating, price = np.asarray(index.rating), np.asarray(index.price)
+    rows = np.flatnonzero(categories == poi_index.CATEGORIES.index(category))
+    if min_rating is not None:
+        rows = rows[rating[rows] >= min_rating]
+    if max_price is not None:
+        rows = rows[price[rows] <= max_price]
+    latitude = float(np.concatenate([starts, ends])[:, 0].mean())
+    scale = np.array([poi_index.KM_PER_DEGREE_LAT, poi_index.KM_PER_DEGREE_LON * math.cos(math.radians(latitude))])
+    a, direction = starts * scale, (ends - starts) * scale
+    found = []
+    for row in rows.tolist():
+        p = np.array([index.lat[row], index.lon[row]]) * scale
+        t = np.clip(((p - a) * direction).sum(axis=1) / np.maximum((direction ** 2).sum(axis=1), 1e-12), 0, 1)
+        distance = np.sqrt(((a + t[:, None] * direction - p) ** 2).sum(axis=1)).min()
+        if distance <= radius_km:
+            found.append((math.inf if np.isnan(rating[row]) else -rating[row], distance, int(index.id[row])))
+    return [place for _, _, place in sorted(found)[:k]]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--places", type=int, default=300_000)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--check", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    directory = tempfile.mkdtemp()
+    places_path = os.path.join(directory, "places.csv")
+    write_places(places_path, args.places, rng)
+    meta = poi_index.build(places_path, os.path.join(directory, "poi_index"))
+    print(f"indexed {meta['pois']} places in {meta['build_seconds']}s")
+
+    started = time.perf_counter()
+    index = poi_index.PoiIndex(os.path.join(directory, "poi_index"))
+    print(f"opened in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    routes = [random_route(rng) for _ in range(args.queries)]
+    cases = {
+        "whole route": {"category": "attraction", "k": 10, "radius_km": 10},
+        "near hour 3": {"category": "lodging", "k": 3, "radius_km": 10, "hour": 3},
+        "near hour 3, filtered": {"category": "lodging", "k": 3, "radius_km": 10, "hour": 3,
+                                  "min_rating": 4.5, "max_price": 120},
+    }
+    for label, options in cases.items():
+        latencies = []
+        for geometry, elapsed in routes:
+            started = time.perf_counter()
+            index.along_route(geometry, elapsed, **options)
+            latencies.append((time.perf_counter() - started) * 1000)
+        latencies.sort()
+        print(f"{label:<22} p50 {statistics.median(latencies):6.2f} ms   "
+              f"p99 {latencies[int(len(latencies) * 0.99) - 1]:6.2f} ms   max {latencies[-1]:6.2f} ms")
+
+    # Category of each indexed row, for the reference scan
+    with open(places_path, newline="") as f:
+        category_of = {int(row["id"]): poi_index.CATEGORIES.index(row["category"]) for row in csv.DictReader(f)}
+    categories = np.array([category_of[place] for place in index.id.tolist()])
+    wrong = 0
+    for options in cases.values():
+        for geometry, elapsed in routes[:args.check]:
+            found = [place["id"] for place in index.along_route(geometry, elapsed, **options)]
+            wrong += found != scan(index, categories, geometry, elapsed, **options)
+    print(f"checked {args.check * len(cases)} queries against a full scan, {wrong} wrong")
+    if wrong:
+        raise SystemExit("corridor queries don't match the full scan")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import (
+    Column, DateTime, Float, Integer, MetaData, String, Table, create_engine, insert, select, update
+)
+from sqlalchemy.orm import Session
+
+import rewards_accrual
+from database import sync_url
+from wallet_ledger import CONSUMER_SETTLE_SECONDS, wallet_transactions
+
+from _common import wallet_transactions_table, watermark_tables
+
+# Writes a large ledger across many wallets, accrues it in batches, appends
+# more rows and accrues again, settles the pending rows and accrues once
+# more, then checks every wallet's points and level
+# against a straightforward per-row computation.
+#   python benchmarks/bench_rewards_accrual.py --transactions 1000000 --wallets 100000
+
+metadata = MetaData()
+wallet_transactions_table(metadata)
+Table(
+    "wallet_rewards", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("wallet_id", Integer, unique=True, index=True),
+    Column("points", Float),
+    Column("level", String),
+    Column("last_updated", DateTime),
+)
+watermark_tables(metadata)
+
+TYPES = ["payment", "payment", "payment", "transfer", "deposit", "settlement"]
+
+
+def write_rows(db, rng, count: int, wallets: int, expected: dict):
+    # Old enough for the mark to move past
+    created_at = datetime.utcnow() - timedelta(seconds=CONSUMER_SETTLE_SECONDS)
+    rows = []
+    for _ in range(count):
+        transaction_type = rng.choice(TYPES)
+        amount = round(rng.uniform(-200, 200), 2)
+        status = "completed" if rng.random() < 0.95 else "pending"
+        wallet_id = rng.randint(1, wallets)
+        rows.append({
+            "wallet_id": wallet_id, "amount": amount, "transaction_type": transaction_type,
+            "status": status, "created_at": created_at
+        })
+        if status == "completed" and amount < 0:
+            expected[wallet_id] += -amount * rewards_accrual.EARN_RATES.get(transaction_type, 0.0)
+    for start in range(0, len(rows), 50_000):
+        db.execute(insert(wallet_transactions), rows[start:start + 50_000])
+    db.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--transactions", type=int, default=1_000_000)
+    parser.add_argument("--wallets", type=int, default=100_000)
+    parser.add_argument("--batch-size", type=int, default=rewards_accrual.ACCRUAL_BATCH_SIZE)
+    parser.add_argument("--seed", type=int, default=11)
+    args = parser.parse_args()
+
+    url = os.getenv("DATABASE_URL")
+    if url is None:
+        url = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    engine = create_engine(sync_url(url))
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+
+    rng = random.Random(args.seed)
+    expected = defaultdict(float)
+    with Session(engine) as db:
+        write_rows(db, rng, args.transactions, args.wallets, expected)
+
+    def accrue():
+        processed = 0
+        started = time.perf_counter()
+        while True:
+            with Session(engine) as db:
+                count = rewards_accrual.accrue_batch(db, args.batch_size)
+                db.commit()
+            processed += count
+            if count < args.batch_size:
+                break
+        elapsed = time.perf_counter() - started
+        print(f"accrued {processed} rows in {elapsed:.2f}s ({processed / max(elapsed, 1e-9):,.0f} rows/s)")
+
+    accrue()
+    # An incremental run only reads what was written since the last one
+    with Session(engine) as db:
+        write_rows(db, rng, args.transactions // 10, args.wallets, expected)
+    accrue()
+    # Rows that were pending as the mark passed them earn once they settle
+    with Session(engine) as db:
+        pending = wallet_transactions.c.status == "pending"
+        for wallet_id, amount, transaction_type in db.execute(select(
+            wallet_transactions.c.wallet_id, wallet_transactions.c.amount, wallet_transactions.c.transaction_type
+        ).where(pending)):
+            if amount < 0:
+                expected[wallet_id] += -amount * rewards_accrual.EARN_RATES.get(transaction_type, 0.0)
+        db.execute(update(wallet_transactions).where(pending).values(status="completed"))
+        db.commit()
+    accrue()
+
+    with Session(engine) as db:
+        stored = {
+            wallet_id: (points, level)
+            for wallet_id, points, level in db.execute(select(
+                rewards_accrual.wallet_rewards.c.wallet_id,
+                rewards_accrual.wallet_rewards.c.points,
+                rewards_accrual.wallet_rewards.c.level
+            ))
+        }
+    metadata.drop_all(engine)
+
+    wrong = [
+        wallet_id for wallet_id, points in expected.items()
+        if points > 0 and (
+            wallet_id not in stored
+            or abs(stored[wallet_id][0] - points) > 0.05
+            or stored[wallet_id][1] != rewards_accrual.tier_for(stored[wallet_id][0])
+        )
+    ]
+    levels = defaultdict(int)
+    for _, level in stored.values():
+        levels[level] += 1
+    print(f"wallets with points {len(stored)}, levels {dict(levels)}, mismatched {len(wrong)}")
+    if wrong:
+        raise SystemExit("accrued points don't match the ledger")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import argparse
+import csv
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import dijkstra
+
+import routing
+
+# Builds a synthetic road network (a jittered street grid with a coarser grid
+# of highways and some one-way streets), preprocesses it, and times startup
+# and random fastest/shortest queries. A sample of the answers is checked
+# against scipy's Dijkstra on the raw edge list.
+#   python benchmarks/bench_routing.py --side 300 --queries 500
+
+
+def write_network(directory: str, side: int, rng: random.Random):
+    nodes_path, edges_path = os.path.join(directory, "nodes.csv"), os.path.join(directory, "edges.csv")
+    with open(nodes_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "lat", "lon"])
+        for row in range(side):
+            for col in range(side):
+                writer.writerow([1_000_000 + row * side + col,
+                                 35.0 + row * 0.004 + rng.uniform(-0.001, 0.001),
+                                 -112.0 + col * 0.005 + rng.uniform(-0.001, 0.001)])
+    edges = 0
+    with open(edges_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["source", "target", "speed_kmh", "oneway"])
+        for row in range(side):
+            for col in range(side):
+                node = 1_000_000 + row * side + col
+                for d_row, d_col in ((0, 1), (1, 0)):
+                    if row + d_row >= side or col + d_col >= side:
+                        continue
+                    highway = (d_row == 0 and row % 25 == 0) or (d_col == 0 and col % 25 == 0)
+                    if not highway and rng.random() < 0.08:
+                        continue
+                    speed = 100 if highway else rng.choice([30, 40, 50])
+                    oneway = not highway and rng.random() < 0.05
+                    writer.writerow([node, node + d_row * side + d_col, speed, int(oneway)])
+                    edges += 1
+    return nodes_path, edges_path, edges
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--side", type=int, default=150)
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--check", type=int, default=25)
+    parser.add_argument("--seed", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    directory = tempfile.mkdtemp()
+    nodes_path, edges_path, edges = write_network(directory, args.side, rng)
+    output = os.path.join(directory, "road_network")
+
+    started = time.perf_counter()
+    meta = routing.build(nodes_path, edges_path, output)
+    print(f"preprocessed {meta['nodes']} nodes / {meta['edges']} directed edges "
+          f"({edges} road segments) in {time.perf_counter() - started:.1f}s")
+
+    started = time.perf_counter()
+    network = routing.RoadNetwork(output)
+    print(f"opened in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    lat, lon = np.asarray(network.lat), np.asarray(network.lon)
+    pairs = [(rng.randrange(len(network)), rng.randrange(len(network))) for _ in range(args.queries)]
+    for metric in routing.METRICS:
+        latencies = []
+        for source, target in pairs:
+            started = time.perf_counter()
+            network.route((lat[source], lon[source]), (lat[target], lon[target]), metric)
+            latencies.append((time.perf_counter() - started) * 1000)
+        latencies.sort()
+        print(f"{metric:<9} p50 {statistics.median(latencies):6.2f} ms   "
+              f"p99 {latencies[int(len(latencies) * 0.99) - 1]:6.2f} ms   max {latencies[-1]:6.2f} ms")
+
+    # Reference answers from the raw edges
+    node_ids, raw_lat, raw_lon, sources, targets, length_m, travel_s = routing.read_network(nodes_path, edges_path)
+    position = {node_id: i for i, node_id in enumerate(node_ids.tolist())}
+    wrong = 0
+    for metric, weights in (("time", travel_s), ("distance", length_m)):
+        best = {}
+        for u, w, cost in zip(sources.tolist(), targets.tolist(), weights.tolist()):
+            best[(u, w)] = min(cost, best.get((u, w), cost))
+        (us, ws), costs = zip(*best.keys()), list(best.values())
+        graph = coo_matrix((costs, (us, ws)), shape=(len(node_ids),) * 2).tocsr()
+        for source, target in pairs[:args.check]:
+            found = network.route((lat[source], lon[source]), (lat[target], lon[target]), metric)
+            raw_source = position[int(network.node_ids[source])]
+            raw_target = position[int(network.node_ids[target])]
+            expected = dijkstra(graph, indices=raw_source)[raw_target]
+            cost = found["duration_s"] if metric == "time" else found["distance_m"]
+            path_nodes = [position[node_id] for node_id in found["nodes"]]
+            path_cost = sum(best[(u, w)] for u, w in zip(path_nodes, path_nodes[1:]))
+            wrong += abs(cost - expected) > 1e-3 * expected + 0.01 or abs(path_cost - expected) > 1e-3 * expected + 0.01
+    print(f"checked {args.check * 2} routes against Dijkstra, {wrong} wrong")
+    if wrong:
+        raise SystemExit("routes don't match Dijkstra")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import argparse
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import MetaData, create_engine, func, insert, select
+from sqlalchemy.orm import Session
+
+import savings_pipeline
+from database import sync_url
+from savings_scheduler import savings_goals, savings_rules
+from wallet_ledger import CONSUMER_SETTLE_SECONDS, virtual_wallets, wallet_transactions
+
+from _common import (
+    savings_goals_table, savings_rules_table, virtual_wallets_table, wallet_transactions_table, watermark_tables
+)
+
+# Ingests a stream of card purchases for users with round-up and percentage
+# rules, runs the pipeline over it in batches and checks every goal against
+# a per-purchase computation.
+#   python benchmarks/bench_savings_pipeline.py --transactions 1000000 --users 50000
+
+metadata = MetaData()
+virtual_wallets_table(metadata)
+wallet_transactions_table(metadata)
+savings_goals_table(metadata)
+savings_rules_table(metadata)
+watermark_tables(metadata)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--transactions", type=int, default=500_000)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--batch-size", type=int, default=savings_pipeline.PIPELINE_BATCH_SIZE)
+    parser.add_argument("--seed", type=int, default=13)
+    args = parser.parse_args()
+
+    url = os.getenv("DATABASE_URL")
+    if url is None:
+        url = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    engine = create_engine(sync_url(url))
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+
+    rng = random.Random(args.seed)
+    rules = []
+    with Session(engine) as db:
+        db.execute(insert(virtual_wallets), [
+            {"id": i, "user_id": i, "balance": 1e9, "card_number": f"4242-BENCH-{i:08d}", "status": "active"}
+            for i in range(1, args.users + 1)
+        ])
+        db.execute(insert(savings_goals), [
+            {"id": i, "user_id": i, "target_amount": 1e9, "current_amount": 0.0}
+            for i in range(1, args.users + 1)
+        ])
+        # Half the users round up, a quarter save a percentage, the rest have no rule
+        for user_id in range(1, args.users + 1):
+            if user_id % 4 in (0, 1):
+                rules.append({"user_id": user_id, "rule_type": "roundup",
+                              "amount": rng.choice([1.0, 1.0, 5.0]), "target_goal_id": user_id, "is_active": True})
+            elif user_id % 4 == 2:
+                rules.append({"user_id": user_id, "rule_type": "percentage",
+                              "amount": rng.choice([2.0, 5.0, 10.0]), "target_goal_id": user_id, "is_active": True})
+        db.execute(insert(savings_rules), rules)
+
+        # Old enough for the pipeline to read past
+        settled_at = datetime.utcnow() - timedelta(seconds=CONSUMER_SETTLE_SECONDS)
+        purchases = []
+        for _ in range(args.transactions):
+            purchases.append({
+                "wallet_id": rng.randint(1, args.users), "amount": -round(rng.uniform(0.5, 120), 2),
+                "transaction_type": rng.choice(["payment", "payment", "payment", "transfer"]),
+                "status": "completed", "created_at": settled_at
+            })
+        for start in range(0, len(purchases), 50_000):
+            db.execute(insert(wallet_transactions), purchases[start:start + 50_000])
+        db.commit()
+
+    expected = defaultdict(int)
+    by_user = {rule["user_id"]: rule for rule in rules}
+    spent = defaultdict(int)
+    for purchase in purchases:
+        rule = by_user.get(purchase["wallet_id"])
+        if rule is None or purchase["transaction_type"] != "payment":
+            continue
+        cents = round(-purchase["amount"] * 100)
+        if rule["rule_type"] == "roundup":
+            unit = round(rule["amount"] * 100)
+            expected[rule["target_goal_id"]] += math.ceil(cents / unit) * unit - cents
+        else:
+            spent[rule["target_goal_id"]] += cents
+
+    started = time.perf_counter()
+    processed = 0
+    batches = []
+    while True:
+        with Session(engine) as db:
+            count = savings_pipeline.process_batch(db, args.batch_size)
+            db.commit()
+        processed += count
+        if count:
+            batches.append(count)
+        if count < args.batch_size:
+            break
+    elapsed = time.perf_counter() - started
+    print(f"processed {processed} transactions in {len(batches)} batches, {elapsed:.2f}s "
+          f"({processed / elapsed:,.0f} transactions/s)")
+
+    with Session(engine) as db:
+        goals = dict(db.execute(select(savings_goals.c.id, savings_goals.c.current_amount)).all())
+        entries = db.scalar(select(func.count()).select_from(wallet_transactions).where(
+            wallet_transactions.c.transaction_type == "savings"
+        ))
+    metadata.drop_all(engine)
+
+    # Percentages are floored per batch, so allow a cent of difference per batch
+    wrong = 0
+    for rule in rules:
+        goal_id = rule["target_goal_id"]
+        if rule["rule_type"] == "roundup":
+            wrong += abs(round(goals[goal_id] * 100) - expected[goal_id]) > 0
+        else:
+            exact = spent[goal_id] * rule["amount"] / 100
+            wrong += not (exact - len(batches) - 1 <= goals[goal_id] * 100 <= exact + 1)
+    print(f"savings ledger rows {entries} for {len(purchases)} purchases, mismatched goals {wrong}")
+    if wrong:
+        raise SystemExit("goal credits don't match the purchases")
+
+
+if __name__ == "__main__":
+    main()
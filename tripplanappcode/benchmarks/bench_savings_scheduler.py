@@ -0,0 +1,103 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The scheduler's worker processes connect through database.py, so point it
+# at the benchmark database before importing anything that uses it
+if "DATABASE_URL" not in os.environ:
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+
+from sqlalchemy import Index, MetaData, func, insert, select
+from sqlalchemy.orm import Session
+
+import savings_scheduler
+from database import sync_engine
+from wallet_ledger import virtual_wallets, wallet_transactions
+
+from _common import savings_goals_table, savings_rules_table, virtual_wallets_table, wallet_transactions_table
+
+# Schedules a large number of daily/weekly/monthly fixed savings rules, runs
+# the scheduler over them, runs it again for the same period (which must move
+# no money), then checks that what left the wallets is what reached the goals.
+#   python benchmarks/bench_savings_scheduler.py --rules 1000000 --workers 8
+
+metadata = MetaData()
+virtual_wallets_table(metadata)
+wallet_transactions_table(metadata)
+savings_goals_table(metadata)
+savings_rules_table(
+    metadata, Index("ix_bench_savings_rules_active_next_run_at", "is_active", "next_run_at")
+)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rules", type=int, default=200_000)
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=savings_scheduler.SCHEDULER_BATCH_SIZE)
+    parser.add_argument("--seed", type=int, default=5)
+    args = parser.parse_args()
+
+    metadata.drop_all(sync_engine)
+    metadata.create_all(sync_engine)
+    rng = random.Random(args.seed)
+    now = datetime.utcnow()
+    with Session(sync_engine) as db:
+        db.execute(insert(virtual_wallets), [
+            {"id": i, "user_id": i, "balance": round(rng.uniform(0, 500), 2),
+             "card_number": f"4242-BENCH-{i:08d}", "status": "active"}
+            for i in range(1, args.users + 1)
+        ])
+        for start in range(0, args.rules, 50_000):
+            count = min(50_000, args.rules - start)
+            db.execute(insert(savings_scheduler.savings_goals), [
+                {"id": start + i + 1, "user_id": rng.randint(1, args.users),
+                 "target_amount": rng.choice([50.0, 500.0, 5000.0]), "current_amount": 0.0}
+                for i in range(count)
+            ])
+            db.execute(insert(savings_scheduler.savings_rules), [
+                {"user_id": rng.randint(1, args.users), "rule_type": "fixed",
+                 "amount": round(rng.uniform(1, 40), 2), "target_goal_id": start + i + 1, "is_active": True,
+                 "frequency": rng.choice(savings_scheduler.FREQUENCIES),
+                 "next_run_at": now - timedelta(minutes=rng.randint(0, 600))}
+                for i in range(count)
+            ])
+        db.commit()
+        opening = db.scalar(select(func.sum(virtual_wallets.c.balance)))
+
+    started = time.perf_counter()
+    stats = savings_scheduler.run_scheduler(now, args.workers, args.batch_size)
+    elapsed = time.perf_counter() - started
+    print(f"first run     {args.rules} rules with {args.workers} workers in {elapsed:.2f}s "
+          f"({args.rules / elapsed:,.0f} rules/s): {stats}")
+
+    started = time.perf_counter()
+    rerun = savings_scheduler.run_scheduler(now, args.workers, args.batch_size)
+    print(f"same period   {time.perf_counter() - started:.2f}s: {rerun}")
+
+    with Session(sync_engine) as db:
+        closing = db.scalar(select(func.sum(virtual_wallets.c.balance)))
+        saved = db.scalar(select(func.coalesce(func.sum(savings_scheduler.savings_goals.c.current_amount), 0)))
+        ledger = db.scalar(select(func.coalesce(func.sum(wallet_transactions.c.amount), 0)))
+        entries = db.scalar(select(func.count()).select_from(wallet_transactions))
+        overdrawn = db.scalar(select(func.count()).where(virtual_wallets.c.balance < -0.005))
+        overfilled = db.scalar(select(func.count()).where(
+            savings_scheduler.savings_goals.c.current_amount > savings_scheduler.savings_goals.c.target_amount + 0.005
+        ))
+    metadata.drop_all(sync_engine)
+
+    print(f"moved         {opening - closing:.2f} out of wallets, {saved:.2f} into goals, ledger {ledger:.2f}")
+    if (rerun["saved"] or entries != stats["saved"] or overdrawn or overfilled
+            or abs(opening - closing - saved) > 0.05 or abs(ledger + saved) > 0.05):
+        raise SystemExit("savings run was not consistent")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from settlement import plan_settlement
+
+# Plans settlements for synthetic trips and checks every plan zeroes all balances.
+#   python benchmarks/bench_settlement.py --sizes 10 100 1000 --repeat 20
+
+
+def synthetic_balances(participants: int, rng: random.Random) -> dict:
+    balances = {user_id: rng.randint(-50_000, 50_000) for user_id in range(1, participants)}
+    balances[participants] = -sum(balances.values())
+    return balances
+
+
+def check_plan(balances: dict, transfers: list):
+    remaining = dict(balances)
+    for debtor, creditor, cents in transfers:
+        assert cents > 0
+        remaining[debtor] += cents
+        remaining[creditor] -= cents
+    assert not any(remaining.values()), "plan leaves balances unsettled"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 100, 500, 1000])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'participants':>12} {'transfers':>10} {'mean ms':>10} {'max ms':>10}")
+    for size in args.sizes:
+        timings = []
+        transfer_counts = []
+        for _ in range(args.repeat):
+            balances = synthetic_balances(size, rng)
+            started = time.perf_counter()
+            transfers = plan_settlement(balances)
+            timings.append((time.perf_counter() - started) * 1000)
+            check_plan(balances, transfers)
+            transfer_counts.append(len(transfers))
+        print(f"{size:>12} {sum(transfer_counts) / len(transfer_counts):>10.1f} "
+              f"{sum(timings) / len(timings):>10.3f} {max(timings):>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
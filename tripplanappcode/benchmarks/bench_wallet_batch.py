@@ -0,0 +1,95 @@
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import Index, MetaData, create_engine, event, func, insert, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+import wallet_ledger
+from database import pool_options, sync_url
+
+from _common import virtual_wallets_table, wallet_transactions_table
+
+# Pays out one wallet to many recipients, first as N separate transfers the
+# way clients called /api/wallet/transfer, then as one transfer_batch, and
+# counts the statements each sends to the database.
+#   DATABASE_URL=postgresql+asyncpg://... python benchmarks/bench_wallet_batch.py --legs 50
+
+metadata = MetaData()
+virtual_wallets_table(metadata)
+wallet_transactions_table(metadata, Index("ix_bench_wallet_transactions_wallet_id", "wallet_id"))
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--legs", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    url = os.getenv("DATABASE_URL")
+    if url is None:
+        url = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    sync_engine = create_engine(sync_url(url))
+    metadata.drop_all(sync_engine)
+    metadata.create_all(sync_engine)
+    with sync_engine.begin() as connection:
+        connection.execute(insert(wallet_ledger.virtual_wallets), [
+            {"id": i, "user_id": i, "balance": 1_000_000.0 if i == 1 else 0.0,
+             "card_number": f"4242-BENCH-{i:08d}", "status": "active"}
+            for i in range(1, args.legs + 2)
+        ])
+
+    engine = create_async_engine(url, **pool_options(url))
+    session_factory = async_sessionmaker(engine, expire_on_commit=False)
+    statements = [0]
+    event.listen(engine.sync_engine, "before_cursor_execute", lambda *_: statements.__setitem__(0, statements[0] + 1))
+    legs = [(1, recipient, 1.25) for recipient in range(2, args.legs + 2)]
+
+    async def one_by_one():
+        for sender, recipient, amount in legs:
+            async with session_factory() as session:
+                # What /api/wallet/transfer did per call: look both wallets up, then transfer
+                await session.execute(select(wallet_ledger.virtual_wallets.c.id).where(
+                    wallet_ledger.virtual_wallets.c.id.in_([sender, recipient])
+                ))
+                await wallet_ledger.transfer(session, sender, recipient, amount)
+                await session.commit()
+
+    async def batched():
+        async with session_factory() as session:
+            await session.execute(select(wallet_ledger.virtual_wallets.c.id).where(
+                wallet_ledger.virtual_wallets.c.id.in_({wallet_id for leg in legs for wallet_id in leg[:2]})
+            ))
+            await wallet_ledger.transfer_batch(session, legs)
+            await session.commit()
+
+    print(f"database: {url}")
+    print(f"{'mode':<16} {'statements':>12} {'p50 ms':>10} {'p99 ms':>10}")
+    for name, payout in (("one by one", one_by_one), ("batch", batched)):
+        samples = []
+        statements[0] = 0
+        for _ in range(args.rounds):
+            started = time.perf_counter()
+            await payout()
+            samples.append((time.perf_counter() - started) * 1000)
+        samples.sort()
+        print(f"{name:<16} {statements[0] / args.rounds:>12.0f} {statistics.median(samples):>10.2f} "
+              f"{samples[int(len(samples) * 0.99) - 1]:>10.2f}")
+
+    async with session_factory() as session:
+        total = await session.scalar(select(func.sum(wallet_ledger.virtual_wallets.c.balance)))
+        ledger_total = await session.scalar(select(func.sum(wallet_ledger.wallet_transactions.c.amount)))
+    await engine.dispose()
+    metadata.drop_all(sync_engine)
+    if abs(total - 1_000_000.0) > 0.005 or abs(ledger_total or 0) > 0.005:
+        raise SystemExit("money was not conserved")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,137 @@
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import (
+    Column, DateTime, Float, Index, Integer, MetaData, Table, create_engine, func, insert, select
+)
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session
+
+import wallet_ledger
+from database import pool_options, sync_url
+from ledger_compaction import checkpoint_wallet
+
+from _common import virtual_wallets_table, wallet_transactions_table
+
+# Builds a wallet with a long ledger (1M rows by default), checkpointing it
+# periodically the way ledger_compaction.py would, then compares current and
+# historical balance reads against replaying the full history.
+#   python benchmarks/bench_wallet_ledger.py --transactions 1000000 --checkpoint-every 10000
+
+metadata = MetaData()
+virtual_wallets_table(metadata)
+wallet_transactions_table(
+    metadata,
+    Index("ix_bench_wallet_transactions_wallet_id_id", "wallet_id", "id"),
+    Index("ix_bench_wallet_transactions_wallet_id_created_at", "wallet_id", "created_at"),
+)
+Table(
+    "wallet_checkpoints", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("wallet_id", Integer),
+    Column("transaction_id", Integer),
+    Column("as_of", DateTime),
+    Column("balance", Float),
+    Column("created_at", DateTime),
+    Index("ix_bench_wallet_checkpoints_wallet_id_transaction_id", "wallet_id", "transaction_id"),
+    Index("ix_bench_wallet_checkpoints_wallet_id_as_of", "wallet_id", "as_of"),
+)
+
+
+def timed(samples: list, started: float):
+    samples.append((time.perf_counter() - started) * 1000)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--transactions", type=int, default=1_000_000)
+    parser.add_argument("--checkpoint-every", type=int, default=10_000)
+    parser.add_argument("--tail", type=int, default=500, help="rows written after the last checkpoint")
+    parser.add_argument("--reads", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=3)
+    args = parser.parse_args()
+
+    url = os.getenv("DATABASE_URL")
+    if url is None:
+        url = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    sync_engine = create_engine(sync_url(url))
+    metadata.drop_all(sync_engine)
+    metadata.create_all(sync_engine)
+
+    rng = random.Random(args.seed)
+    started_at = datetime(2020, 1, 1)
+    wallet_id = 1
+    written = 0
+    build_started = time.perf_counter()
+    with Session(sync_engine) as db:
+        db.execute(insert(wallet_ledger.virtual_wallets).values(
+            id=wallet_id, user_id=1, balance=0.0, card_number="4242-BENCH-00000001", status="active"
+        ))
+        body = args.transactions - args.tail
+        while written < args.transactions:
+            chunk = min(args.checkpoint_every, (body if written < body else args.transactions) - written)
+            db.execute(insert(wallet_ledger.wallet_transactions), [
+                {
+                    "wallet_id": wallet_id,
+                    "amount": round(rng.uniform(-50, 60), 2),
+                    "transaction_type": "payment",
+                    "status": "completed",
+                    "created_at": started_at + timedelta(minutes=written + i)
+                }
+                for i in range(chunk)
+            ])
+            written += chunk
+            if written <= body:
+                checkpoint_wallet(db, wallet_id)
+            db.commit()
+        # Give the planner statistics, as a production database would have
+        db.connection().exec_driver_sql("ANALYZE")
+        db.commit()
+    print(f"built {args.transactions} rows with checkpoints every {args.checkpoint_every} "
+          f"in {time.perf_counter() - build_started:.1f}s")
+
+    engine = create_async_engine(url, **pool_options(url))
+    session_factory = async_sessionmaker(engine, expire_on_commit=False)
+    replay, current, historical = [], [], []
+    async with session_factory() as db:
+        for _ in range(args.reads):
+            at = started_at + timedelta(minutes=rng.randrange(args.transactions))
+
+            started = time.perf_counter()
+            expected = await db.scalar(
+                select(func.coalesce(func.sum(wallet_ledger.wallet_transactions.c.amount), 0)).where(
+                    wallet_ledger.wallet_transactions.c.wallet_id == wallet_id,
+                    wallet_ledger.wallet_transactions.c.created_at <= at
+                )
+            )
+            timed(replay, started)
+
+            started = time.perf_counter()
+            value = await wallet_ledger.balance(db, wallet_id, at)
+            timed(historical, started)
+            assert abs(value - expected) < 0.01, (at, value, expected)
+
+            started = time.perf_counter()
+            await wallet_ledger.balance(db, wallet_id)
+            timed(current, started)
+    await engine.dispose()
+    metadata.drop_all(sync_engine)
+
+    print(f"{'read':<24} {'p50 ms':>10} {'p99 ms':>10}")
+    for name, samples in (("full replay", replay), ("checkpoint + tail", current),
+                          ("historical (as of)", historical)):
+        samples.sort()
+        print(f"{name:<24} {statistics.median(samples):>10.3f} {samples[int(len(samples) * 0.99) - 1]:>10.3f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
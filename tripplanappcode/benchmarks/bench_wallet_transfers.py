@@ -0,0 +1,120 @@
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import Index, MetaData, create_engine, func, insert, select
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+import wallet_ledger
+from database import pool_options, sync_url
+
+from _common import virtual_wallets_table, wallet_transactions_table
+
+# Fires thousands of concurrent random transfers through wallet_ledger.transfer
+# and checks that no money is created or lost: the total balance is unchanged,
+# the ledger rows net to zero, and every wallet's balance equals its opening
+# balance plus its ledger rows.
+#   DATABASE_URL=postgresql+asyncpg://... python benchmarks/bench_wallet_transfers.py --transfers 20000 --clients 200
+
+OPENING_BALANCE = 1000.0
+
+metadata = MetaData()
+virtual_wallets_table(metadata)
+wallet_transactions_table(metadata, Index("ix_bench_wallet_transactions_wallet_id", "wallet_id"))
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--wallets", type=int, default=100)
+    parser.add_argument("--transfers", type=int, default=5000)
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--max-amount", type=float, default=300.0)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    url = os.getenv("DATABASE_URL")
+    if url is None:
+        url = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    sync_engine = create_engine(sync_url(url))
+    metadata.drop_all(sync_engine)
+    metadata.create_all(sync_engine)
+    with sync_engine.begin() as connection:
+        connection.execute(insert(wallet_ledger.virtual_wallets), [
+            {"id": i, "user_id": i, "balance": OPENING_BALANCE, "card_number": f"4242-BENCH-{i:08d}", "status": "active"}
+            for i in range(1, args.wallets + 1)
+        ])
+
+    engine = create_async_engine(url, **pool_options(url))
+    session_factory = async_sessionmaker(engine, expire_on_commit=False)
+    rng = random.Random(args.seed)
+    work = asyncio.Queue()
+    for _ in range(args.transfers):
+        sender, recipient = rng.sample(range(1, args.wallets + 1), 2)
+        work.put_nowait((sender, recipient, round(rng.uniform(1, args.max_amount), 2)))
+    outcomes = {"ok": 0, "insufficient": 0, "retried": 0}
+
+    async def client():
+        while not work.empty():
+            sender, recipient, amount = work.get_nowait()
+            for attempt in range(10):
+                async with session_factory() as session:
+                    try:
+                        await wallet_ledger.transfer(session, sender, recipient, amount)
+                        await session.commit()
+                        outcomes["ok"] += 1
+                    except wallet_ledger.InsufficientFunds:
+                        await session.rollback()
+                        outcomes["insufficient"] += 1
+                    except DBAPIError:
+                        # Lock timeouts and serialization failures are retried
+                        await session.rollback()
+                        outcomes["retried"] += 1
+                        await asyncio.sleep(0.001 * 2 ** attempt * rng.random())
+                        continue
+                break
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.clients)))
+    elapsed = time.perf_counter() - started
+
+    async with session_factory() as session:
+        total = await session.scalar(select(func.sum(wallet_ledger.virtual_wallets.c.balance)))
+        ledger_total = await session.scalar(select(func.sum(wallet_ledger.wallet_transactions.c.amount)))
+        drift = await session.execute(
+            select(wallet_ledger.virtual_wallets.c.id)
+            .outerjoin(
+                wallet_ledger.wallet_transactions,
+                wallet_ledger.wallet_transactions.c.wallet_id == wallet_ledger.virtual_wallets.c.id
+            )
+            .group_by(wallet_ledger.virtual_wallets.c.id, wallet_ledger.virtual_wallets.c.balance)
+            .having(func.abs(
+                wallet_ledger.virtual_wallets.c.balance - OPENING_BALANCE
+                - func.coalesce(func.sum(wallet_ledger.wallet_transactions.c.amount), 0)
+            ) > 0.005)
+        )
+        drifted = drift.all()
+    await engine.dispose()
+
+    expected = OPENING_BALANCE * args.wallets
+    print(f"database      {url}")
+    print(f"transfers     {args.transfers} by {args.clients} clients in {elapsed:.2f}s "
+          f"({args.transfers / elapsed:.0f}/s)")
+    print(f"outcomes      {outcomes['ok']} ok, {outcomes['insufficient']} insufficient funds, "
+          f"{outcomes['retried']} retries")
+    print(f"total money   {total:.2f} (expected {expected:.2f})")
+    print(f"ledger net    {ledger_total or 0:.2f}")
+    print(f"drifted       {len(drifted)} wallets")
+    metadata.drop_all(sync_engine)
+    if abs(total - expected) > 0.005 or abs(ledger_total or 0) > 0.005 or drifted:
+        raise SystemExit("money was not conserved")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
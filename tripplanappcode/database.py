@@ -0,0 +1,94 @@
+import os
+from sqlalchemy import Date, bindparam, column, create_engine, inspect, select, table, text, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+# Database engines and sessions. Request handlers get their own AsyncSession
+# from get_db; offline jobs and CLIs use the synchronous SessionLocal against
+# the same database.
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./trip_tribe.db")
+
+# Sync driver for each async one, so jobs can share DATABASE_URL
+SYNC_DRIVERS = {
+    "sqlite+aiosqlite": "sqlite",
+    "postgresql+asyncpg": "postgresql+psycopg2",
+    "mysql+aiomysql": "mysql+pymysql",
+}
+
+
+def sync_url(url: str) -> str:
+    scheme, _, rest = url.partition("://")
+    return f"{SYNC_DRIVERS.get(scheme, scheme)}://{rest}"
+
+
+def pool_options(url: str) -> dict:
+    # SQLite manages its own connections; pool sizing only applies to server databases
+    if url.startswith("sqlite"):
+        return {}
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "10")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "20")),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        "pool_pre_ping": True,
+    }
+
+
+engine = create_async_engine(DATABASE_URL, **pool_options(DATABASE_URL))
+AsyncSessionLocal = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+SYNC_DATABASE_URL = os.getenv("SYNC_DATABASE_URL", sync_url(DATABASE_URL))
+sync_engine = create_engine(SYNC_DATABASE_URL, **pool_options(SYNC_DATABASE_URL))
+SessionLocal = sessionmaker(bind=sync_engine, autocommit=False, autoflush=False)
+
+
+def migrate_date_column(engine, table_name: str, column_name: str, to_date) -> int:
+    # Rewrites a column that used to hold strings or timestamps as dates:
+    # to_date(value) maps each stored value to a date (None if it can't), and
+    # on databases with a real DATE type the column's type is changed too.
+    # Safe to run on every start; returns the number of rows rewritten.
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        if table_name not in inspector.get_table_names():
+            return 0
+        current_type = next(c["type"] for c in inspector.get_columns(table_name) if c["name"] == column_name)
+        dialect = connection.dialect.name
+        if isinstance(current_type, Date) and dialect != "sqlite":
+            return 0
+
+        # Untyped, so values come back as the driver stores them
+        stored = table(table_name, column("id"), column(column_name))
+        changed, unreadable = [], []
+        for row_id, value in connection.execute(select(stored.c.id, stored.c[column_name])):
+            if value is None:
+                continue
+            day = to_date(value)
+            if day is None:
+                unreadable.append(row_id)
+            elif value != day and value != day.isoformat():
+                changed.append({"row_id": row_id, "day": day})
+        if unreadable:
+            # Nothing is written; fix or clear these rows and start again
+            raise ValueError(f"{table_name}.{column_name} isn't a date for ids {unreadable[:20]}")
+
+        if changed:
+            target = table(table_name, column("id"), column(column_name, Date))
+            connection.execute(
+                update(target).where(target.c.id == bindparam("row_id")).values({column_name: bindparam("day")}),
+                changed
+            )
+        # SQLite has no column types to change, and reads ISO dates back as dates
+        if dialect == "postgresql":
+            connection.execute(text(
+                f"ALTER TABLE {table_name} ALTER COLUMN {column_name} TYPE DATE USING {column_name}::date"
+            ))
+        elif dialect == "mysql":
+            connection.execute(text(f"ALTER TABLE {table_name} MODIFY {column_name} DATE"))
+    return len(changed)
+
+
+async def get_db():
+    # One session per request, closed (and rolled back if uncommitted) afterwards
+    async with AsyncSessionLocal() as session:
+        yield session
@@ -0,0 +1,77 @@
+from decimal import Decimal, ROUND_HALF_UP
+from fractions import Fraction
+
+# Expense split engine. All arithmetic is done in integer cents so the shares
+# of an expense always add up to exactly its amount.
+
+SPLIT_TYPES = ("equal", "shares", "percentage", "exact")
+
+
+def to_cents(amount) -> int:
+    return int((Decimal(str(amount)) * 100).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+
+
+def from_cents(cents: int) -> float:
+    return cents / 100
+
+
+def allocate(total_cents: int, weights: dict) -> dict:
+    # Largest-remainder apportionment: floor every share, then hand the leftover
+    # cents to the largest fractional parts (ties go to the earlier participant)
+    total_weight = sum(weights.values())
+    if total_weight <= 0:
+        raise ValueError("Split weights must add up to more than zero")
+
+    shares = {}
+    remainders = []
+    for position, (user_id, weight) in enumerate(weights.items()):
+        exact = Fraction(total_cents) * weight / total_weight
+        shares[user_id] = exact.numerator // exact.denominator
+        remainders.append((exact - shares[user_id], -position, user_id))
+
+    leftover = total_cents - sum(shares.values())
+    for _, _, user_id in sorted(remainders, reverse=True)[:leftover]:
+        shares[user_id] += 1
+    return shares
+
+
+def _split_values(splits: dict, participant_ids) -> dict:
+    # JSON object keys arrive as strings
+    values = {int(user_id): value for user_id, value in (splits or {}).items()}
+    unknown = set(values) - set(participant_ids)
+    if unknown:
+        raise ValueError(f"Users {sorted(unknown)} are not participants of this trip")
+    if not values:
+        raise ValueError("Split details are required for this split type")
+    return values
+
+
+def split_expense(total_cents: int, split_type: str, participant_ids, splits: dict = None) -> dict:
+    # Returns {user_id: cents}; the values always sum to total_cents
+    participant_ids = list(participant_ids)
+    if not participant_ids:
+        raise ValueError("Trip has no participants to split with")
+    if split_type not in SPLIT_TYPES:
+        raise ValueError(f"Unknown split type '{split_type}'")
+
+    if split_type == "equal":
+        return allocate(total_cents, {user_id: 1 for user_id in participant_ids})
+
+    values = _split_values(splits, participant_ids)
+    if split_type == "shares":
+        weights = {user_id: Fraction(str(shares)) for user_id, shares in values.items()}
+        if any(weight < 0 for weight in weights.values()):
+            raise ValueError("Shares can't be negative")
+        return allocate(total_cents, weights)
+
+    if split_type == "percentage":
+        weights = {user_id: Fraction(str(percent)) for user_id, percent in values.items()}
+        if any(weight < 0 for weight in weights.values()) or sum(weights.values()) != 100:
+            raise ValueError("Percentages must be non-negative and add up to 100")
+        return allocate(total_cents, weights)
+
+    # exact
+    shares = {user_id: to_cents(amount) for user_id, amount in values.items()}
+    if any(cents < 0 for cents in shares.values()) or sum(shares.values()) != total_cents:
+        raise ValueError("Exact amounts must be non-negative and add up to the expense amount")
+    return shares
@@ -0,0 +1,104 @@
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+# Local stand-in for the parts of the Stripe API the payment gateway uses, for
+# offline development and load tests. Point the backend at it with
+#   STRIPE_API_BASE=http://127.0.0.1:12111
+#   python fake_stripe.py --port 12111 --latency-ms 150 --failure-rate 0.05
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status: int, body: dict):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        form = dict(parse_qsl(self.rfile.read(length).decode()))
+
+        server = self.server
+        time.sleep(max(0.0, random.gauss(server.latency, server.jitter)))
+        if random.random() < server.failure_rate:
+            self._send_json(503, {"error": {"type": "api_error", "message": "Injected failure"}})
+            return
+
+        if self.path != "/v1/payment_intents":
+            self._send_json(404, {"error": {"type": "invalid_request_error", "message": "Unrecognized request URL"}})
+            return
+        if "amount" not in form or "currency" not in form:
+            self._send_json(400, {"error": {"type": "invalid_request_error", "message": "Missing amount or currency"}})
+            return
+
+        idempotency_key = self.headers.get("Idempotency-Key")
+        with server.lock:
+            server.request_count += 1
+            replay = server.idempotent_responses.get(idempotency_key) if idempotency_key else None
+        if replay is not None:
+            self._send_json(200, replay)
+            return
+
+        intent_id = f"pi_{uuid.uuid4().hex[:24]}"
+        intent = {
+            "id": intent_id,
+            "object": "payment_intent",
+            "amount": int(form["amount"]),
+            "currency": form["currency"],
+            "status": "requires_payment_method",
+            "client_secret": f"{intent_id}_secret_{uuid.uuid4().hex[:24]}",
+            "metadata": {key[9:-1]: value for key, value in form.items() if key.startswith("metadata[")},
+            "created": int(time.time())
+        }
+        with server.lock:
+            server.intent_count += 1
+            if idempotency_key:
+                server.idempotent_responses[idempotency_key] = intent
+        self._send_json(200, intent)
+
+
+def make_server(host: str = "127.0.0.1", port: int = 12111, latency_ms: float = 0.0,
+                jitter_ms: float = 0.0, failure_rate: float = 0.0, verbose: bool = False):
+    server = ThreadingHTTPServer((host, port), FakeStripeHandler)
+    server.daemon_threads = True
+    server.latency = latency_ms / 1000
+    server.jitter = jitter_ms / 1000
+    server.failure_rate = failure_rate
+    server.verbose = verbose
+    server.lock = threading.Lock()
+    server.idempotent_responses = {}
+    server.request_count = 0
+    server.intent_count = 0
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local fake Stripe API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12111)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.latency_ms, args.jitter_ms, args.failure_rate, args.verbose)
+    print(f"Fake Stripe listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
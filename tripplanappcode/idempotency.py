@@ -0,0 +1,59 @@
+import asyncio
+import hashlib
+import json
+from fastapi.encoders import jsonable_encoder
+
+# Idempotency-Key support. The first request for a key runs the handler and its
+# response is kept for `ttl` seconds; replays get the stored response back, and
+# duplicates that arrive while the first is still running wait for it. A failed
+# request stores nothing, so the client's next retry runs the handler again.
+#
+# Entries live in a response_cache backend. With RESPONSE_CACHE_URL pointing at
+# Redis every worker shares them: a request claims its key with SET NX before
+# running the handler, so a retry that lands on another worker waits for the
+# first instead of writing a second payment or ledger row. A claim expires
+# after `claim_ttl` seconds, so a worker that dies mid-request doesn't hold the
+# key forever.
+
+
+class IdempotencyConflict(Exception):
+    pass
+
+
+def request_fingerprint(payload) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(self, backend, ttl: float = 24 * 3600, claim_ttl: float = 60, poll_interval: float = 0.05,
+                 prefix: str = "idempotency"):
+        self.backend = backend
+        self.ttl = ttl
+        self.claim_ttl = claim_ttl
+        self.poll_interval = poll_interval
+        self.prefix = prefix
+
+    async def run(self, key: str, fingerprint: str, handler):
+        key = f"{self.prefix}:{key}"
+        while True:
+            stored, = await self.backend.get_many([key])
+            if stored is None:
+                if await self.backend.add(key, {"fingerprint": fingerprint, "done": False}, self.claim_ttl):
+                    break
+                continue
+            if stored["fingerprint"] != fingerprint:
+                if stored["done"]:
+                    raise IdempotencyConflict("Idempotency key was already used with a different request")
+                raise IdempotencyConflict("Idempotency key is in use by a different request")
+            if stored["done"]:
+                return stored["response"]
+            # Another request holds the key; wait for its response or for the claim to go
+            await asyncio.sleep(self.poll_interval)
+
+        try:
+            response = jsonable_encoder(await handler())
+        except BaseException:
+            await self.backend.delete(key)
+            raise
+        await self.backend.set(key, {"fingerprint": fingerprint, "done": True, "response": response}, self.ttl)
+        return response
@@ -0,0 +1,287 @@
+import asyncio
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from routing import RoadNetwork, haversine_m
+
+# Multi-stop itinerary optimizer. The travel times between every pair of stops
+# come from the road network's many-to-many search (or straight lines when no
+# network is built). A nearest-neighbour tour is improved with 2-opt and
+# Or-opt moves, then perturbed and re-improved until the time budget runs out,
+# and the best order is split into daily legs so the busiest day (driving plus
+# time at the stops) is as light as possible.
+#
+# Large requests run in a process pool so one optimization can't hold an API
+# worker; each pool process memory-maps the road network once.
+
+DEFAULT_VISIT_MINUTES = 60
+# Without a road network: straight-line distance, stretched, at an average speed
+DETOUR_FACTOR = 1.3
+STRAIGHT_LINE_SPEED_KMH = 60.0
+TIME_BUDGET_S = 2.0
+MAX_STOPS = 200
+MAX_DAYS = 365
+# Requests with more stops than this go to the process pool
+INLINE_MAX_STOPS = 12
+ITINERARY_WORKERS = int(os.getenv("ITINERARY_WORKERS", "2"))
+# Cost of an edge the tour must not use
+BLOCKED = 1e12
+
+_networks = {}
+_pool = None
+
+
+def road_network(path: str) -> RoadNetwork:
+    if path not in _networks:
+        _networks[path] = RoadNetwork(path)
+    return _networks[path]
+
+
+def travel_matrices(points, network_path: str = None):
+    # (duration_s, distance_m) between every pair of (lat, lon) points
+    if network_path is not None:
+        return road_network(network_path).matrix(points)
+    lat, lon = np.array(points).T
+    distance_m = haversine_m(lat[:, None], lon[:, None], lat[None, :], lon[None, :]) * DETOUR_FACTOR
+    return distance_m / (STRAIGHT_LINE_SPEED_KMH / 3.6), distance_m
+
+
+def _tour_cost(costs, tour):
+    return sum(costs[a][b] for a, b in zip(tour, tour[1:] + tour[:1]))
+
+
+def nearest_neighbour(costs, anchor: int, nodes):
+    tour = [anchor]
+    remaining = set(nodes) - {anchor}
+    while remaining:
+        last = costs[tour[-1]]
+        tour.append(min(remaining, key=last.__getitem__))
+        remaining.remove(tour[-1])
+    return tour
+
+
+def two_opt(costs, tour) -> bool:
+    # One pass of first-improvement 2-opt on a cycle whose first node stays
+    # put. Costs may be asymmetric, so a reversed segment is priced both ways
+    # from prefix sums. Returns whether the tour changed.
+    size = len(tour)
+    improved = False
+    i = 1
+    while i < size - 1:
+        forward, backward = [0.0], [0.0]
+        for a, b in zip(tour, tour[1:]):
+            forward.append(forward[-1] + costs[a][b])
+            backward.append(backward[-1] + costs[b][a])
+        before, first = tour[i - 1], tour[i]
+        for j in range(i + 1, size):
+            last, after = tour[j], tour[(j + 1) % size]
+            delta = (
+                costs[before][last] + costs[first][after] + backward[j] - backward[i]
+                - costs[before][first] - costs[last][after] - forward[j] + forward[i]
+            )
+            if delta < -1e-9:
+                tour[i:j + 1] = tour[i:j + 1][::-1]
+                improved = True
+                break
+        else:
+            i += 1
+    return improved
+
+
+def or_opt(costs, tour, max_segment: int = 3) -> bool:
+    # One pass moving runs of up to max_segment stops elsewhere in the cycle,
+    # as they are or reversed. Returns whether the tour changed.
+    size = len(tour)
+    improved = False
+    for length in range(1, max_segment + 1):
+        i = 1
+        while i + length <= size:
+            segment = tour[i:i + length]
+            before, after = tour[i - 1], tour[(i + length) % size]
+            inside = sum(costs[a][b] for a, b in zip(segment, segment[1:]))
+            reversed_inside = sum(costs[b][a] for a, b in zip(segment, segment[1:]))
+            removed = costs[before][segment[0]] + costs[segment[-1]][after] - costs[before][after]
+            rest = tour[:i] + tour[i + length:]
+            best = None
+            for p in range(len(rest)):
+                x, y = rest[p], rest[(p + 1) % len(rest)]
+                if x == before:
+                    continue
+                added = costs[x][segment[0]] + costs[segment[-1]][y] - costs[x][y]
+                if added - removed < -1e-9 and (best is None or added - removed < best[0]):
+                    best = (added - removed, p, segment)
+                added = costs[x][segment[-1]] + costs[segment[0]][y] - costs[x][y] + reversed_inside - inside
+                if added - removed < -1e-9 and (best is None or added - removed < best[0]):
+                    best = (added - removed, p, segment[::-1])
+            if best is None:
+                i += 1
+                continue
+            _, p, moved = best
+            tour[:] = rest[:p + 1] + moved + rest[p + 1:]
+            improved = True
+    return improved
+
+
+def local_search(costs, tour, deadline: float):
+    while time.perf_counter() < deadline and (two_opt(costs, tour) or or_opt(costs, tour)):
+        pass
+    return tour
+
+
+def double_bridge(tour, rng: random.Random):
+    # Swaps two middle parts of the cycle without reversing anything, which
+    # 2-opt and Or-opt can't undo in one move
+    a, b, c = sorted(rng.sample(range(1, len(tour)), 3))
+    return tour[:a] + tour[b:c] + tour[a:b] + tour[c:]
+
+
+def optimize_tour(costs, tour, time_budget: float = TIME_BUDGET_S, seed: int = 0):
+    # Best cycle found from the initial tour within the time budget, still
+    # starting at the tour's first node
+    deadline = time.perf_counter() + time_budget
+    best = local_search(costs, list(tour), deadline)
+    if len(best) < 5:
+        return best
+    best_cost = _tour_cost(costs, best)
+    rng = random.Random(seed)
+    # Stop early once kicks have stopped paying off
+    patience = 100 + 10 * len(best)
+    since_improvement = 0
+    while time.perf_counter() < deadline and since_improvement < patience:
+        candidate = local_search(costs, double_bridge(best, rng), deadline)
+        candidate_cost = _tour_cost(costs, candidate)
+        if candidate_cost < best_cost - 1e-9:
+            best, best_cost, since_improvement = candidate, candidate_cost, 0
+        else:
+            since_improvement += 1
+    return best
+
+
+def visiting_order(durations, has_start: bool, round_trip: bool, time_budget: float):
+    # Order of the stops (positions in durations, after the start if there is
+    # one) that minimizes total driving. Open itineraries get a dummy node the
+    # tour passes through between its last stop and its first.
+    size = len(durations)
+    costs = durations.tolist()
+    if round_trip:
+        tour = optimize_tour(costs, nearest_neighbour(costs, 0, range(size)), time_budget)
+        return tour[1:] if has_start else tour
+
+    dummy = size
+    padded = np.zeros((size + 1, size + 1))
+    padded[:size, :size] = durations
+    if has_start:
+        # Any stop may end the trip, but the dummy only leads back to the start
+        padded[dummy, 1:size] = BLOCKED
+    tour = optimize_tour(padded.tolist(), nearest_neighbour(costs, 0, range(size)) + [dummy], time_budget)
+    position = tour.index(dummy)
+    tour = tour[position + 1:] + tour[:position]
+    return tour[1:] if has_start else tour
+
+
+def split_days(legs, visits, days: int):
+    # Splits stops (in order) into at most `days` consecutive groups so the
+    # busiest day carries the least load. legs[i] is the drive into stop i,
+    # visits[i] the time spent there. Returns the index each day starts at.
+    count = len(legs)
+    # A day per stop at most, so the table is at most MAX_STOPS square
+    days = min(days, count)
+    prefix = np.concatenate(([0.0], np.cumsum(np.add(legs, visits, dtype=float))))
+    # span[start, k]: stops start..k-1 as one day; a day can't be empty
+    span = prefix[None, :] - prefix[:, None]
+    span[np.tril_indices(count + 1)] = np.inf
+    # best[d, k]: lightest busiest day covering the first k stops in d days
+    best = np.full((days + 1, count + 1), np.inf)
+    split = np.zeros((days + 1, count + 1), dtype=int)
+    best[0, 0] = 0.0
+    columns = np.arange(count + 1)
+    for day in range(1, days + 1):
+        busiest = np.maximum(best[day - 1][:, None], span)
+        split[day] = busiest.argmin(axis=0)
+        best[day] = busiest[split[day], columns]
+    starts, k = [], count
+    for day in range(days, 0, -1):
+        k = int(split[day, k])
+        starts.append(k)
+    return starts[::-1]
+
+
+def plan_itinerary(points, visit_minutes, days: int, start=None, round_trip: bool = False,
+                   network_path: str = None, time_budget: float = TIME_BUDGET_S) -> dict:
+    # points: (lat, lon) of each stop; start: (lat, lon) the trip leaves from,
+    # if any. Stops are referred to by their position in points.
+    everything = ([start] if start is not None else []) + list(points)
+    durations, distances = travel_matrices(everything, network_path)
+    offset = 1 if start is not None else 0
+    order = visiting_order(durations, start is not None, round_trip, time_budget)
+
+    legs = [durations[previous][node] if previous is not None else 0.0
+            for previous, node in zip([0 if start is not None else None] + order[:-1], order)]
+    leg_distances = [distances[previous][node] if previous is not None else 0.0
+                     for previous, node in zip([0 if start is not None else None] + order[:-1], order)]
+    visits = [visit_minutes[node - offset] * 60 for node in order]
+    starts = split_days(legs, visits, days) + [len(order)]
+
+    itinerary = []
+    for day, (first, end) in enumerate(zip(starts, starts[1:]), start=1):
+        stops = [
+            {
+                "stop": order[k] - offset,
+                "drive_minutes": round(legs[k] / 60, 1),
+                "distance_km": round(leg_distances[k] / 1000, 1),
+                "visit_minutes": visit_minutes[order[k] - offset],
+            }
+            for k in range(first, end)
+        ]
+        itinerary.append({
+            "day": day,
+            "stops": stops,
+            "drive_minutes": round(sum(legs[first:end]) / 60, 1),
+            "distance_km": round(sum(leg_distances[first:end]) / 1000, 1),
+        })
+    if round_trip and order:
+        return_leg = durations[order[-1]][0]
+        itinerary[-1]["return_drive_minutes"] = round(return_leg / 60, 1)
+        itinerary[-1]["drive_minutes"] = round(itinerary[-1]["drive_minutes"] + return_leg / 60, 1)
+        itinerary[-1]["distance_km"] = round(itinerary[-1]["distance_km"] + distances[order[-1]][0] / 1000, 1)
+    for day in range(len(itinerary) + 1, days + 1):
+        itinerary.append({"day": day, "stops": [], "drive_minutes": 0.0, "distance_km": 0.0})
+
+    # Driving for the stops in the order they were given, for comparison
+    given = list(range(offset, len(everything)))
+    given_route = ([0] if start is not None else []) + given + ([0] if round_trip else [])
+    return {
+        "order": [node - offset for node in order],
+        "days": itinerary,
+        "drive_minutes": round(sum(day["drive_minutes"] for day in itinerary), 1),
+        "distance_km": round(sum(day["distance_km"] for day in itinerary), 1),
+        "given_order_drive_minutes": round(
+            sum(durations[a][b] for a, b in zip(given_route, given_route[1:])) / 60, 1
+        ),
+        "travel_times": "road_network" if network_path is not None else "straight_line",
+    }
+
+
+def pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=ITINERARY_WORKERS)
+    return _pool
+
+
+async def optimize(points, visit_minutes, days: int, start=None, round_trip: bool = False,
+                   network_path: str = None, time_budget: float = TIME_BUDGET_S) -> dict:
+    args = (points, visit_minutes, days, start, round_trip, network_path, time_budget)
+    if len(points) <= INLINE_MAX_STOPS:
+        return await asyncio.to_thread(plan_itinerary, *args)
+    return await asyncio.get_running_loop().run_in_executor(pool(), plan_itinerary, *args)
+
+
+def close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
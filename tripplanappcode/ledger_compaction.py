@@ -0,0 +1,140 @@
+import argparse
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import case, func, insert, or_, select
+
+from database import SessionLocal
+from wallet_ledger import (
+    SETTLED_STATUS, checkpoint_query, tail_sum_query,
+    virtual_wallets, wallet_checkpoints, wallet_transactions,
+)
+
+# Background job that writes a new checkpoint for every wallet whose ledger has
+# grown by at least `min_tail` rows since its last one, keeping balance reads
+# cheap, and reports wallets whose VirtualWallet.balance projection disagrees
+# with the ledger.
+#
+# A checkpoint only covers rows older than `settle_seconds`. Any write that
+# could still land with an earlier created_at has finished by then, so rows
+# after a checkpoint are never older than its as_of. A checkpoint also stops
+# before a wallet's first pending row, and rows past it don't count towards
+# `min_tail`, so a wallet stuck behind an unsettled deposit isn't picked again.
+#   python ledger_compaction.py --min-tail 1000 --interval 300
+
+SETTLE_SECONDS = 60
+
+
+def wallets_to_compact(db, min_tail: int, limit: int, after_wallet_id: int = 0):
+    # Wallets after after_wallet_id, in id order, with at least min_tail rows
+    # a checkpoint could cover: those after the last checkpoint and before the
+    # first pending row, which may never settle
+    latest = (
+        select(
+            wallet_checkpoints.c.wallet_id,
+            func.max(wallet_checkpoints.c.transaction_id).label("transaction_id")
+        )
+        .group_by(wallet_checkpoints.c.wallet_id)
+        .subquery()
+    )
+    first_pending = (
+        select(wallet_transactions.c.wallet_id, func.min(wallet_transactions.c.id).label("transaction_id"))
+        .where(wallet_transactions.c.status == "pending")
+        .group_by(wallet_transactions.c.wallet_id)
+        .subquery()
+    )
+    return db.execute(
+        select(wallet_transactions.c.wallet_id)
+        .select_from(
+            wallet_transactions
+            .outerjoin(latest, latest.c.wallet_id == wallet_transactions.c.wallet_id)
+            .outerjoin(first_pending, first_pending.c.wallet_id == wallet_transactions.c.wallet_id)
+        )
+        .where(
+            wallet_transactions.c.wallet_id > after_wallet_id,
+            wallet_transactions.c.id > func.coalesce(latest.c.transaction_id, 0),
+            or_(first_pending.c.transaction_id.is_(None), wallet_transactions.c.id < first_pending.c.transaction_id)
+        )
+        .group_by(wallet_transactions.c.wallet_id)
+        .having(func.count() >= min_tail)
+        .order_by(wallet_transactions.c.wallet_id)
+        .limit(limit)
+    ).scalars().all()
+
+
+def checkpoint_wallet(db, wallet_id: int, settle_seconds: float = SETTLE_SECONDS, now: datetime = None):
+    previous = db.execute(checkpoint_query(wallet_id)).first()
+    after_transaction_id, opening_balance, _ = previous if previous else (0, 0.0, None)
+
+    tail = wallet_transactions.c.wallet_id == wallet_id, wallet_transactions.c.id > after_transaction_id
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=settle_seconds)
+    upto = select(func.max(wallet_transactions.c.id)).where(*tail, wallet_transactions.c.created_at <= cutoff)
+    # A pending row may still settle, so the checkpoint stops just before it
+    first_pending = db.scalar(
+        select(func.min(wallet_transactions.c.id)).where(*tail, wallet_transactions.c.status == "pending")
+    )
+    if first_pending is not None:
+        upto = upto.where(wallet_transactions.c.id < first_pending)
+    upto_id = db.scalar(upto)
+    if upto_id is None:
+        return None
+
+    query = select(
+        func.max(wallet_transactions.c.id),
+        func.max(wallet_transactions.c.created_at),
+        func.coalesce(func.sum(case(
+            (wallet_transactions.c.status == SETTLED_STATUS, wallet_transactions.c.amount), else_=0
+        )), 0)
+    ).where(*tail, wallet_transactions.c.id <= upto_id)
+    transaction_id, as_of, amount = db.execute(query).one()
+    db.execute(insert(wallet_checkpoints).values(
+        wallet_id=wallet_id,
+        transaction_id=transaction_id,
+        as_of=as_of,
+        balance=opening_balance + amount,
+        created_at=datetime.utcnow()
+    ))
+    return transaction_id
+
+
+def projection_drift(db, wallet_id: int) -> float:
+    checkpoint = db.execute(checkpoint_query(wallet_id)).first()
+    after_transaction_id, opening_balance, _ = checkpoint if checkpoint else (0, 0.0, None)
+    ledger_balance = opening_balance + db.scalar(tail_sum_query(wallet_id, after_transaction_id))
+    projected = db.scalar(select(virtual_wallets.c.balance).where(virtual_wallets.c.id == wallet_id))
+    return (projected or 0.0) - ledger_balance
+
+
+def run_compaction(min_tail: int = 1000, batch_size: int = 500, settle_seconds: float = SETTLE_SECONDS) -> dict:
+    stats = {"checkpointed": 0, "drifted": []}
+    after_wallet_id = 0
+    while True:
+        with SessionLocal() as db:
+            wallet_ids = wallets_to_compact(db, min_tail, batch_size, after_wallet_id)
+            for wallet_id in wallet_ids:
+                if checkpoint_wallet(db, wallet_id, settle_seconds) is not None:
+                    stats["checkpointed"] += 1
+                drift = projection_drift(db, wallet_id)
+                if abs(drift) >= 0.005:
+                    stats["drifted"].append((wallet_id, drift))
+            db.commit()
+        if len(wallet_ids) < batch_size:
+            return stats
+        after_wallet_id = wallet_ids[-1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checkpoint wallet ledgers")
+    parser.add_argument("--min-tail", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--settle-seconds", type=float, default=SETTLE_SECONDS)
+    parser.add_argument("--interval", type=float, help="seconds between runs; runs once if omitted")
+    args = parser.parse_args()
+
+    while True:
+        stats = run_compaction(args.min_tail, args.batch_size, args.settle_seconds)
+        print(f"{datetime.utcnow().isoformat()} checkpointed {stats['checkpointed']} wallets")
+        for wallet_id, drift in stats["drifted"]:
+            print(f"  wallet {wallet_id}: balance projection is off the ledger by {drift:+.2f}")
+        if args.interval is None:
+            break
+        time.sleep(args.interval)
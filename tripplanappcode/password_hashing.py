@@ -0,0 +1,71 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from passlib.context import CryptContext
+
+# bcrypt off the event loop. A hash or verify at cost 12 takes a few hundred
+# milliseconds of CPU; run inline it stalls every other request on the worker,
+# so they run on a bounded thread pool instead (bcrypt releases the GIL while
+# it works). The cost comes from PASSWORD_HASH_ROUNDS; hashes made at any
+# other cost verify as before and are reported for rehashing, so changing it
+# migrates users as they log in.
+
+DEFAULT_ROUNDS = 12
+MIN_ROUNDS, MAX_ROUNDS = 4, 31
+
+
+def bcrypt_rounds(hashed_password: str) -> int:
+    # "$2b$12$..." -> 12
+    return int(hashed_password.split("$")[2])
+
+
+class PasswordHasher:
+    def __init__(self, rounds: int = DEFAULT_ROUNDS, max_workers: int = None):
+        if not MIN_ROUNDS <= rounds <= MAX_ROUNDS:
+            raise ValueError(f"bcrypt rounds must be between {MIN_ROUNDS} and {MAX_ROUNDS}")
+        self.rounds = rounds
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=rounds)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="bcrypt")
+
+    @classmethod
+    def from_env(cls):
+        workers = os.getenv("PASSWORD_HASH_WORKERS")
+        return cls(
+            rounds=int(os.getenv("PASSWORD_HASH_ROUNDS", str(DEFAULT_ROUNDS))),
+            max_workers=int(workers) if workers else None
+        )
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def needs_rehash(self, hashed_password: str) -> bool:
+        return self.context.needs_update(hashed_password) or bcrypt_rounds(hashed_password) != self.rounds
+
+    def _verify_and_update(self, password: str, hashed_password: str):
+        if not self.context.verify(password, hashed_password):
+            return False, None
+        if self.needs_rehash(hashed_password):
+            return True, self.context.hash(password)
+        return True, None
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.context.hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self._run(self.context.verify, password, hashed_password)
+
+    async def verify_and_update(self, password: str, hashed_password: str):
+        # (matches, new hash or None). The new hash is set when the stored one
+        # was made at another cost and should replace it.
+        if not hashed_password:
+            await self.dummy_verify()
+            return False, None
+        return await self._run(self._verify_and_update, password, hashed_password)
+
+    async def dummy_verify(self):
+        # Spend as long as a real check, so unknown usernames can't be told apart by timing
+        await self._run(self.context.dummy_verify)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
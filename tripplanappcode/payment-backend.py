@@ -1,11 +1,44 @@
-from fastapi import FastAPI, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import FastAPI, Depends, HTTPException, Header
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Index, insert, update, delete, func, select
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, selectinload
 import stripe
+import argparse
+import json
+from collections import defaultdict
 from datetime import datetime
-from typing import List
+from typing import List, Optional
+from pagination import encode_cursor, decode_cursor, clamp_page_size
+from expense_splits import split_expense, to_cents, from_cents
+from settlement import plan_settlement
+from payment_gateway import StripeGateway
+from idempotency import IdempotencyStore, IdempotencyConflict, request_fingerprint
+from database import AsyncSessionLocal, SessionLocal, get_db
+from response_cache import response_cache, trip_scope, user_scope
 
 # Initialize Stripe
 stripe.api_key = "your_stripe_secret_key"  # In production, use environment variable
+payment_gateway = StripeGateway.from_env(default_api_key=stripe.api_key)
+
+@app.on_event("shutdown")
+async def close_payment_gateway():
+    await payment_gateway.close()
+
+# Responses for requests sent with an Idempotency-Key header, shared by the
+# workers through the response cache's backend
+idempotency_store = IdempotencyStore(response_cache.backend, ttl=24 * 3600)
+
+async def run_idempotent(scope: str, idempotency_key: Optional[str], user_id: int, payload: dict, handler):
+    # handler receives the scoped key (or None) to pass on to Stripe
+    if idempotency_key is None:
+        return await handler(None)
+    scoped_key = f"{scope}:{user_id}:{idempotency_key}"
+    try:
+        return await idempotency_store.run(scoped_key, request_fingerprint(payload), lambda: handler(scoped_key))
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=422, detail=str(e))
 
 class Payment(Base):
     __tablename__ = "payments"
@@ -27,91 +60,424 @@ class Expense(Base):
     split_type = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
 
-@app.post("/api/payments/create-intent")
-async def create_payment_intent(payment_data: dict, current_user: User = Depends(get_current_user)):
-    try:
-        # Create Stripe PaymentIntent
-        intent = stripe.PaymentIntent.create(
-            amount=int(payment_data["amount"] * 100),  # Convert to cents
-            currency="usd",
-            metadata={
-                "trip_id": payment_data["trip_id"],
-                "user_id": current_user.id
-            }
+    __table_args__ = (
+        Index("ix_expenses_trip_id_id", "trip_id", "id"),
+    )
+
+class PaymentRequest(Base):
+    __tablename__ = "payment_requests"
+    id = Column(Integer, primary_key=True)
+    expense_id = Column(Integer, ForeignKey("expenses.id"), index=True)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    amount = Column(Float)
+    status = Column(String)  # pending, completed, settled (paid off by a settle-up)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# Materialized running balance per trip participant, kept in integer cents.
+# paid is money put into the trip, owed is the participant's share of expenses.
+class TripBalance(Base):
+    __tablename__ = "trip_balances"
+    trip_id = Column(Integer, ForeignKey("trips.id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    paid_cents = Column(Integer, default=0, nullable=False)
+    owed_cents = Column(Integer, default=0, nullable=False)
+
+# One row per settle-up transfer, so balances can be rebuilt from source rows
+class Settlement(Base):
+    __tablename__ = "settlements"
+    id = Column(Integer, primary_key=True)
+    trip_id = Column(Integer, ForeignKey("trips.id"), index=True)
+    from_user_id = Column(Integer, ForeignKey("users.id"))
+    to_user_id = Column(Integer, ForeignKey("users.id"))
+    amount_cents = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+async def apply_balance_deltas(db: AsyncSession, trip_id: int, deltas: dict):
+    # deltas: {user_id: (paid_cents, owed_cents)}; applied inside the caller's
+    # transaction as one upsert, so two requests creating a user's first
+    # balance row at once both add to it instead of one failing on the key
+    if not deltas:
+        return
+    rows = [
+        {"trip_id": trip_id, "user_id": user_id, "paid_cents": paid_cents, "owed_cents": owed_cents}
+        # In user order, so concurrent upserts lock rows in the same order
+        for user_id, (paid_cents, owed_cents) in sorted(deltas.items())
+    ]
+    dialect = db.bind.dialect.name
+    if dialect == "mysql":
+        statement = mysql.insert(TripBalance).values(rows)
+        statement = statement.on_duplicate_key_update(
+            paid_cents=TripBalance.paid_cents + statement.inserted.paid_cents,
+            owed_cents=TripBalance.owed_cents + statement.inserted.owed_cents
         )
-        
-        # Record payment attempt in database
-        payment = Payment(
-            trip_id=payment_data["trip_id"],
-            user_id=current_user.id,
-            amount=payment_data["amount"],
-            status="pending",
-            payment_method=payment_data["payment_method"]
+    else:
+        statement = (postgresql if dialect == "postgresql" else sqlite).insert(TripBalance).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=[TripBalance.trip_id, TripBalance.user_id],
+            set_={
+                "paid_cents": TripBalance.paid_cents + statement.excluded.paid_cents,
+                "owed_cents": TripBalance.owed_cents + statement.excluded.owed_cents,
+            }
         )
-        db.add(payment)
-        db.commit()
-        
-        return {"client_secret": intent.client_secret}
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    await db.execute(statement)
+
+# Rows fetched per round-trip when walking a trip's expenses
+EXPENSE_BATCH_SIZE = 500
+
+def serialize_expense(expense: Expense):
+    return {
+        "id": expense.id,
+        "trip_id": expense.trip_id,
+        "description": expense.description,
+        "amount": expense.amount,
+        "paid_by": expense.paid_by,
+        "split_type": expense.split_type,
+        "created_at": expense.created_at.isoformat() if expense.created_at else None
+    }
+
+@app.post("/api/payments/create-intent")
+async def create_payment_intent(
+    payment_data: dict,
+    idempotency_key: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    async def handler(scoped_key):
+        try:
+            # Create Stripe PaymentIntent
+            intent = await payment_gateway.create_payment_intent(
+                amount_cents=to_cents(payment_data["amount"]),
+                currency="usd",
+                metadata={
+                    "trip_id": payment_data["trip_id"],
+                    "user_id": current_user.id
+                },
+                idempotency_key=scoped_key
+            )
+            
+            # Record payment attempt in database
+            payment = Payment(
+                trip_id=payment_data["trip_id"],
+                user_id=current_user.id,
+                amount=payment_data["amount"],
+                status="pending",
+                payment_method=payment_data["payment_method"]
+            )
+            db.add(payment)
+            await db.commit()
+            
+            return {"client_secret": intent["client_secret"]}
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    return await run_idempotent("create-intent", idempotency_key, current_user.id, payment_data, handler)
 
 @app.post("/api/expenses/create")
-async def create_expense(expense_data: dict, current_user: User = Depends(get_current_user)):
+async def create_expense(expense_data: dict, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
     try:
+        trip = await db.scalar(
+            select(Trip).options(selectinload(Trip.participants)).where(Trip.id == expense_data["trip_id"])
+        )
+        if trip is None:
+            raise HTTPException(status_code=404, detail="Trip not found")
+
+        # Work out every participant's share in integer cents
+        total_cents = to_cents(expense_data["amount"])
+        shares = split_expense(
+            total_cents,
+            expense_data["split_type"],
+            [participant.user_id for participant in trip.participants],
+            expense_data.get("splits")
+        )
+
         expense = Expense(
             trip_id=expense_data["trip_id"],
             description=expense_data["description"],
-            amount=expense_data["amount"],
+            amount=from_cents(total_cents),
             paid_by=current_user.id,
             split_type=expense_data["split_type"]
         )
         db.add(expense)
-        db.commit()
-        
-        # Calculate and update shares for all participants
-        trip = db.query(Trip).filter(Trip.id == expense_data["trip_id"]).first()
-        participants = trip.participants
-        share_amount = expense_data["amount"] / len(participants)
-        
-        for participant in participants:
-            if participant.user_id != current_user.id:
-                create_payment_request(
-                    user_id=participant.user_id,
-                    amount=share_amount,
-                    expense_id=expense.id
-                )
+        await db.flush()
+
+        # One bulk insert for all payment requests, committed with the expense
+        payment_requests = [
+            {
+                "user_id": user_id,
+                "amount": from_cents(cents),
+                "expense_id": expense.id,
+                "status": "pending"
+            }
+            for user_id, cents in shares.items()
+            if user_id != current_user.id and cents > 0
+        ]
+        if payment_requests:
+            await db.execute(insert(PaymentRequest), payment_requests)
+
+        deltas = defaultdict(lambda: (0, 0))
+        deltas[current_user.id] = (total_cents, 0)
+        for user_id, cents in shares.items():
+            paid_cents, owed_cents = deltas[user_id]
+            deltas[user_id] = (paid_cents, owed_cents + cents)
+        await apply_balance_deltas(db, trip.id, deltas)
+        await db.commit()
+        await response_cache.invalidate(trip_scope(trip.id))
         
         return {"message": "Expense created successfully", "expense_id": expense.id}
+    except HTTPException:
+        await db.rollback()
+        raise
     except Exception as e:
+        await db.rollback()
         raise HTTPException(status_code=400, detail=str(e))
 
-def create_payment_request(user_id: int, amount: float, expense_id: int):
-    payment_request = PaymentRequest(
-        user_id=user_id,
-        amount=amount,
-        expense_id=expense_id,
-        status="pending"
+@app.get("/api/expenses/{trip_id}")
+async def get_trip_expenses(
+    trip_id: int,
+    cursor: Optional[str] = None,
+    limit: int = 50,
+    stream: bool = False,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    query = select(Expense).where(Expense.trip_id == trip_id).order_by(Expense.id)
+
+    # NDJSON stream of every expense, fetched from the DB in batches. The stream
+    # outlives the request's session, so it opens its own.
+    if stream:
+        async def generate():
+            async with AsyncSessionLocal() as stream_db:
+                result = await stream_db.stream_scalars(query.execution_options(yield_per=EXPENSE_BATCH_SIZE))
+                async for expense in result:
+                    yield json.dumps(serialize_expense(expense)) + "\n"
+        return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+    limit = clamp_page_size(limit)
+    if cursor is not None:
+        try:
+            last_id, = decode_cursor(cursor)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.where(Expense.id > last_id)
+
+    expenses = [serialize_expense(expense) for expense in await db.scalars(query.limit(limit + 1))]
+    next_cursor = None
+    if len(expenses) > limit:
+        expenses = expenses[:limit]
+        next_cursor = encode_cursor(expenses[-1]["id"])
+
+    return {"expenses": expenses, "next_cursor": next_cursor}
+
+@app.post("/api/payments/requests/{request_id}/complete")
+async def complete_payment_request(request_id: int, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+    payment_request = await db.scalar(select(PaymentRequest).where(
+        PaymentRequest.id == request_id,
+        PaymentRequest.user_id == current_user.id
+    ))
+    if payment_request is None:
+        raise HTTPException(status_code=404, detail="Payment request not found")
+
+    # Only the first completion moves balances; a settle-up closes the rest
+    result = await db.execute(
+        update(PaymentRequest)
+        .where(PaymentRequest.id == request_id, PaymentRequest.status == "pending")
+        .values(status="completed")
     )
-    db.add(payment_request)
-    db.commit()
+    if result.rowcount == 0:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Payment request already completed or settled")
 
-@app.get("/api/expenses/{trip_id}")
-async def get_trip_expenses(trip_id: int, current_user: User = Depends(get_current_user)):
-    expenses = db.query(Expense).filter(Expense.trip_id == trip_id).all()
-    return expenses
+    expense = await db.get(Expense, payment_request.expense_id)
+    cents = to_cents(payment_request.amount)
+    await apply_balance_deltas(db, expense.trip_id, {
+        current_user.id: (cents, 0),
+        expense.paid_by: (-cents, 0)
+    })
+    await db.commit()
+    await response_cache.invalidate(trip_scope(expense.trip_id))
+    return {"message": "Payment completed"}
 
 @app.get("/api/payments/balance/{trip_id}")
-async def get_trip_balance(trip_id: int, current_user: User = Depends(get_current_user)):
-    expenses = db.query(Expense).filter(
-        Expense.trip_id == trip_id,
-        Expense.paid_by == current_user.id
-    ).all()
-    
-    paid = sum(expense.amount for expense in expenses)
-    owed = calculate_user_share(trip_id, current_user.id)
-    
+async def get_trip_balance(trip_id: int, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+    async def compute():
+        balance = await db.get(TripBalance, (trip_id, current_user.id))
+        paid = from_cents(balance.paid_cents) if balance else 0.0
+        owed = from_cents(balance.owed_cents) if balance else 0.0
+
+        return {
+            "paid": paid,
+            "owed": owed,
+            "balance": from_cents(balance.paid_cents - balance.owed_cents) if balance else 0.0
+        }
+
+    # Every write to a trip's balances invalidates its scope
+    return await response_cache.get_or_compute("trip-balance", [trip_scope(trip_id)], compute, current_user.id)
+
+async def load_settlement_plan(db: AsyncSession, trip_id: int):
+    balances = {
+        user_id: paid_cents - owed_cents
+        for user_id, paid_cents, owed_cents in await db.execute(select(
+            TripBalance.user_id, TripBalance.paid_cents, TripBalance.owed_cents
+        ).where(TripBalance.trip_id == trip_id))
+    }
+    return plan_settlement(balances)
+
+def serialize_settlement(transfers):
+    return [
+        {"from_user_id": debtor, "to_user_id": creditor, "amount": from_cents(cents)}
+        for debtor, creditor, cents in transfers
+    ]
+
+@app.get("/api/payments/settle-up/{trip_id}")
+async def get_settlement_plan(trip_id: int, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+    try:
+        transfers = await load_settlement_plan(db, trip_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"transfers": serialize_settlement(transfers)}
+
+@app.post("/api/payments/settle-up/{trip_id}")
+async def execute_settlement(trip_id: int, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+    trip = await db.get(Trip, trip_id)
+    if trip is None:
+        raise HTTPException(status_code=404, detail="Trip not found")
+    if trip.creator_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Only the trip creator can settle up")
+
+    try:
+        transfers = await load_settlement_plan(db, trip_id)
+        # Every leg moves through the wallets in one batch, together with the balance updates
+        await apply_wallet_transfers(
+            db,
+            [(debtor, creditor, from_cents(cents)) for debtor, creditor, cents in transfers],
+            transaction_type="settlement"
+        )
+        deltas = defaultdict(lambda: (0, 0))
+        for debtor, creditor, cents in transfers:
+            deltas[debtor] = (deltas[debtor][0] + cents, 0)
+            deltas[creditor] = (deltas[creditor][0] - cents, 0)
+        if deltas:
+            await apply_balance_deltas(db, trip_id, deltas)
+            await db.execute(insert(Settlement), [
+                {"trip_id": trip_id, "from_user_id": debtor, "to_user_id": creditor, "amount_cents": cents}
+                for debtor, creditor, cents in transfers
+            ])
+        # The transfers paid off every open request on the trip
+        await db.execute(
+            update(PaymentRequest)
+            .where(
+                PaymentRequest.status == "pending",
+                PaymentRequest.expense_id.in_(select(Expense.id).where(Expense.trip_id == trip_id))
+            )
+            .values(status="settled")
+        )
+        await db.commit()
+    except ValueError as e:
+        await db.rollback()
+        raise HTTPException(status_code=400, detail=str(e))
+    await response_cache.invalidate(trip_scope(trip_id), *(user_scope(user_id) for user_id in deltas))
+
+    return {"message": "Trip settled", "transfers": serialize_settlement(transfers)}
+
+# Recompute trip balances from Expense, PaymentRequest and Settlement rows. These run
+# offline from the command line, on a synchronous session.
+def compute_trip_balances(db: Session, trip_id: int = None):
+    balances = defaultdict(lambda: [0, 0])
+
+    def scoped(query):
+        return query.filter(Expense.trip_id == trip_id) if trip_id is not None else query
+
+    # Payers put the full expense in
+    for t_id, user_id, amount in scoped(
+        db.query(Expense.trip_id, Expense.paid_by, func.sum(Expense.amount))
+    ).group_by(Expense.trip_id, Expense.paid_by):
+        balances[(t_id, user_id)][0] += to_cents(amount)
+
+    # Everyone with a payment request owes it
+    for t_id, user_id, amount in scoped(
+        db.query(Expense.trip_id, PaymentRequest.user_id, func.sum(PaymentRequest.amount))
+        .join(Expense, Expense.id == PaymentRequest.expense_id)
+    ).group_by(Expense.trip_id, PaymentRequest.user_id):
+        balances[(t_id, user_id)][1] += to_cents(amount)
+
+    # The payer owes whatever part of the expense wasn't requested from others
+    requested = (
+        db.query(PaymentRequest.expense_id, func.sum(PaymentRequest.amount).label("amount"))
+        .group_by(PaymentRequest.expense_id)
+        .subquery()
+    )
+    for t_id, user_id, amount in scoped(
+        db.query(Expense.trip_id, Expense.paid_by, func.sum(Expense.amount - func.coalesce(requested.c.amount, 0)))
+        .outerjoin(requested, requested.c.expense_id == Expense.id)
+    ).group_by(Expense.trip_id, Expense.paid_by):
+        balances[(t_id, user_id)][1] += to_cents(amount)
+
+    # Completed payment requests move money from the debtor to the payer
+    for t_id, user_id, payer_id, amount in scoped(
+        db.query(Expense.trip_id, PaymentRequest.user_id, Expense.paid_by, func.sum(PaymentRequest.amount))
+        .join(Expense, Expense.id == PaymentRequest.expense_id)
+        .filter(PaymentRequest.status == "completed")
+    ).group_by(Expense.trip_id, PaymentRequest.user_id, Expense.paid_by):
+        balances[(t_id, user_id)][0] += to_cents(amount)
+        balances[(t_id, payer_id)][0] -= to_cents(amount)
+
+    # Settle-up transfers do the same between debtor and creditor
+    settlements = db.query(
+        Settlement.trip_id, Settlement.from_user_id, Settlement.to_user_id, func.sum(Settlement.amount_cents)
+    )
+    if trip_id is not None:
+        settlements = settlements.filter(Settlement.trip_id == trip_id)
+    for t_id, debtor, creditor, cents in settlements.group_by(
+        Settlement.trip_id, Settlement.from_user_id, Settlement.to_user_id
+    ):
+        balances[(t_id, debtor)][0] += cents
+        balances[(t_id, creditor)][0] -= cents
+
+    return {key: tuple(value) for key, value in balances.items() if value != [0, 0]}
+
+def verify_trip_balances(db: Session, trip_id: int = None):
+    expected = compute_trip_balances(db, trip_id)
+    query = db.query(TripBalance)
+    if trip_id is not None:
+        query = query.filter(TripBalance.trip_id == trip_id)
+    stored = {
+        (balance.trip_id, balance.user_id): (balance.paid_cents, balance.owed_cents)
+        for balance in query
+        if (balance.paid_cents, balance.owed_cents) != (0, 0)
+    }
     return {
-        "paid": paid,
-        "owed": owed,
-        "balance": paid - owed
+        key: {"expected": expected.get(key, (0, 0)), "stored": stored.get(key, (0, 0))}
+        for key in expected.keys() | stored.keys()
+        if expected.get(key) != stored.get(key)
     }
+
+def rebuild_trip_balances(db: Session, trip_id: int = None):
+    expected = compute_trip_balances(db, trip_id)
+    statement = delete(TripBalance)
+    if trip_id is not None:
+        statement = statement.where(TripBalance.trip_id == trip_id)
+    db.execute(statement)
+    if expected:
+        db.execute(insert(TripBalance), [
+            {"trip_id": t_id, "user_id": user_id, "paid_cents": paid_cents, "owed_cents": owed_cents}
+            for (t_id, user_id), (paid_cents, owed_cents) in expected.items()
+        ])
+    db.commit()
+    return len(expected)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild or verify materialized trip balances")
+    parser.add_argument("command", choices=["rebuild-balances", "verify-balances"])
+    parser.add_argument("--trip-id", type=int)
+    args = parser.parse_args()
+
+    with SessionLocal() as db:
+        if args.command == "rebuild-balances":
+            print(f"Rebuilt {rebuild_trip_balances(db, args.trip_id)} balances")
+        else:
+            mismatches = verify_trip_balances(db, args.trip_id)
+            for (t_id, user_id), values in sorted(mismatches.items()):
+                print(f"trip {t_id} user {user_id}: expected {values['expected']} stored {values['stored']}")
+            print(f"{len(mismatches)} mismatched balances")
+            if mismatches:
+                raise SystemExit(1)
@@ -0,0 +1,121 @@
+import asyncio
+import os
+import random
+import uuid
+
+import httpx
+
+# Async Stripe client. Calls go over a pooled httpx connection pool instead of
+# the blocking stripe library, so a slow Stripe response only suspends the
+# request waiting on it.
+
+# Status codes Stripe documents as safe to retry
+RETRYABLE_STATUS_CODES = {409, 429, 500, 502, 503, 504}
+
+
+class PaymentGatewayError(Exception):
+    def __init__(self, message: str, status_code: int = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class StripeGateway:
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str = "https://api.stripe.com",
+        timeout: float = 10.0,
+        max_connections: int = 100,
+        max_concurrency: int = 50,
+        max_retries: int = 3,
+        backoff_base: float = 0.25,
+        backoff_cap: float = 4.0
+    ):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client = None
+
+    @classmethod
+    def from_env(cls, default_api_key: str = None):
+        return cls(
+            api_key=os.getenv("STRIPE_SECRET_KEY", default_api_key),
+            base_url=os.getenv("STRIPE_API_BASE", "https://api.stripe.com"),
+            timeout=float(os.getenv("STRIPE_TIMEOUT", "10")),
+            max_connections=int(os.getenv("STRIPE_MAX_CONNECTIONS", "100")),
+            max_concurrency=int(os.getenv("STRIPE_MAX_CONCURRENCY", "50")),
+            max_retries=int(os.getenv("STRIPE_MAX_RETRIES", "3"))
+        )
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                auth=(self.api_key, ""),
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections
+                )
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _backoff(self, attempt: int) -> float:
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    async def request(self, method: str, path: str, data: dict = None,
+                      idempotency_key: str = None, timeout: float = None) -> dict:
+        # Every POST carries an idempotency key so a retried call can't charge twice
+        headers = {}
+        if method.upper() == "POST":
+            headers["Idempotency-Key"] = idempotency_key or str(uuid.uuid4())
+
+        client = self._get_client()
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._semaphore:
+                    response = await client.request(
+                        method, path, data=data, headers=headers,
+                        timeout=self.timeout if timeout is None else timeout
+                    )
+            except (httpx.TimeoutException, httpx.TransportError) as e:
+                error = PaymentGatewayError(f"Stripe request failed: {e}")
+            else:
+                if response.status_code < 400:
+                    return response.json()
+                error = PaymentGatewayError(_error_message(response), response.status_code)
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    raise error
+
+            if attempt == self.max_retries:
+                raise error
+            await asyncio.sleep(self._backoff(attempt))
+
+    async def create_payment_intent(self, amount_cents: int, currency: str = "usd",
+                                    metadata: dict = None, idempotency_key: str = None,
+                                    timeout: float = None) -> dict:
+        data = {"amount": amount_cents, "currency": currency}
+        for key, value in (metadata or {}).items():
+            data[f"metadata[{key}]"] = value
+        return await self.request(
+            "POST", "/v1/payment_intents", data=data,
+            idempotency_key=idempotency_key, timeout=timeout
+        )
+
+
+def _error_message(response: httpx.Response) -> str:
+    try:
+        return response.json()["error"]["message"]
+    except Exception:
+        return f"Stripe returned HTTP {response.status_code}"
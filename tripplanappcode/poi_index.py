@@ -0,0 +1,236 @@
+import argparse
+import csv
+import json
+import math
+import os
+import time
+import numpy as np
+
+from routing import load_array
+
+# Points of interest (lodging, attractions, fuel) along a route corridor. A CSV
+# dump is bulk-loaded once into flat .npy columns sorted by category and grid
+# cell, best-rated first within a cell, plus a directory of the cells that hold
+# anything; the API memory-maps them at startup. A query collects the cells
+# within reach of the part of the route driven around a given hour, slices
+# their rows straight out of the mapped columns and applies the rating, price
+# and distance filters to those arrays, so only the k rows returned ever
+# become Python objects.
+#   python poi_index.py build --pois pois.csv -o poi_index
+#
+# pois.csv: id,name,category,lat,lon[,rating][,price]; category is one of
+#           CATEGORIES, and a missing rating or price fails any filter on it
+
+CATEGORIES = ("lodging", "attraction", "fuel")
+# Roughly 5 km cells: a corridor query touches a few per kilometre of route
+POI_GRID_DEGREES = 0.05
+LAT_CELLS = round(180 / POI_GRID_DEGREES) + 1
+LON_CELLS = round(360 / POI_GRID_DEGREES) + 1
+KM_PER_DEGREE_LAT = 110.57
+KM_PER_DEGREE_LON = 111.32
+# Candidates are measured against the route this many at a time
+DISTANCE_CHUNK = 1024
+
+
+def cell_keys(category, lat, lon):
+    # Grid cell of each point, numbered within its category
+    lat_cell = np.floor((np.asarray(lat) + 90) / POI_GRID_DEGREES).astype(np.int64)
+    lon_cell = np.floor((np.asarray(lon) + 180) / POI_GRID_DEGREES).astype(np.int64)
+    return np.asarray(category, dtype=np.int64) * (LAT_CELLS * LON_CELLS) + lat_cell * LON_CELLS + lon_cell
+
+
+def read_pois(pois_path: str):
+    # Column arrays (ids, names, category, lat, lon, rating, price)
+    ids, names, category, lat, lon, rating, price = [], [], [], [], [], [], []
+    with open(pois_path, newline="") as f:
+        for line, row in enumerate(csv.DictReader(f), start=2):
+            kind = row["category"].strip().lower()
+            if kind not in CATEGORIES:
+                raise ValueError(f"line {line}: unknown category {row['category']!r}")
+            ids.append(int(row["id"]))
+            names.append(row["name"].strip())
+            category.append(CATEGORIES.index(kind))
+            lat.append(float(row["lat"]))
+            lon.append(float(row["lon"]))
+            rating.append(float(row.get("rating") or "nan"))
+            price.append(float(row.get("price") or "nan"))
+    return (
+        np.array(ids, dtype=np.int64), np.array(names, dtype=str), np.array(category, dtype=np.int8),
+        np.array(lat), np.array(lon), np.array(rating, dtype=np.float32), np.array(price, dtype=np.float32),
+    )
+
+
+def build(pois_path: str, output: str):
+    started = time.perf_counter()
+    ids, names, category, lat, lon, rating, price = read_pois(pois_path)
+    keys = cell_keys(category, lat, lon)
+    # By cell, then best rating first (unrated last)
+    order = np.lexsort((-rating, keys))
+    keys = keys[order]
+    cells, cell_start = np.unique(keys, return_index=True)
+
+    os.makedirs(output, exist_ok=True)
+    arrays = {
+        "id": ids[order], "name": names[order], "lat": lat[order], "lon": lon[order],
+        "rating": rating[order], "price": price[order],
+        "cells": cells, "cell_start": np.append(cell_start, len(keys)).astype(np.int64),
+    }
+    for name, values in arrays.items():
+        np.save(os.path.join(output, f"{name}.npy"), values)
+    meta = {
+        "pois": int(len(ids)),
+        "categories": {kind: int((category == i).sum()) for i, kind in enumerate(CATEGORIES)},
+        "grid_degrees": POI_GRID_DEGREES,
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "build_seconds": round(time.perf_counter() - started, 1),
+    }
+    with open(os.path.join(output, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    return meta
+
+
+class PoiIndex:
+    def __init__(self, path: str):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        for name in ("id", "name", "lat", "lon", "rating", "price", "cells", "cell_start"):
+            setattr(self, name, load_array(path, name))
+
+    def __len__(self):
+        return len(self.id)
+
+    def _rows(self, keys):
+        # Positions of every row in the given cells
+        found = np.searchsorted(self.cells, keys)
+        present = found < len(self.cells)
+        found, keys = found[present], keys[present]
+        found = found[self.cells[found] == keys]
+        starts, ends = self.cell_start[found], self.cell_start[found + 1]
+        counts = ends - starts
+        # One arange per cell, laid end to end
+        offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts)
+        return offsets + np.arange(counts.sum())
+
+    def along_route(self, geometry, elapsed_s, category: str = "lodging", k: int = 5, radius_km: float = 10.0,
+                    hour: float = None, window_hours: float = 1.0, min_rating: float = None,
+                    max_price: float = None):
+        # The k best-rated places of a category within radius_km of a route
+        # ([[lat, lon], ...] with the driving seconds to each point), limited to
+        # the stretch driven within window_hours of `hour` when it's given
+        points = np.asarray(geometry, dtype=float).reshape(-1, 2)
+        elapsed = np.asarray(elapsed_s, dtype=float)
+        if len(points) == 1:
+            points, elapsed = np.repeat(points, 2, axis=0), np.repeat(elapsed, 2)
+        starts, ends = points[:-1], points[1:]
+        start_s, end_s = elapsed[:-1], elapsed[1:]
+        if hour is not None:
+            # Past the end of the drive means near the destination
+            at = min(max(hour * 3600, 0.0), elapsed[-1])
+            keep = (end_s >= at - window_hours * 3600) & (start_s <= at + window_hours * 3600)
+            starts, ends, start_s, end_s = starts[keep], ends[keep], start_s[keep], end_s[keep]
+        if not len(starts):
+            return []
+
+        # Sample the segments at least every half cell; every cell within
+        # radius_km of a sample is paired with the sample's segment
+        steps = np.maximum(np.ceil(np.abs(ends - starts).max(axis=1) / (POI_GRID_DEGREES / 2)), 1).astype(np.int64)
+        segment = np.repeat(np.arange(len(starts)), steps + 1)
+        fraction = np.arange(len(segment)) - np.repeat(np.cumsum(steps + 1) - steps - 1, steps + 1)
+        fraction = fraction / steps[segment]
+        samples = starts[segment] + (ends[segment] - starts[segment]) * fraction[:, None]
+        # Widened by the sample spacing, so a segment is paired with every cell
+        # holding something within radius_km of any point on it
+        d_lat = radius_km / KM_PER_DEGREE_LAT + POI_GRID_DEGREES / 2
+        d_lon = radius_km / (KM_PER_DEGREE_LON * np.maximum(np.cos(np.radians(samples[:, 0])), 0.01)) \
+            + POI_GRID_DEGREES / 2
+        lat_low = np.floor((samples[:, 0] - d_lat + 90) / POI_GRID_DEGREES).astype(np.int64)
+        lon_low = np.floor((samples[:, 1] - d_lon + 180) / POI_GRID_DEGREES).astype(np.int64)
+        lat_high = np.floor((samples[:, 0] + d_lat + 90) / POI_GRID_DEGREES).astype(np.int64)
+        lon_high = np.floor((samples[:, 1] + d_lon + 180) / POI_GRID_DEGREES).astype(np.int64)
+        base = CATEGORIES.index(category) * (LAT_CELLS * LON_CELLS)
+        pair_keys, pair_segments = [], []
+        for d_row in range(int((lat_high - lat_low).max()) + 1):
+            for d_col in range(int((lon_high - lon_low).max()) + 1):
+                inside = (lat_low + d_row <= lat_high) & (lon_low + d_col <= lon_high)
+                pair_keys.append(base + (lat_low[inside] + d_row) * LON_CELLS + lon_low[inside] + d_col)
+                pair_segments.append(segment[inside])
+        # Packed into one integer each, sorted by cell
+        pairs = np.unique(np.concatenate(pair_keys) * len(starts) + np.concatenate(pair_segments))
+        pair_keys, pair_segments = np.divmod(pairs, len(starts))
+        rows = self._rows(np.unique(pair_keys))
+
+        # Cheap filters first, on the mapped columns
+        if min_rating is not None:
+            rows = rows[self.rating[rows] >= min_rating]
+        if max_price is not None:
+            rows = rows[self.price[rows] <= max_price]
+        # Best rated first, unrated last
+        rank = -self.rating[rows].astype(float)
+        rank[np.isnan(rank)] = np.inf
+        order = np.argsort(rank, kind="stable")
+        rows, rank = rows[order], rank[order]
+
+        # Distances to the nearby segments on a local flat projection, a chunk
+        # of candidates at a time until no later one can make the top k
+        latitude = float(np.concatenate([starts, ends])[:, 0].mean())
+        scale = np.array([KM_PER_DEGREE_LAT, KM_PER_DEGREE_LON * math.cos(math.radians(latitude))])
+        a, direction = starts * scale, (ends - starts) * scale
+        length2 = np.maximum((direction ** 2).sum(axis=1), 1e-12)
+        found_rows, found_ranks, found_distance, found_reached = [], [], [], []
+        for chunk in range(0, len(rows), DISTANCE_CHUNK):
+            # Candidates come best rated first, so once k are found only ties
+            # with the k-th can still get in
+            if len(found_rows) >= k and rank[chunk] > found_ranks[k - 1]:
+                break
+            part = rows[chunk:chunk + DISTANCE_CHUNK]
+            low = np.searchsorted(pair_keys, cell_keys(CATEGORIES.index(category), self.lat[part], self.lon[part]))
+            high = np.searchsorted(pair_keys, pair_keys[low], side="right")
+            counts = high - low
+            candidate = np.repeat(np.arange(len(part)), counts)
+            near = pair_segments[np.repeat(low - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts)
+                                 + np.arange(counts.sum())]
+            p = np.stack([self.lat[part], self.lon[part]], axis=1)[candidate] * scale
+            t = np.clip(((p - a[near]) * direction[near]).sum(axis=1) / length2[near], 0, 1)
+            gap = ((a[near] + t[:, None] * direction[near] - p) ** 2).sum(axis=1)
+            # Closest segment of each candidate
+            closest = np.lexsort((gap, candidate))
+            closest = closest[np.r_[True, candidate[closest][1:] != candidate[closest][:-1]]]
+            distance_km = np.sqrt(gap[closest])
+            segment_at = near[closest]
+            reached = start_s[segment_at] + t[closest] * (end_s[segment_at] - start_s[segment_at])
+            inside = np.flatnonzero(distance_km <= radius_km)
+            found_rows.extend(part[inside].tolist())
+            found_distance.extend(distance_km[inside].tolist())
+            found_reached.extend(reached[inside].tolist())
+            found_ranks.extend(rank[chunk + inside].tolist())
+        found_rows = np.array(found_rows, dtype=np.int64)
+
+        # Best rated, then closest to the road
+        best = np.lexsort((found_distance, found_ranks))[:k]
+        return [
+            {
+                "id": int(self.id[row]),
+                "name": str(self.name[row]),
+                "category": category,
+                "lat": round(float(self.lat[row]), 6),
+                "lon": round(float(self.lon[row]), 6),
+                "rating": None if np.isnan(self.rating[row]) else round(float(self.rating[row]), 1),
+                "price": None if np.isnan(self.price[row]) else round(float(self.price[row]), 2),
+                "distance_km": round(found_distance[i], 1),
+                "reached_after_minutes": round(found_reached[i] / 60),
+            }
+            for i, row in zip(best.tolist(), found_rows[best].tolist())
+        ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk-load points of interest into a corridor index")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build")
+    build_parser.add_argument("--pois", required=True)
+    build_parser.add_argument("-o", "--output", default="poi_index")
+    args = parser.parse_args()
+
+    meta = build(args.pois, args.output)
+    print(f"{meta['pois']} places indexed in {meta['build_seconds']}s: "
+          + ", ".join(f"{count} {kind}" for kind, count in meta["categories"].items()))
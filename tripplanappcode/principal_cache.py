@@ -0,0 +1,126 @@
+import hashlib
+import math
+import os
+import time
+from collections import OrderedDict
+
+# Resolved principals for get_current_user, so an authenticated request
+# normally costs a dict lookup rather than a JWT decode and a users query.
+# Entries are keyed by a hash of the bearer token (the token itself is never
+# kept) and hold a snapshot of the user's columns. An entry lives for at most
+# `ttl` seconds and never past the token's exp; changing a user's
+# verification status, rating or interests drops every entry for that user,
+# and a revoked token stays rejected until it would have expired anyway.
+#
+# The cache is per process: with several workers, an invalidation reaches the
+# others when their entries age out, so keep the TTL short. Revocations also
+# go to TokenRevocations, which keeps them in the response cache's backend:
+# with RESPONSE_CACHE_URL pointing at Redis every worker sees a logout at
+# once. Without it the backend is in-process too, so a logout only holds on
+# the worker that served it until the token expires.
+
+
+def token_key(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class PrincipalCache:
+    def __init__(self, max_entries: int = 100_000, ttl: float = 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # token key -> (expires_at, user_id, columns), least recently used first
+        self._tokens_by_user = {}       # user_id -> {token key}
+        self._revoked = {}              # token key -> token exp
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_entries=int(os.getenv("PRINCIPAL_CACHE_MAX_ENTRIES", "100000")),
+            ttl=float(os.getenv("PRINCIPAL_CACHE_TTL", "60"))
+        )
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, token: str):
+        # The cached columns for this token, or None
+        key = token_key(token)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= time.time():
+            self._drop(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    def put(self, token: str, user_id: int, columns: dict, token_exp: float):
+        key = token_key(token)
+        if key in self._revoked:
+            return
+        self._drop(key)
+        self._entries[key] = (min(time.time() + self.ttl, token_exp), user_id, columns)
+        self._tokens_by_user.setdefault(user_id, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            keys = self._tokens_by_user.get(entry[1])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tokens_by_user[entry[1]]
+
+    def invalidate_user(self, user_id: int):
+        for key in list(self._tokens_by_user.get(user_id, ())):
+            self._drop(key)
+
+    def revoke(self, token: str, token_exp: float):
+        now = time.time()
+        # Tokens past their exp are rejected by the JWT check anyway
+        for key, exp in list(self._revoked.items()):
+            if exp <= now:
+                del self._revoked[key]
+        key = token_key(token)
+        self._drop(key)
+        self._revoked[key] = token_exp
+
+    def is_revoked(self, token: str) -> bool:
+        return token_key(token) in self._revoked
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "revoked": len(self._revoked),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+class TokenRevocations:
+    # Revoked tokens in a response_cache backend, each kept until its token's
+    # exp. Checked on every request, cache hit or not, so it costs one Redis
+    # GET per request when Redis is configured.
+    def __init__(self, backend, prefix: str = "revoked"):
+        self.backend = backend
+        self.prefix = prefix
+
+    def _key(self, token: str) -> str:
+        return f"{self.prefix}:{token_key(token)}"
+
+    async def revoke(self, token: str, token_exp: float):
+        ttl = math.ceil(token_exp - time.time())
+        if ttl > 0:
+            await self.backend.set(self._key(token), 1, ttl)
+
+    async def is_revoked(self, token: str) -> bool:
+        value, = await self.backend.get_many([self._key(token)])
+        return value is not None
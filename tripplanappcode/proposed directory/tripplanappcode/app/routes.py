@@ -1,5 +1,6 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from .models import SavingsGoal, BudgetCategory, SavingsRule
 from .schemas import SavingsGoalCreate, BudgetCategoryCreate
 from .utils import get_db, get_current_user
@@ -7,7 +8,7 @@ from .utils import get_db, get_current_user
 router = APIRouter()
 
 @router.post("/api/savings/create-goal")
-async def create_savings_goal(goal_data: SavingsGoalCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def create_savings_goal(goal_data: SavingsGoalCreate, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
     new_goal = SavingsGoal(
         user_id=current_user.id,
         name=goal_data.name,
@@ -18,11 +19,11 @@ async def create_savings_goal(goal_data: SavingsGoalCreate, db: Session = Depend
         auto_save_frequency=goal_data.auto_save_frequency
     )
     db.add(new_goal)
-    db.commit()
+    await db.commit()
     return {"message": "Savings goal created successfully", "goal_id": new_goal.id}
 
 @router.post("/api/budget/set-category")
-async def set_budget_category(category_data: BudgetCategoryCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def set_budget_category(category_data: BudgetCategoryCreate, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
     category = BudgetCategory(
         user_id=current_user.id,
         name=category_data.name,
@@ -30,15 +31,15 @@ async def set_budget_category(category_data: BudgetCategoryCreate, db: Session =
         month=datetime.utcnow().replace(day=1)
     )
     db.add(category)
-    db.commit()
+    await db.commit()
     return {"message": "Budget category set successfully"}
 
 @router.get("/api/budget/analysis")
-async def get_budget_analysis(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    categories = db.query(BudgetCategory).filter(
+async def get_budget_analysis(db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+    categories = (await db.scalars(select(BudgetCategory).where(
         BudgetCategory.user_id == current_user.id,
         BudgetCategory.month == datetime.utcnow().replace(day=1)
-    ).all()
+    ))).all()
     
     analysis = []
     for category in categories:
@@ -56,7 +57,7 @@ async def get_budget_analysis(db: Session = Depends(get_db), current_user: User
     return analysis
 
 @router.get("/api/savings/recommendations")
-async def get_savings_recommendations(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def get_savings_recommendations(db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
     spending_patterns = analyze_spending_patterns(current_user.id)
     recommendations = []
     
@@ -68,10 +69,10 @@ async def get_savings_recommendations(db: Session = Depends(get_db), current_use
             "message": "Reducing daily coffee purchases could save you significant money"
         })
     
-    active_goals = db.query(SavingsGoal).filter(
+    active_goals = (await db.scalars(select(SavingsGoal).where(
         SavingsGoal.user_id == current_user.id,
         SavingsGoal.current_amount < SavingsGoal.target_amount
-    ).all()
+    ))).all()
     
     for goal in active_goals:
         remaining_amount = goal.target_amount - goal.current_amount
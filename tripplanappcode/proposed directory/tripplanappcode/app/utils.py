@@ -1,3 +1,11 @@
+from datetime import datetime
+from .database import AsyncSessionLocal
+
+async def get_db():
+    # One session per request, closed (and rolled back if uncommitted) afterwards
+    async with AsyncSessionLocal() as session:
+        yield session
+
 def calculate_savings_goal_progress(target_amount: float, current_amount: float, deadline: datetime) -> dict:
     remaining_amount = target_amount - current_amount
     remaining_days = (deadline - datetime.utcnow()).days
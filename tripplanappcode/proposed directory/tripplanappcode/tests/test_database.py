@@ -0,0 +1,68 @@
+import asyncio
+import os
+import tempfile
+
+import pytest
+from sqlalchemy import text
+
+# A scratch database, unless the run points DATABASE_URL somewhere else
+os.environ.setdefault(
+    "DATABASE_URL", f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'test_database.db')}"
+)
+
+from app.utils import get_db
+
+TABLE = "get_db_test_rows"
+
+
+async def with_session(work):
+    # Runs work(session) inside get_db the way FastAPI drives a dependency:
+    # an exception from the handler is thrown into it
+    dependency = get_db()
+    session = await dependency.__anext__()
+    try:
+        result = await work(session)
+    except Exception as e:
+        with pytest.raises(type(e)):
+            await dependency.athrow(e)
+        raise
+    await dependency.aclose()
+    return result
+
+
+async def setup_table(session):
+    await session.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+    await session.execute(text(f"CREATE TABLE {TABLE} (id INTEGER PRIMARY KEY, name VARCHAR(50))"))
+    await session.commit()
+
+
+async def names(session):
+    return (await session.execute(text(f"SELECT name FROM {TABLE} ORDER BY id"))).scalars().all()
+
+
+def test_get_db_round_trip():
+    async def insert(session):
+        await session.execute(text(f"INSERT INTO {TABLE} (name) VALUES ('saved')"))
+        await session.commit()
+
+    async def run():
+        await with_session(setup_table)
+        await with_session(insert)
+        # Read back through a different session, so it came from the database
+        return await with_session(names)
+
+    assert asyncio.run(run()) == ["saved"]
+
+
+def test_get_db_rolls_back_when_the_request_fails():
+    async def failing_insert(session):
+        await session.execute(text(f"INSERT INTO {TABLE} (name) VALUES ('lost')"))
+        raise RuntimeError("handler failed")
+
+    async def run():
+        await with_session(setup_table)
+        with pytest.raises(RuntimeError):
+            await with_session(failing_insert)
+        return await with_session(names)
+
+    assert asyncio.run(run()) == []
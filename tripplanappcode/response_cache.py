@@ -0,0 +1,183 @@
+import asyncio
+import json
+import math
+import os
+import time
+from collections import OrderedDict, defaultdict
+from fastapi.encoders import jsonable_encoder
+
+# Cache for the read endpoints the dashboards poll. Every entry belongs to one
+# or more scopes ("user:42", "trip:7", "trips") and its key embeds each
+# scope's current version, so a write invalidates everything cached for a
+# user or trip by bumping that scope's version: one INCR, however many
+# entries depend on it, and stale entries simply age out. Entries also have a
+# TTL, which bounds staleness for data that background jobs write.
+#
+# The backend is picked from RESPONSE_CACHE_URL: redis://... uses Redis so
+# every worker process shares the cache and its invalidations; otherwise an
+# in-process LRU stands in for it.
+
+
+class MemoryBackend:
+    def __init__(self, max_entries: int = 100_000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # key -> (expires_at, value), least recently used first
+        # Counters live apart from the LRU: evicting a scope version would
+        # bring entries cached under its old versions back to life
+        self._counters = {}
+
+    async def get_many(self, keys):
+        now = time.monotonic()
+        values = []
+        for key in keys:
+            if key in self._counters:
+                values.append(self._counters[key])
+                continue
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= now:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+            values.append(entry[1] if entry is not None else None)
+        return values
+
+    async def set(self, key: str, value, ttl: float = None):
+        self._entries[key] = (time.monotonic() + ttl if ttl else None, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def add(self, key: str, value, ttl: float = None) -> bool:
+        # Sets the key only if it's absent, like Redis SET NX
+        if (await self.get_many([key]))[0] is not None:
+            return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def delete(self, key: str):
+        self._entries.pop(key, None)
+
+    async def incr(self, key: str) -> int:
+        self._counters[key] = self._counters.get(key, 0) + 1
+        return self._counters[key]
+
+    async def close(self):
+        self._entries.clear()
+        self._counters.clear()
+
+
+class RedisBackend:
+    # Needs the redis package, which is only imported when a redis:// URL is configured
+    def __init__(self, url: str):
+        import redis.asyncio as redis
+
+        self._client = redis.from_url(url)
+
+    async def get_many(self, keys):
+        return [
+            json.loads(value) if value is not None else None
+            for value in await self._client.mget(keys)
+        ]
+
+    async def set(self, key: str, value, ttl: float = None):
+        await self._client.set(key, json.dumps(value), ex=int(ttl) if ttl else None)
+
+    async def add(self, key: str, value, ttl: float = None) -> bool:
+        return bool(await self._client.set(key, json.dumps(value), ex=math.ceil(ttl) if ttl else None, nx=True))
+
+    async def delete(self, key: str):
+        await self._client.delete(key)
+
+    async def incr(self, key: str) -> int:
+        return await self._client.incr(key)
+
+    async def close(self):
+        await self._client.aclose()
+
+
+class ResponseCache:
+    def __init__(self, backend, ttl: float = 60, prefix: str = "rc"):
+        self.backend = backend
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self._computing = {}   # key -> Future, so concurrent misses share one computation
+
+    @classmethod
+    def from_env(cls):
+        url = os.getenv("RESPONSE_CACHE_URL")
+        backend = RedisBackend(url) if url and url.startswith("redis") else MemoryBackend(
+            int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "100000"))
+        )
+        return cls(backend, ttl=float(os.getenv("RESPONSE_CACHE_TTL", "60")))
+
+    def _version_key(self, scope: str) -> str:
+        return f"{self.prefix}:version:{scope}"
+
+    async def get_or_compute(self, name: str, scopes, compute, *parts, ttl: float = None):
+        # Cached response of `name` for these scopes and parts, or the result of
+        # awaiting compute(), stored for next time
+        scopes = list(scopes)
+        versions = await self.backend.get_many([self._version_key(scope) for scope in scopes])
+        key = ":".join([
+            self.prefix, name,
+            *(f"{scope}@{version or 0}" for scope, version in zip(scopes, versions)),
+            *(str(part) for part in parts),
+        ])
+
+        value, = await self.backend.get_many([key])
+        if value is not None:
+            self.hits[name] += 1
+            return value
+        self.misses[name] += 1
+
+        pending = self._computing.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        pending = self._computing[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = jsonable_encoder(await compute())
+            await self.backend.set(key, value, ttl or self.ttl)
+            pending.set_result(value)
+            return value
+        except BaseException as e:
+            pending.set_exception(e)
+            # Nobody else may be waiting; don't leave the exception unretrieved
+            pending.exception()
+            raise
+        finally:
+            del self._computing[key]
+
+    async def invalidate(self, *scopes: str):
+        for scope in set(scopes):
+            await self.backend.incr(self._version_key(scope))
+
+    def stats(self) -> dict:
+        names = sorted(self.hits.keys() | self.misses.keys())
+        return {
+            name: {
+                "hits": self.hits[name],
+                "misses": self.misses[name],
+                "hit_rate": round(self.hits[name] / (self.hits[name] + self.misses[name]), 3),
+            }
+            for name in names
+        }
+
+    async def close(self):
+        await self.backend.close()
+
+
+def user_scope(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+def trip_scope(trip_id: int) -> str:
+    return f"trip:{trip_id}"
+
+
+# Scope for anything that depends on the set of all trips
+TRIPS_SCOPE = "trips"
+
+response_cache = ResponseCache.from_env()
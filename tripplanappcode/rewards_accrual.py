@@ -0,0 +1,165 @@
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+import numpy as np
+from sqlalchemy import DateTime, Float, Integer, String, bindparam, case, column, insert, select, table, update
+
+from database import SessionLocal, sync_engine
+from wallet_ledger import (
+    SETTLED_STATUS, advance_watermark, hold_pending, migrate_watermarks, read_watermark, release_pending,
+    settled_prefix, wallet_transactions,
+)
+
+# Incremental rewards accrual. Each run picks up the WalletTransaction rows
+# written since its high-water mark in ledger_watermarks, in id order, totals the points per
+# wallet with numpy and applies them to wallet_rewards with bulk statements.
+# A batch and the mark that covers it commit together, so a crashed run just
+# redoes its last batch and history is never rescanned.
+#   python rewards_accrual.py --interval 300 --rate payment=1.5
+#
+# Points are earned on settled money leaving a wallet (card payments by
+# default). The mark stops short of rows that may still be joined by an
+# earlier uncommitted one (see wallet_ledger.settled_prefix); pending rows
+# that could earn are listed as the mark passes them and earn in the run
+# after they settle. Nothing in this tree writes "payment" rows yet; they
+# are expected from card processing.
+
+wallet_rewards = table(
+    "wallet_rewards",
+    column("id", Integer),
+    column("wallet_id", Integer),
+    column("points", Float),
+    column("level", String),
+    column("last_updated", DateTime),
+)
+
+# Points per dollar spent, by transaction type; unlisted types earn nothing.
+# REWARDS_EARN_RATES='{"payment": 1.5}' overrides them.
+DEFAULT_EARN_RATES = {"payment": 1.0}
+EARN_RATES = {**DEFAULT_EARN_RATES, **json.loads(os.getenv("REWARDS_EARN_RATES", "{}"))}
+
+# Lowest point total for each level, highest first
+TIERS = [("gold", 5000.0), ("silver", 1000.0), ("bronze", 0.0)]
+
+WATERMARK_NAME = "rewards_accrual"
+ACCRUAL_BATCH_SIZE = 100_000
+
+
+def tier_for(points: float) -> str:
+    for level, threshold in TIERS:
+        if points >= threshold:
+            return level
+    return TIERS[-1][0]
+
+
+def tier_expression(points):
+    return case(*((points >= threshold, level) for level, threshold in TIERS[:-1]), else_=TIERS[-1][0])
+
+
+def points_by_wallet(wallet_ids, amounts, transaction_types, statuses, earn_rates: dict):
+    # Points earned per wallet for one batch of ledger rows, as (wallet_ids, points)
+    wallet_ids = np.asarray(wallet_ids, dtype=np.int64)
+    if not len(wallet_ids):
+        return wallet_ids, np.zeros(0)
+    types, type_index = np.unique(np.asarray(transaction_types, dtype=object).astype(str), return_inverse=True)
+    rates = np.array([earn_rates.get(name, 0.0) for name in types])[type_index]
+    spent = np.maximum(-np.asarray(amounts, dtype=np.float64), 0.0)
+    earned = np.where(np.asarray(statuses, dtype=object) == SETTLED_STATUS, spent * rates, 0.0)
+
+    wallets, wallet_index = np.unique(wallet_ids, return_inverse=True)
+    totals = np.bincount(wallet_index, weights=earned, minlength=len(wallets))
+    keep = totals > 0
+    return wallets[keep], np.round(totals[keep], 2)
+
+
+def apply_points(db, wallets, points, now: datetime):
+    existing = set()
+    for start in range(0, len(wallets), 10_000):
+        existing.update(db.scalars(select(wallet_rewards.c.wallet_id).where(
+            wallet_rewards.c.wallet_id.in_(wallets[start:start + 10_000].tolist())
+        )))
+
+    updates, inserts = [], []
+    for wallet_id, earned in zip(wallets.tolist(), points.tolist()):
+        if wallet_id in existing:
+            updates.append({"target_wallet_id": wallet_id, "earned": earned})
+        else:
+            inserts.append({"wallet_id": wallet_id, "points": earned, "level": tier_for(earned), "last_updated": now})
+
+    if updates:
+        new_points = wallet_rewards.c.points + bindparam("earned", type_=Float)
+        db.execute(
+            update(wallet_rewards)
+            .where(wallet_rewards.c.wallet_id == bindparam("target_wallet_id"))
+            .values(points=new_points, level=tier_expression(new_points), last_updated=now),
+            updates
+        )
+    if inserts:
+        db.execute(insert(wallet_rewards), inserts)
+
+
+def accrue_batch(db, batch_size: int = ACCRUAL_BATCH_SIZE, earn_rates: dict = None, now: datetime = None) -> int:
+    # Accrues the next batch past the high-water mark inside the caller's
+    # transaction and returns how many ledger rows it covered
+    earn_rates = EARN_RATES if earn_rates is None else earn_rates
+    mark = read_watermark(db, WATERMARK_NAME)
+    query = select(
+        wallet_transactions.c.id,
+        wallet_transactions.c.wallet_id,
+        wallet_transactions.c.amount,
+        wallet_transactions.c.transaction_type,
+        wallet_transactions.c.status,
+        wallet_transactions.c.created_at
+    )
+    rows = db.execute(
+        query.where(wallet_transactions.c.id > mark).order_by(wallet_transactions.c.id).limit(batch_size)
+    ).all()
+    now = now or datetime.utcnow()
+    rows = settled_prefix(rows, now)
+    counted = release_pending(db, WATERMARK_NAME, query) + rows
+    hold_pending(db, WATERMARK_NAME, rows, {name for name, rate in earn_rates.items() if rate})
+    if counted:
+        _, wallet_ids, amounts, transaction_types, statuses, _ = zip(*counted)
+        wallets, points = points_by_wallet(wallet_ids, amounts, transaction_types, statuses, earn_rates)
+        apply_points(db, wallets, points, now)
+    if rows:
+        advance_watermark(db, WATERMARK_NAME, rows[-1].id)
+    return len(rows)
+
+
+def run_accrual(batch_size: int = ACCRUAL_BATCH_SIZE, earn_rates: dict = None) -> int:
+    processed = 0
+    while True:
+        with SessionLocal() as db:
+            count = accrue_batch(db, batch_size, earn_rates)
+            db.commit()
+        processed += count
+        if count < batch_size:
+            return processed
+
+
+def parse_rate(value: str):
+    transaction_type, _, rate = value.partition("=")
+    return transaction_type, float(rate)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Accrue wallet rewards from new transactions")
+    parser.add_argument("--batch-size", type=int, default=ACCRUAL_BATCH_SIZE)
+    parser.add_argument("--rate", type=parse_rate, action="append", default=[],
+                        help="TYPE=POINTS_PER_DOLLAR, overriding the configured rate")
+    parser.add_argument("--interval", type=float, help="seconds between runs; runs once if omitted")
+    args = parser.parse_args()
+    earn_rates = {**EARN_RATES, **dict(args.rate)}
+    migrate_watermarks(sync_engine)
+
+    while True:
+        started = time.perf_counter()
+        processed = run_accrual(args.batch_size, earn_rates)
+        print(f"{datetime.utcnow().isoformat()} accrued {processed} transactions "
+              f"in {time.perf_counter() - started:.1f}s")
+        if args.interval is None:
+            break
+        time.sleep(args.interval)
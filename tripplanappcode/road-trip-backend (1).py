@@ -1,13 +1,29 @@
-from fastapi import FastAPI, Depends, HTTPException, Security
+from fastapi import FastAPI, Depends, HTTPException, Security, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, Table
+from sqlalchemy import create_engine, Column, Integer, String, Float, Date, ForeignKey, Table, Index, event, inspect, tuple_, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from passlib.context import CryptContext
-from datetime import datetime, timedelta
+from sqlalchemy.orm import Session, sessionmaker, relationship, joinedload, object_session
+from datetime import date, datetime, timedelta
+from typing import Optional
+import asyncio
+import math
+import os
 import jwt
 import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
+from trip_matching import (
+    CompatibilityEngine, InterestIndex, parse_interests, INTEREST_WEIGHT, RATING_WEIGHT, MAX_RATING,
+    COMPATIBILITY_THRESHOLD,
+)
+from pagination import encode_cursor, decode_cursor, clamp_page_size
+from database import AsyncSessionLocal, get_db, migrate_date_column, sync_engine
+from password_hashing import PasswordHasher
+from principal_cache import PrincipalCache, TokenRevocations
+from response_cache import TRIPS_SCOPE, response_cache, user_scope
+from routing import RoadNetwork, parse_point
+from poi_index import CATEGORIES, PoiIndex
+import itinerary
 
 app = FastAPI()
 Base = declarative_base()
@@ -31,7 +47,7 @@ class Trip(Base):
     creator_id = Column(Integer, ForeignKey("users.id"))
     start_point = Column(String)
     destination = Column(String)
-    start_date = Column(String)
+    start_date = Column(Date, nullable=False)
     duration = Column(Integer)  # in days
     max_participants = Column(Integer)
     estimated_cost = Column(Float)
@@ -39,6 +55,11 @@ class Trip(Base):
     creator = relationship("User", back_populates="trips")
     participants = relationship("TripParticipant", back_populates="trip")
 
+    __table_args__ = (
+        Index("ix_trips_start_date_destination", "start_date", "destination"),
+        Index("ix_trips_start_date_creator_id", "start_date", "creator_id"),
+    )
+
 class TripParticipant(Base):
     __tablename__ = "trip_participants"
     id = Column(Integer, primary_key=True)
@@ -47,16 +68,43 @@ class TripParticipant(Base):
     status = Column(String)  # pending, accepted, rejected
     trip = relationship("Trip", back_populates="participants")
 
+# Trip.start_date was a String holding whatever the client sent; the date
+# input sends ISO dates, other clients sometimes US-style ones
+TRIP_DATE_FORMATS = ("%m/%d/%Y",)
+
+def parse_trip_date(value) -> Optional[date]:
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    value = value.strip()
+    try:
+        return datetime.fromisoformat(value).date()
+    except ValueError:
+        pass
+    for date_format in TRIP_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            pass
+    return None
+
+@app.on_event("startup")
+async def migrate_trip_dates():
+    # Before anything reads trips; a no-op once the column holds dates
+    await asyncio.to_thread(migrate_date_column, sync_engine, Trip.__tablename__, "start_date", parse_trip_date)
+
 # Security
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt runs on a bounded thread pool; PASSWORD_HASH_ROUNDS sets the cost
+password_hasher = PasswordHasher.from_env()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 SECRET_KEY = "your-secret-key"  # In production, use environment variable
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password, hashed_password):
+    return await password_hasher.verify(plain_password, hashed_password)
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    return await password_hasher.hash(password)
 
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -64,34 +112,106 @@ def create_access_token(data: dict):
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm="HS256")
 
+credentials_exception = HTTPException(
+    status_code=status.HTTP_401_UNAUTHORIZED,
+    detail="Could not validate credentials",
+    headers={"WWW-Authenticate": "Bearer"}
+)
+
+# Users resolved from bearer tokens; a hit skips both the JWT decode and the query
+principal_cache = PrincipalCache.from_env()
+# Logouts shared with the other workers through the response cache's backend
+token_revocations = TokenRevocations(response_cache.backend)
+# Changes to these drop the user's cached principals
+PRINCIPAL_FIELDS = ("verification_status", "rating", "interests")
+
+def principal_columns(user: User) -> dict:
+    return {
+        column.key: getattr(user, column.key)
+        for column in User.__table__.columns
+        if column.key != "hashed_password"
+    }
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+    # Another worker may have revoked the token after this one cached it
+    if principal_cache.is_revoked(token) or await token_revocations.is_revoked(token):
+        raise credentials_exception
+    columns = principal_cache.get(token)
+    if columns is not None:
+        # A detached copy, so nothing a route does to it reaches the cache
+        return User(**columns)
+
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
+        user_id = int(payload["sub"])
+    except (jwt.PyJWTError, KeyError, TypeError, ValueError):
+        raise credentials_exception
+    user = await db.get(User, user_id)
+    if user is None:
+        raise credentials_exception
+    principal_cache.put(token, user.id, principal_columns(user), payload["exp"])
+    return user
+
+@app.on_event("shutdown")
+async def close_password_hasher():
+    password_hasher.close()
+
 # User Authentication and Verification
 @app.post("/register")
-async def register_user(user_data: dict):
+async def register_user(user_data: dict, db: AsyncSession = Depends(get_db)):
     # Create new user with pending verification
     user = User(
         username=user_data["username"],
         email=user_data["email"],
-        hashed_password=get_password_hash(user_data["password"]),
+        hashed_password=await get_password_hash(user_data["password"]),
         verification_status="pending"
     )
     # Add to database
     db.add(user)
-    db.commit()
+    await db.commit()
     return {"message": "Registration successful, verification pending"}
 
+@app.post("/token")
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+    user = await db.scalar(select(User).where(User.username == form_data.username))
+    matches, new_hash = await password_hasher.verify_and_update(
+        form_data.password, user.hashed_password if user is not None else None
+    )
+    if not matches:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Incorrect username or password",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+
+    # Hashes made at an older cost are replaced while we have the password
+    if new_hash is not None:
+        user.hashed_password = new_hash
+        await db.commit()
+
+    return {"access_token": create_access_token({"sub": str(user.id)}), "token_type": "bearer"}
+
+@app.post("/logout")
+async def logout(token: str = Depends(oauth2_scheme), current_user: User = Depends(get_current_user)):
+    # The token stays rejected until it expires
+    payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
+    principal_cache.revoke(token, payload["exp"])
+    await token_revocations.revoke(token, payload["exp"])
+    return {"message": "Logged out"}
+
 @app.post("/verify-user/{user_id}")
-async def verify_user(user_id: int, verification_data: dict):
+async def verify_user(user_id: int, verification_data: dict, db: AsyncSession = Depends(get_db)):
     # Implement verification logic (background checks, ID verification, etc.)
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.get(User, user_id)
     if verification_data["status"] == "approved":
         user.verification_status = "verified"
-        db.commit()
+        await db.commit()
         return {"message": "User verified successfully"}
     return {"message": "Verification failed"}
 
 # Trip Management
 @app.post("/create-trip")
-async def create_trip(trip_data: dict, current_user: User = Depends(get_current_user)):
+async def create_trip(trip_data: dict, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
     if current_user.verification_status != "verified":
         raise HTTPException(status_code=403, detail="Only verified users can create trips")
     
@@ -99,75 +219,415 @@ async def create_trip(trip_data: dict, current_user: User = Depends(get_current_
         creator_id=current_user.id,
         start_point=trip_data["start_point"],
         destination=trip_data["destination"],
-        start_date=trip_data["start_date"],
+        start_date=datetime.strptime(trip_data["start_date"], "%Y-%m-%d").date(),
         duration=trip_data["duration"],
         max_participants=trip_data["max_participants"],
         estimated_cost=trip_data["estimated_cost"],
         requirements=trip_data["requirements"]
     )
     db.add(new_trip)
-    db.commit()
+    await db.commit()
+    await response_cache.invalidate(TRIPS_SCOPE)
     return {"message": "Trip created successfully", "trip_id": new_trip.id}
 
+@app.get("/search-trips")
+async def search_trips(
+    destination: Optional[str] = None,
+    start_after: Optional[date] = None,
+    start_before: Optional[date] = None,
+    min_duration: Optional[int] = None,
+    max_duration: Optional[int] = None,
+    max_cost: Optional[float] = None,
+    cursor: Optional[str] = None,
+    limit: int = 20,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    limit = clamp_page_size(limit)
+    query = select(Trip).where(Trip.start_date >= (start_after or date.today()))
+    if start_before is not None:
+        query = query.where(Trip.start_date <= start_before)
+    if destination is not None:
+        query = query.where(Trip.destination == destination)
+    if min_duration is not None:
+        query = query.where(Trip.duration >= min_duration)
+    if max_duration is not None:
+        query = query.where(Trip.duration <= max_duration)
+    if max_cost is not None:
+        query = query.where(Trip.estimated_cost <= max_cost)
+
+    # Keyset pagination on (start_date, id): every page is an index seek
+    if cursor is not None:
+        try:
+            last_start_date, last_id = decode_cursor(cursor)
+            last_start_date = date.fromisoformat(last_start_date)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.where(tuple_(Trip.start_date, Trip.id) > tuple_(last_start_date, last_id))
+
+    trips = (await db.scalars(query.order_by(Trip.start_date, Trip.id).limit(limit + 1))).all()
+    next_cursor = None
+    if len(trips) > limit:
+        trips = trips[:limit]
+        next_cursor = encode_cursor(trips[-1].start_date, trips[-1].id)
+
+    return {"trips": trips, "next_cursor": next_cursor}
+
 # AI Matching System
+matching_engine = CompatibilityEngine()
+interest_index = InterestIndex()
+
+@app.on_event("startup")
+async def load_interest_index():
+    async with AsyncSessionLocal() as db:
+        for user_id, interests, rating in await db.execute(select(User.id, User.interests, User.rating)):
+            interest_index.index_user(user_id, interests, rating)
+            matching_engine.upsert_user(user_id, interests, rating)
+        for trip_id, creator_id in await db.execute(
+            select(Trip.id, Trip.creator_id).where(Trip.start_date > date.today())
+        ):
+            interest_index.index_trip(trip_id, creator_id)
+
+# Keep the index current as users and trips change. Changes are queued on the
+# session at flush time and applied once it commits, so a write that is
+# rolled back never leaves an entry behind.
+def defer_index_change(instance, change, *args):
+    object_session(instance).info.setdefault("index_changes", []).append((change, args))
+
+@event.listens_for(Session, "after_commit")
+def apply_index_changes(session):
+    for change, args in session.info.pop("index_changes", ()):
+        change(*args)
+
+@event.listens_for(Session, "after_rollback")
+def discard_index_changes(session):
+    session.info.pop("index_changes", None)
+
+# Cached match lists depend on every trip creator's interests and rating
+MATCHING_FIELDS = ("interests", "rating")
+match_invalidations = set()   # running tasks, kept so they aren't collected early
+
+def invalidate_matches():
+    # Runs after commit, which may be on the event loop (AsyncSession) or not
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        asyncio.run(response_cache.invalidate(TRIPS_SCOPE))
+        return
+    task = loop.create_task(response_cache.invalidate(TRIPS_SCOPE))
+    match_invalidations.add(task)
+    task.add_done_callback(match_invalidations.discard)
+
+@event.listens_for(User, "after_insert")
+@event.listens_for(User, "after_update")
+def index_user_interests(mapper, connection, user):
+    defer_index_change(user, interest_index.index_user, user.id, user.interests, user.rating)
+    defer_index_change(user, matching_engine.upsert_user, user.id, user.interests, user.rating)
+
+@event.listens_for(User, "after_delete")
+def unindex_user(mapper, connection, user):
+    defer_index_change(user, interest_index.remove_user, user.id)
+    defer_index_change(user, invalidate_matches)
+    principal_cache.invalidate_user(user.id)
+
+@event.listens_for(User, "after_update")
+def queue_match_invalidation(mapper, connection, user):
+    state = inspect(user)
+    if any(state.attrs[field].history.has_changes() for field in MATCHING_FIELDS):
+        defer_index_change(user, invalidate_matches)
+
+@event.listens_for(User, "after_update")
+def invalidate_principal(mapper, connection, user):
+    state = inspect(user)
+    if any(state.attrs[field].history.has_changes() for field in PRINCIPAL_FIELDS):
+        principal_cache.invalidate_user(user.id)
+
+@event.listens_for(Trip, "after_insert")
+@event.listens_for(Trip, "after_update")
+def index_trip(mapper, connection, trip):
+    defer_index_change(trip, interest_index.index_trip, trip.id, trip.creator_id)
+
+@event.listens_for(Trip, "after_delete")
+def unindex_trip(mapper, connection, trip):
+    defer_index_change(trip, interest_index.remove_trip, trip.id)
+
 def calculate_user_compatibility(user1: User, user2: User):
     # Convert interests to vectors
-    interests1 = set(user1.interests.split(','))
-    interests2 = set(user2.interests.split(','))
+    interests1 = set(parse_interests(user1.interests))
+    interests2 = set(parse_interests(user2.interests))
     
     # Calculate similarity scores
     common_interests = len(interests1.intersection(interests2))
     rating_diff = abs(user1.rating - user2.rating)
     
     # Weighted scoring
-    compatibility_score = (common_interests * 0.7) + ((5 - rating_diff) * 0.3)
+    compatibility_score = (common_interests * INTEREST_WEIGHT) + ((MAX_RATING - rating_diff) * RATING_WEIGHT)
     return compatibility_score
 
 @app.get("/find-compatible-trips")
-async def find_compatible_trips(current_user: User = Depends(get_current_user)):
-    all_trips = db.query(Trip).filter(
+async def find_compatible_trips(limit: int = 50, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+    # Matches depend on every upcoming trip and its creator, so they share the
+    # trips scope; the user's own interests and rating are part of the key
+    async def compute():
+        return await match_trips(limit, db, current_user)
+
+    return await response_cache.get_or_compute(
+        "compatible-trips", [user_scope(current_user.id), TRIPS_SCOPE], compute,
+        limit, current_user.interests, current_user.rating, date.today()
+    )
+
+async def match_trips(limit: int, db: AsyncSession, current_user: User):
+    # Only trips whose creators share an interest or are close enough in rating can qualify
+    candidate_trip_ids = interest_index.candidate_trips(
+        current_user.interests,
+        current_user.rating,
+        exclude_user_id=current_user.id,
+        threshold=COMPATIBILITY_THRESHOLD
+    )
+    if not candidate_trip_ids:
+        return []
+
+    all_trips = (await db.scalars(select(Trip).options(joinedload(Trip.creator)).where(
+        Trip.id.in_(candidate_trip_ids),
         Trip.creator_id != current_user.id,
-        Trip.start_date > datetime.now()
-    ).all()
+        Trip.start_date > date.today()
+    ))).all()
     
-    compatible_trips = []
+    # Score every candidate creator in a single vectorized pass
     for trip in all_trips:
         creator = trip.creator
-        compatibility = calculate_user_compatibility(current_user, creator)
-        if compatibility > 0.6:  # Threshold for compatibility
-            compatible_trips.append({
-                "trip": trip,
-                "compatibility_score": compatibility,
-                "creator_info": {
-                    "username": creator.username,
-                    "rating": creator.rating
-                }
-            })
+        matching_engine.upsert_user(creator.id, creator.interests, creator.rating)
+    best = matching_engine.top_k(
+        current_user.interests,
+        current_user.rating,
+        [trip.creator_id for trip in all_trips],
+        k=limit,
+        threshold=COMPATIBILITY_THRESHOLD
+    )
+    
+    compatible_trips = []
+    for compatibility, position in best:
+        trip = all_trips[position]
+        creator = trip.creator
+        compatible_trips.append({
+            "trip": trip,
+            "compatibility_score": compatibility,
+            "creator_info": {
+                "username": creator.username,
+                "rating": creator.rating
+            }
+        })
     
-    return sorted(compatible_trips, key=lambda x: x["compatibility_score"], reverse=True)
+    return compatible_trips
+
+# Hit and miss counts per cached endpoint, and for the principal cache
+@app.get("/api/cache/stats")
+async def get_cache_stats(current_user: User = Depends(get_current_user)):
+    return {"responses": response_cache.stats(), "principals": principal_cache.stats()}
+
+@app.on_event("shutdown")
+async def close_response_cache():
+    await response_cache.close()
 
 # Route Planning and Recommendations
+# Routes come from the road network preprocessed by routing.py, memory-mapped at startup
+ROAD_NETWORK_PATH = os.getenv("ROAD_NETWORK_PATH", "road_network")
+ROUTE_NAMES = {"time": "Fastest Route", "distance": "Shortest Route"}
+road_network = None
+# Lodging and attractions come from the index built by poi_index.py
+POI_INDEX_PATH = os.getenv("POI_INDEX_PATH", "poi_index")
+poi_index = None
+CORRIDOR_KM = 10.0
+DAILY_DRIVE_HOURS = 8.0
+LODGING_PER_NIGHT = 3
+ATTRACTIONS_PER_ROUTE = 10
+
+@app.on_event("startup")
+async def open_road_network():
+    global road_network, poi_index
+    if os.path.exists(os.path.join(ROAD_NETWORK_PATH, "meta.json")):
+        road_network = RoadNetwork(ROAD_NETWORK_PATH)
+    if os.path.exists(os.path.join(POI_INDEX_PATH, "meta.json")):
+        poi_index = PoiIndex(POI_INDEX_PATH)
+
+def format_duration(seconds: float) -> str:
+    hours, minutes = divmod(round(seconds / 60), 60)
+    return f"{hours} hours {minutes} min" if hours else f"{minutes} min"
+
+def poi_filters(preferences: dict) -> dict:
+    # Corridor and filter settings from route preferences; raises ValueError
+    filters = {
+        "radius_km": float(preferences.get("corridor_km", CORRIDOR_KM)),
+        "daily_drive_hours": float(preferences.get("daily_drive_hours", DAILY_DRIVE_HOURS)),
+        "min_rating": preferences.get("min_rating"),
+        "max_price": preferences.get("max_lodging_price"),
+    }
+    for name in ("min_rating", "max_price"):
+        if filters[name] is not None:
+            filters[name] = float(filters[name])
+    if not 0 < filters["radius_km"] <= 100 or filters["daily_drive_hours"] < 1:
+        raise ValueError("corridor_km must be between 0 and 100 and daily_drive_hours at least 1")
+    return filters
+
+def places_along(found, filters):
+    # (attractions, lodging) for a route: attractions anywhere along it, and
+    # lodging around the end of each day's drive and at the destination
+    if poi_index is None:
+        return [], []
+    geometry, elapsed = found["geometry"], found["elapsed_s"]
+    attractions = poi_index.along_route(
+        geometry, elapsed, "attraction", ATTRACTIONS_PER_ROUTE, filters["radius_km"],
+        min_rating=filters["min_rating"]
+    )
+    hours = found["duration_s"] / 3600
+    stops = [filters["daily_drive_hours"] * night for night in range(1, int(hours / filters["daily_drive_hours"]) + 1)]
+    if not stops or hours - stops[-1] > 1:
+        stops.append(hours)
+    lodging = []
+    for night, hour in enumerate(stops, start=1):
+        for place in poi_index.along_route(
+            geometry, elapsed, "lodging", LODGING_PER_NIGHT, filters["radius_km"], hour=hour,
+            min_rating=filters["min_rating"], max_price=filters["max_price"]
+        ):
+            lodging.append({"night": night, **place})
+    return attractions, lodging
+
+def plan_routes(start, end, metrics, filters):
+    routes, seen = [], set()
+    for metric in metrics:
+        found = road_network.route(start, end, metric)
+        # Skip a route that's the same roads as one already found
+        if found is None or tuple(found["nodes"]) in seen:
+            continue
+        seen.add(tuple(found["nodes"]))
+        attractions, lodging = places_along(found, filters)
+        routes.append({
+            "id": metric,
+            "name": ROUTE_NAMES[metric],
+            "duration": format_duration(found["duration_s"]),
+            "duration_minutes": round(found["duration_s"] / 60, 1),
+            "distance_km": round(found["distance_m"] / 1000, 1),
+            "geometry": found["geometry"],
+            "attractions": attractions,
+            "lodging": lodging
+        })
+    return routes
+
 @app.post("/generate-routes")
 async def generate_routes(route_request: dict):
-    start_point = route_request["start_point"]
-    destination = route_request["destination"]
-    preferences = route_request.get("preferences", {})
-    
-    # Here you would integrate with mapping APIs (Google Maps, MapBox, etc.)
-    # For now, returning mock data
-    routes = [
-        {
-            "name": "Scenic Route",
-            "duration": "8 hours",
-            "attractions": ["Grand Canyon", "Sedona Red Rocks"],
-            "lodging": [
-                {
-                    "name": "Mountain Lodge",
-                    "price": 150,
-                    "rating": 4.5,
-                    "affiliate_link": "http://booking.com/mountain-lodge"
-                }
-            ]
-        }
-    ]
+    if road_network is None:
+        raise HTTPException(status_code=503, detail="Routing is not available")
+    try:
+        start = road_network.locate(route_request["start_point"])
+        end = road_network.locate(route_request["destination"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid start_point or destination: {e}")
+    preferences = route_request.get("preferences") or {}
+    try:
+        if not isinstance(preferences, dict):
+            raise TypeError("preferences must be an object")
+        metrics = [metric for metric in road_network.hierarchies if preferences.get("optimize", metric) == metric]
+        if not metrics:
+            raise ValueError(f"optimize must be one of {', '.join(road_network.hierarchies)}")
+        filters = poi_filters(preferences)
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid preferences: {e}")
+
+    # A query is a few milliseconds of CPU; run it beside the event loop
+    routes = await asyncio.to_thread(plan_routes, start, end, metrics, filters)
+    if not routes:
+        raise HTTPException(status_code=404, detail="No route found between these points")
     return routes
+
+@app.post("/pois/along-route")
+async def find_pois_along_route(poi_request: dict):
+    # geometry and elapsed_s as returned by /generate-routes; the k best-rated
+    # places of a category within radius_km, near `hour` into the drive if given
+    if poi_index is None:
+        raise HTTPException(status_code=503, detail="Places search is not available")
+    try:
+        geometry = np.asarray(poi_request["geometry"], dtype=float)
+        elapsed = np.asarray(poi_request["elapsed_s"], dtype=float)
+        if geometry.ndim != 2 or geometry.shape[1] != 2 or elapsed.shape != (len(geometry),) or not len(geometry):
+            raise ValueError("geometry must be [[lat, lon], ...] and elapsed_s the same length, both non-empty")
+        if not (np.isfinite(geometry).all() and np.isfinite(elapsed).all()):
+            raise ValueError("geometry and elapsed_s must be finite numbers")
+        category = poi_request.get("category", "lodging")
+        if category not in CATEGORIES:
+            raise ValueError(f"category must be one of {', '.join(CATEGORIES)}")
+        k = min(int(poi_request.get("k", LODGING_PER_NIGHT)), 50)
+        filters = poi_filters({
+            "corridor_km": poi_request.get("radius_km", CORRIDOR_KM),
+            "min_rating": poi_request.get("min_rating"),
+            "max_lodging_price": poi_request.get("max_price"),
+        })
+        hour = poi_request.get("hour")
+        hour = float(hour) if hour is not None else None
+        if hour is not None and not math.isfinite(hour):
+            raise ValueError("hour must be a finite number")
+        window_hours = float(poi_request.get("window_hours", 1.0))
+        if not window_hours > 0 or not math.isfinite(window_hours):
+            raise ValueError("window_hours must be a positive number")
+    except (KeyError, TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid places request: {e}")
+
+    return await asyncio.to_thread(
+        poi_index.along_route, geometry, elapsed, category, k, filters["radius_km"], hour, window_hours,
+        filters["min_rating"], filters["max_price"]
+    )
+
+@app.post("/optimize-itinerary")
+async def optimize_trip_itinerary(
+    itinerary_request: dict,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    # stops: place names, "lat,lon" strings or {"name", "lat", "lon", "visit_minutes"};
+    # duration: days, or taken from trip_id
+    stops = itinerary_request.get("stops") or []
+    if not isinstance(stops, list) or not 2 <= len(stops) <= itinerary.MAX_STOPS:
+        raise HTTPException(status_code=400, detail=f"Give between 2 and {itinerary.MAX_STOPS} stops")
+    duration = itinerary_request.get("duration")
+    if duration is None and itinerary_request.get("trip_id") is not None:
+        trip = await db.get(Trip, itinerary_request["trip_id"])
+        if trip is None:
+            raise HTTPException(status_code=404, detail="Trip not found")
+        duration = trip.duration
+    if duration is None:
+        raise HTTPException(status_code=400, detail="Give the trip's duration or trip_id")
+
+    locate = road_network.locate if road_network is not None else parse_point
+    try:
+        duration = int(duration)
+        if not 1 <= duration <= itinerary.MAX_DAYS:
+            raise ValueError(f"duration must be between 1 and {itinerary.MAX_DAYS} days")
+        stops = [stop if isinstance(stop, dict) else {"name": str(stop), "place": stop} for stop in stops]
+        points = [locate(stop if "lat" in stop else stop.get("place", stop.get("name"))) for stop in stops]
+        visit_minutes = [float(stop.get("visit_minutes", itinerary.DEFAULT_VISIT_MINUTES)) for stop in stops]
+        start = itinerary_request.get("start")
+        start = locate(start) if start is not None else None
+        coordinates = points + ([start] if start is not None else [])
+        if not (np.isfinite(coordinates).all() and np.isfinite(visit_minutes).all()):
+            raise ValueError("stop coordinates and visit_minutes must be finite numbers")
+        if min(visit_minutes) < 0:
+            raise ValueError("visit_minutes can't be negative")
+    except (KeyError, TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid itinerary request: {e}")
+
+    try:
+        plan = await itinerary.optimize(
+            points, visit_minutes, duration, start, bool(itinerary_request.get("round_trip")),
+            ROAD_NETWORK_PATH if road_network is not None else None
+        )
+    except ValueError as e:
+        # A stop too far from any road
+        raise HTTPException(status_code=400, detail=str(e))
+    for day in plan["days"]:
+        for stop in day["stops"]:
+            stop["name"] = stops[stop["stop"]].get("name")
+            stop["lat"], stop["lon"] = points[stop["stop"]]
+    return plan
+
+@app.on_event("shutdown")
+async def close_itinerary_pool():
+    itinerary.close_pool()
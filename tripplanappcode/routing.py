@@ -0,0 +1,522 @@
+import argparse
+import csv
+import heapq
+import json
+import math
+import os
+import time
+import numpy as np
+
+# Offline road routing. A one-time preprocessing step reads a road-network
+# extract (a nodes CSV and an edge list CSV, e.g. exported from OSM), keeps its
+# largest strongly connected part and builds a contraction hierarchy for
+# travel time and for distance. Everything is written as flat .npy arrays in
+# CSR form, which the API memory-maps at startup, so opening even a
+# state-sized network takes milliseconds. A query is a bidirectional Dijkstra
+# that only climbs the hierarchy and settles a few hundred nodes.
+#   python routing.py build --nodes nodes.csv --edges edges.csv --places places.csv -o road_network
+#   python routing.py route --graph road_network "36.10,-112.11" "34.87,-111.76"
+#
+# nodes.csv: id,lat,lon
+# edges.csv: source,target[,length_m][,speed_kmh][,oneway]; a missing length is
+#            the straight-line distance, a missing speed DEFAULT_SPEED_KMH, and
+#            edges are two-way unless oneway is 1/true/yes
+# places.csv (optional): name,lat,lon, so trips can name their endpoints
+
+METRICS = ("time", "distance")
+DEFAULT_SPEED_KMH = 50.0
+EARTH_RADIUS_M = 6_371_000.0
+# Nodes are bucketed in GRID_DEGREES cells for snapping coordinates to the road
+GRID_DEGREES = 0.01
+SNAP_MAX_RINGS = 10
+# Witness searches settle at most this many nodes; lower builds faster but adds
+# shortcuts. Ordering only estimates them, with a cheaper search.
+WITNESS_SETTLE_LIMIT = 100
+ORDERING_SETTLE_LIMIT = 5
+MAX_GEOMETRY_POINTS = 1000
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(value) for value in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def cell_keys(lat, lon):
+    lat_cell = np.floor(np.asarray(lat) / GRID_DEGREES).astype(np.int64) + 9_000
+    lon_cell = np.floor(np.asarray(lon) / GRID_DEGREES).astype(np.int64) + 18_000
+    return lat_cell * 36_001 + lon_cell
+
+
+def read_network(nodes_path: str, edges_path: str):
+    # (node_ids, lat, lon, sources, targets, length_m, travel_s), with edges as
+    # directed pairs of node positions
+    with open(nodes_path, newline="") as f:
+        rows = [(int(row["id"]), float(row["lat"]), float(row["lon"])) for row in csv.DictReader(f)]
+    node_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    lat = np.array([row[1] for row in rows])
+    lon = np.array([row[2] for row in rows])
+    position = {node_id: i for i, node_id in enumerate(node_ids.tolist())}
+
+    sources, targets, lengths, speeds, oneway = [], [], [], [], []
+    with open(edges_path, newline="") as f:
+        for row in csv.DictReader(f):
+            source, target = position.get(int(row["source"])), position.get(int(row["target"]))
+            if source is None or target is None or source == target:
+                continue
+            sources.append(source)
+            targets.append(target)
+            lengths.append(float(row["length_m"]) if row.get("length_m") else math.nan)
+            speeds.append(float(row["speed_kmh"]) if row.get("speed_kmh") else DEFAULT_SPEED_KMH)
+            oneway.append((row.get("oneway") or "").strip().lower() in ("1", "true", "yes"))
+    sources, targets = np.array(sources, dtype=np.int64), np.array(targets, dtype=np.int64)
+    lengths, speeds, oneway = np.array(lengths), np.array(speeds), np.array(oneway, dtype=bool)
+    missing = np.isnan(lengths)
+    lengths[missing] = haversine_m(lat[sources[missing]], lon[sources[missing]],
+                                   lat[targets[missing]], lon[targets[missing]])
+    speeds[speeds <= 0] = DEFAULT_SPEED_KMH
+
+    two_way = ~oneway
+    sources, targets = np.concatenate([sources, targets[two_way]]), np.concatenate([targets, sources[two_way]])
+    lengths, speeds = np.concatenate([lengths, lengths[two_way]]), np.concatenate([speeds, speeds[two_way]])
+    return node_ids, lat, lon, sources, targets, lengths, lengths / (speeds / 3.6)
+
+
+def parse_point(place):
+    # (lat, lon) from "lat,lon", [lat, lon] or {"lat": .., "lon": ..}
+    if isinstance(place, dict):
+        return float(place["lat"]), float(place["lon"])
+    if isinstance(place, (list, tuple)):
+        return float(place[0]), float(place[1])
+    try:
+        lat, lon = (float(value) for value in str(place).split(","))
+    except ValueError:
+        raise ValueError(f"Unknown place {place!r}; give it as 'lat,lon'")
+    return lat, lon
+
+
+def largest_component(n: int, sources, targets):
+    # Positions of the nodes in the largest strongly connected component, so
+    # every snapped point can reach every other
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    graph = coo_matrix((np.ones(len(sources)), (sources, targets)), shape=(n, n)).tocsr()
+    _, labels = connected_components(graph, directed=True, connection="strong")
+    return np.flatnonzero(labels == np.bincount(labels).argmax())
+
+
+def _witness_distances(out_edges, source: int, skip: int, targets, limit: float, settle_limit: int):
+    # Distances from source without passing through skip, until every target
+    # is settled or the search passes limit. Nodes that weren't settled have
+    # tentative distances, which are still real paths.
+    distances = {source: 0.0}
+    heap = [(0.0, source)]
+    remaining = len(targets)
+    settled = 0
+    # Hot loop of the build; lookups are bound locally
+    get, push, pop, inf = distances.get, heapq.heappush, heapq.heappop, math.inf
+    while heap:
+        distance, node = pop(heap)
+        if distance > distances[node]:
+            continue
+        if distance > limit or settled == settle_limit:
+            break
+        settled += 1
+        if node in targets:
+            remaining -= 1
+            if not remaining:
+                break
+        for neighbour, (cost, _) in out_edges[node].items():
+            candidate = distance + cost
+            if candidate < get(neighbour, inf) and neighbour != skip:
+                distances[neighbour] = candidate
+                push(heap, (candidate, neighbour))
+    return distances
+
+
+def _shortcuts(out_edges, in_edges, node: int, settle_limit: int = WITNESS_SETTLE_LIMIT):
+    # [(u, w, cost, secondary)] needed to keep u -> node -> w distances once node is gone
+    shortcuts = []
+    outgoing = out_edges[node]
+    if not outgoing:
+        return shortcuts
+    max_out = max(cost for cost, _ in outgoing.values())
+    for u, (in_cost, in_secondary) in in_edges[node].items():
+        distances = _witness_distances(out_edges, u, node, outgoing.keys() - {u}, in_cost + max_out, settle_limit)
+        for w, (out_cost, out_secondary) in outgoing.items():
+            if w != u and distances.get(w, math.inf) > in_cost + out_cost:
+                shortcuts.append((u, w, in_cost + out_cost, in_secondary + out_secondary))
+    return shortcuts
+
+
+def contract(n: int, sources, targets, costs, secondary):
+    # Contraction hierarchy over one metric. Returns the rank of every node and
+    # the upward and downward graphs as {node: [(neighbour, cost, secondary, via)]},
+    # where via is the contracted node a shortcut stands for (-1 for a road).
+    # `secondary` is the other metric, carried along so routes report both.
+    out_edges = [{} for _ in range(n)]
+    in_edges = [{} for _ in range(n)]
+    for u, w, cost, other in zip(sources.tolist(), targets.tolist(), costs.tolist(), secondary.tolist()):
+        if cost < out_edges[u].get(w, (math.inf,))[0]:
+            out_edges[u][w] = in_edges[w][u] = (cost, other)
+    via = {}
+    contracted_neighbours = [0] * n
+    # Depth of the hierarchy below each node; favouring shallow nodes keeps
+    # contraction spread evenly over the map
+    level = [0] * n
+
+    def priority(node):
+        shortcuts = _shortcuts(out_edges, in_edges, node, ORDERING_SETTLE_LIMIT)
+        edge_difference = len(shortcuts) - len(out_edges[node]) - len(in_edges[node])
+        return 2 * edge_difference + contracted_neighbours[node] + level[node]
+
+    heap = [(priority(node), node) for node in range(n)]
+    heapq.heapify(heap)
+    rank = np.empty(n, dtype=np.int32)
+    up = [None] * n
+    down = [None] * n
+    order = 0
+    while heap:
+        _, node = heapq.heappop(heap)
+        # Lazy update: contract the node only if it's still the cheapest
+        current = priority(node)
+        if heap and current > heap[0][0]:
+            heapq.heappush(heap, (current, node))
+            continue
+        shortcuts = _shortcuts(out_edges, in_edges, node)
+
+        rank[node] = order
+        order += 1
+        up[node] = [(w, cost, other, via.get((node, w), -1)) for w, (cost, other) in out_edges[node].items()]
+        down[node] = [(u, cost, other, via.get((u, node), -1)) for u, (cost, other) in in_edges[node].items()]
+        for w in out_edges[node]:
+            del in_edges[w][node]
+            contracted_neighbours[w] += 1
+            level[w] = max(level[w], level[node] + 1)
+        for u in in_edges[node]:
+            del out_edges[u][node]
+            contracted_neighbours[u] += 1
+            level[u] = max(level[u], level[node] + 1)
+        out_edges[node], in_edges[node] = {}, {}
+        for u, w, cost, other in shortcuts:
+            if cost < out_edges[u].get(w, (math.inf,))[0]:
+                out_edges[u][w] = in_edges[w][u] = (cost, other)
+                via[(u, w)] = node
+    return rank, up, down
+
+
+def _to_csr(adjacency):
+    indptr = np.zeros(len(adjacency) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(edges) for edges in adjacency])
+    flat = [edge for edges in adjacency for edge in edges]
+    return {
+        "indptr": indptr,
+        "indices": np.array([edge[0] for edge in flat], dtype=np.int32),
+        "cost": np.array([edge[1] for edge in flat], dtype=np.float32),
+        "secondary": np.array([edge[2] for edge in flat], dtype=np.float32),
+        "via": np.array([edge[3] for edge in flat], dtype=np.int32),
+    }
+
+
+def build(nodes_path: str, edges_path: str, output: str, places_path: str = None, metrics=METRICS):
+    started = time.perf_counter()
+    node_ids, lat, lon, sources, targets, length_m, travel_s = read_network(nodes_path, edges_path)
+
+    # Keep the largest connected part and number its nodes by grid cell, so
+    # nodes that are close on the map are close in memory too
+    keep = largest_component(len(node_ids), sources, targets)
+    keep = keep[np.argsort(cell_keys(lat[keep], lon[keep]), kind="stable")]
+    position = np.full(len(node_ids), -1, dtype=np.int64)
+    position[keep] = np.arange(len(keep))
+    inside = (position[sources] >= 0) & (position[targets] >= 0)
+    sources, targets = position[sources[inside]], position[targets[inside]]
+    length_m, travel_s = length_m[inside], travel_s[inside]
+    node_ids, lat, lon = node_ids[keep], lat[keep], lon[keep]
+
+    os.makedirs(output, exist_ok=True)
+    arrays = {"node_ids": node_ids, "lat": lat, "lon": lon, "cell": cell_keys(lat, lon)}
+    for metric in metrics:
+        costs, secondary = (travel_s, length_m) if metric == "time" else (length_m, travel_s)
+        rank, up, down = contract(len(node_ids), sources, targets, costs, secondary)
+        arrays[f"{metric}_rank"] = rank
+        for direction, adjacency in (("up", up), ("down", down)):
+            for name, values in _to_csr(adjacency).items():
+                arrays[f"{metric}_{direction}_{name}"] = values
+    for name, values in arrays.items():
+        np.save(os.path.join(output, f"{name}.npy"), values)
+
+    places = {}
+    if places_path:
+        with open(places_path, newline="") as f:
+            places = {row["name"].strip().lower(): (float(row["lat"]), float(row["lon"])) for row in csv.DictReader(f)}
+    meta = {
+        "nodes": int(len(node_ids)),
+        "edges": int(len(sources)),
+        "metrics": list(metrics),
+        "grid_degrees": GRID_DEGREES,
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "build_seconds": round(time.perf_counter() - started, 1),
+        "places": places,
+    }
+    with open(os.path.join(output, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    return meta
+
+
+def load_array(path: str, name: str):
+    # Memory-mapped, viewed as a plain ndarray: np.memmap's per-slice
+    # bookkeeping costs more than the lookups themselves
+    return np.asarray(np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r"))
+
+
+class _Hierarchy:
+    def __init__(self, path: str, metric: str):
+        def load(name):
+            return load_array(path, f"{metric}_{name}")
+
+        self.rank = load("rank")
+        self.up = tuple(load(f"up_{name}") for name in ("indptr", "indices", "cost", "secondary", "via"))
+        self.down = tuple(load(f"down_{name}") for name in ("indptr", "indices", "cost", "secondary", "via"))
+
+    @staticmethod
+    def edges(graph, node: int):
+        indptr, indices, cost, secondary, via = graph
+        start, end = int(indptr[node]), int(indptr[node + 1])
+        return zip(indices[start:end].tolist(), cost[start:end].tolist(),
+                   secondary[start:end].tolist(), via[start:end].tolist())
+
+    def edge(self, a: int, b: int):
+        # (secondary, via) of the hierarchy edge a -> b
+        if self.rank[a] < self.rank[b]:
+            graph, node, neighbour = self.up, a, b
+        else:
+            graph, node, neighbour = self.down, b, a
+        best = None
+        for other, cost, secondary, via in self.edges(graph, node):
+            if other == neighbour and (best is None or cost < best[0]):
+                best = (cost, secondary, via)
+        return best
+
+    def unpack(self, a: int, b: int, path: list, steps: list):
+        # Appends the road nodes of hierarchy edge a -> b, after a, to path,
+        # and the (cost, secondary) of each road edge to steps
+        stack = [(a, b)]
+        while stack:
+            a, b = stack.pop()
+            cost, secondary, via = self.edge(a, b)
+            if via < 0:
+                path.append(b)
+                steps.append((cost, secondary))
+            else:
+                stack.append((via, b))
+                stack.append((a, via))
+
+    def upward(self, node: int, side: int):
+        # {node: (cost, secondary)} over the whole upward search space of node,
+        # forward (side 0) or backward (side 1), without stalled nodes
+        graph, stall_graph = (self.up, self.down) if side == 0 else (self.down, self.up)
+        distances = {node: (0.0, 0.0)}
+        heap = [(0.0, node)]
+        settled = {}
+        while heap:
+            distance, node = heapq.heappop(heap)
+            if node in settled or distance > distances[node][0]:
+                continue
+            if any(
+                distances.get(higher, (math.inf,))[0] + cost < distance
+                for higher, cost, _, _ in self.edges(stall_graph, node)
+            ):
+                continue
+            settled[node] = distances[node]
+            secondary = distances[node][1]
+            for neighbour, cost, neighbour_secondary, _ in self.edges(graph, node):
+                candidate = distance + cost
+                if candidate < distances.get(neighbour, (math.inf,))[0]:
+                    distances[neighbour] = (candidate, secondary + neighbour_secondary)
+                    heapq.heappush(heap, (candidate, neighbour))
+        return settled
+
+    def matrix(self, sources, targets):
+        # (cost, secondary) matrices between node lists: one backward search per
+        # target leaves its distances in buckets on the nodes it reaches, and
+        # one forward search per source reads them
+        buckets = {}
+        for j, target in enumerate(targets):
+            for node, (cost, secondary) in self.upward(target, 1).items():
+                buckets.setdefault(node, []).append((j, cost, secondary))
+        costs = np.full((len(sources), len(targets)), np.inf)
+        secondaries = np.full((len(sources), len(targets)), np.inf)
+        for i, source in enumerate(sources):
+            row, secondary_row = costs[i], secondaries[i]
+            for node, (cost, secondary) in self.upward(source, 0).items():
+                for j, target_cost, target_secondary in buckets.get(node, ()):
+                    if cost + target_cost < row[j]:
+                        row[j] = cost + target_cost
+                        secondary_row[j] = secondary + target_secondary
+        return costs, secondaries
+
+    def query(self, source: int, target: int):
+        # (cost, secondary, node path, (cost, secondary) of each road edge on
+        # it) of the best route, or None
+        if source == target:
+            return 0.0, 0.0, [source], []
+        distances = ({source: (0.0, 0.0)}, {target: (0.0, 0.0)})
+        parents = ({source: None}, {target: None})
+        heaps = ([(0.0, source)], [(0.0, target)])
+        graphs = (self.up, self.down)
+        best, meeting = math.inf, None
+        while heaps[0] or heaps[1]:
+            side = 0 if heaps[0] and (not heaps[1] or heaps[0][0][0] <= heaps[1][0][0]) else 1
+            distance, node = heapq.heappop(heaps[side])
+            if distance >= best:
+                # Everything left on this side is at least as far
+                heaps[side].clear()
+                continue
+            if distance > distances[side][node][0]:
+                continue
+            other = distances[1 - side].get(node)
+            if other is not None and distance + other[0] < best:
+                best, meeting = distance + other[0], node
+            # Stall on demand: a higher node already reaches this one more
+            # cheaply, so nothing found through it can be on the best route
+            if any(
+                distances[side].get(higher, (math.inf,))[0] + cost < distance
+                for higher, cost, _, _ in self.edges(graphs[1 - side], node)
+            ):
+                continue
+            secondary = distances[side][node][1]
+            for neighbour, cost, neighbour_secondary, _ in self.edges(graphs[side], node):
+                candidate = distance + cost
+                if candidate < distances[side].get(neighbour, (math.inf,))[0]:
+                    distances[side][neighbour] = (candidate, secondary + neighbour_secondary)
+                    parents[side][neighbour] = node
+                    heapq.heappush(heaps[side], (candidate, neighbour))
+        if meeting is None:
+            return None
+
+        # Hierarchy edges from source up to the meeting node and down to target
+        forward = [meeting]
+        while parents[0][forward[-1]] is not None:
+            forward.append(parents[0][forward[-1]])
+        forward.reverse()
+        backward = [meeting]
+        while parents[1][backward[-1]] is not None:
+            backward.append(parents[1][backward[-1]])
+        hops = forward + backward[1:]
+        path, steps = [hops[0]], []
+        for a, b in zip(hops, hops[1:]):
+            self.unpack(a, b, path, steps)
+        return best, distances[0][meeting][1] + distances[1][meeting][1], path, steps
+
+
+class RoadNetwork:
+    def __init__(self, path: str):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.node_ids = load_array(path, "node_ids")
+        self.lat = load_array(path, "lat")
+        self.lon = load_array(path, "lon")
+        self.cell = load_array(path, "cell")
+        self.places = {name: tuple(point) for name, point in self.meta.get("places", {}).items()}
+        self.hierarchies = {metric: _Hierarchy(path, metric) for metric in self.meta["metrics"]}
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def locate(self, place):
+        # parse_point, or a known place name
+        if isinstance(place, str) and place.strip().lower() in self.places:
+            return self.places[place.strip().lower()]
+        return parse_point(place)
+
+    def nearest_node(self, lat: float, lon: float):
+        # Position of the closest road node, searched ring by ring of grid cells
+        lat_cell = math.floor(lat / GRID_DEGREES) + 9_000
+        lon_cell = math.floor(lon / GRID_DEGREES) + 18_000
+        best, best_distance = None, math.inf
+        for ring in range(SNAP_MAX_RINGS + 1):
+            candidates = []
+            for d_lat in range(-ring, ring + 1):
+                for d_lon in range(-ring, ring + 1):
+                    if max(abs(d_lat), abs(d_lon)) != ring:
+                        continue
+                    key = (lat_cell + d_lat) * 36_001 + lon_cell + d_lon
+                    start, end = np.searchsorted(self.cell, key), np.searchsorted(self.cell, key, side="right")
+                    candidates.extend(range(start, end))
+            if candidates:
+                candidates = np.array(candidates)
+                distances = haversine_m(lat, lon, self.lat[candidates], self.lon[candidates])
+                closest = int(distances.argmin())
+                if distances[closest] < best_distance:
+                    best, best_distance = int(candidates[closest]), float(distances[closest])
+            # A node in the next ring is at least ring cells away
+            if best is not None and best_distance <= ring * GRID_DEGREES * 111_000 * math.cos(math.radians(lat)):
+                break
+        return best
+
+    def matrix(self, points, metric: str = "time"):
+        # (duration_s, distance_m) matrices between every pair of (lat, lon) points
+        nodes = [self.nearest_node(*point) for point in points]
+        if None in nodes:
+            raise ValueError(f"{points[nodes.index(None)]} is not near a road")
+        costs, secondaries = self.hierarchies[metric].matrix(nodes, nodes)
+        return (costs, secondaries) if metric == "time" else (secondaries, costs)
+
+    def route(self, start, end, metric: str = "time"):
+        # {"duration_s", "distance_m", "nodes", "geometry", "elapsed_s"} for the
+        # best route by metric, or None when either end is off the network.
+        # elapsed_s is the driving time to each geometry point.
+        source, target = self.nearest_node(*start), self.nearest_node(*end)
+        if source is None or target is None:
+            return None
+        found = self.hierarchies[metric].query(source, target)
+        if found is None:
+            return None
+        cost, secondary, path, steps = found
+        duration_s, distance_m = (cost, secondary) if metric == "time" else (secondary, cost)
+        elapsed = np.zeros(len(path))
+        if steps:
+            elapsed[1:] = np.cumsum(np.array(steps)[:, 0 if metric == "time" else 1])
+        # Positions along the path kept in the geometry
+        sampled = np.arange(len(path))
+        if len(sampled) > MAX_GEOMETRY_POINTS:
+            sampled = np.concatenate([sampled[:-1:math.ceil(len(sampled) / MAX_GEOMETRY_POINTS)], sampled[-1:]])
+        geometry_nodes = np.array(path)[sampled]
+        return {
+            "duration_s": duration_s,
+            "distance_m": distance_m,
+            "nodes": self.node_ids[np.array(path)].tolist(),
+            "geometry": [[round(float(self.lat[i]), 6), round(float(self.lon[i]), 6)] for i in geometry_nodes],
+            "elapsed_s": [round(float(elapsed[i]), 1) for i in sampled],
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preprocess a road network or route across one")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build")
+    build_parser.add_argument("--nodes", required=True)
+    build_parser.add_argument("--edges", required=True)
+    build_parser.add_argument("--places")
+    build_parser.add_argument("--metrics", default=",".join(METRICS))
+    build_parser.add_argument("-o", "--output", default="road_network")
+    route_parser = commands.add_parser("route")
+    route_parser.add_argument("--graph", default="road_network")
+    route_parser.add_argument("--metric", choices=METRICS, default="time")
+    route_parser.add_argument("start")
+    route_parser.add_argument("end")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        meta = build(args.nodes, args.edges, args.output, args.places, tuple(args.metrics.split(",")))
+        print(f"{meta['nodes']} nodes, {meta['edges']} edges preprocessed in {meta['build_seconds']}s")
+    else:
+        network = RoadNetwork(args.graph)
+        started = time.perf_counter()
+        found = network.route(network.locate(args.start), network.locate(args.end), args.metric)
+        elapsed = (time.perf_counter() - started) * 1000
+        if found is None:
+            raise SystemExit("No route found")
+        print(f"{found['distance_m'] / 1000:.1f} km, {found['duration_s'] / 60:.0f} min, "
+              f"{len(found['nodes'])} nodes in {elapsed:.1f} ms")
@@ -0,0 +1,164 @@
+import argparse
+import time
+from datetime import datetime
+import numpy as np
+from sqlalchemy import select
+
+from database import SessionLocal, sync_engine
+from savings_scheduler import apply_contributions, savings_rules
+from wallet_ledger import (
+    SETTLED_STATUS, advance_watermark, hold_pending, migrate_watermarks, read_watermark, release_pending,
+    settled_prefix, virtual_wallets, wallet_transactions,
+)
+
+# Round-up and percentage SavingsRules. Each run reads the WalletTransaction
+# rows written since its high-water mark, works out every active rule's
+# contribution for the whole batch with numpy, and moves the money through
+# savings_scheduler.apply_contributions: one debit and one ledger row per rule
+# per batch rather than per purchase. The batch commits together with the
+# mark, so each purchase is counted exactly once. The mark waits for rows
+# that may still be joined by an earlier uncommitted one (see
+# wallet_ledger.settled_prefix); pending purchases it passes are saved from
+# in the run after they settle.
+#   python savings_pipeline.py --interval 60
+#
+# A roundup rule's amount is the unit to round purchases up to (1.0 rounds
+# $3.40 up to $4.00 and saves $0.60); a percentage rule's amount is the
+# percent of each purchase to save.
+
+WATERMARK_NAME = "savings_rules"
+SPEND_TYPES = ("payment",)
+PIPELINE_BATCH_SIZE = 50_000
+DEFAULT_ROUNDUP_UNIT = 1.0
+
+
+def rule_contributions(spend_users, spend_cents, rule_users, rule_types, rule_amounts):
+    # Per-rule contribution in cents for one batch of purchases. spend_users
+    # and spend_cents describe the purchases; the rule arrays describe the
+    # active rules of those users.
+    spend_users = np.asarray(spend_users, dtype=np.int64)
+    spend_cents = np.asarray(spend_cents, dtype=np.int64)
+    rule_users = np.asarray(rule_users, dtype=np.int64)
+    rule_types = np.asarray(rule_types, dtype=object)
+    rule_amounts = np.asarray(rule_amounts, dtype=np.float64)
+    contributions = np.zeros(len(rule_users), dtype=np.int64)
+    if not len(spend_users) or not len(rule_users):
+        return contributions
+
+    users, spend_index = np.unique(spend_users, return_inverse=True)
+    rule_index = np.searchsorted(users, rule_users)
+    rule_index[rule_index == len(users)] = 0
+    has_spend = users[rule_index] == rule_users
+
+    percentage = (rule_types == "percentage") & has_spend
+    if percentage.any():
+        spent = np.bincount(spend_index, weights=spend_cents, minlength=len(users))
+        contributions[percentage] = np.floor(
+            spent[rule_index[percentage]] * rule_amounts[percentage] / 100
+        ).astype(np.int64)
+
+    roundup = (rule_types == "roundup") & has_spend
+    units = np.round(np.where(rule_amounts > 0, rule_amounts, DEFAULT_ROUNDUP_UNIT) * 100).astype(np.int64)
+    # Few distinct units are in use, so each one is a single pass over the batch
+    for unit in np.unique(units[roundup]):
+        rounded_up = np.bincount(spend_index, weights=-spend_cents % unit, minlength=len(users))
+        chosen = roundup & (units == unit)
+        contributions[chosen] = rounded_up[rule_index[chosen]].astype(np.int64)
+    return contributions
+
+
+def process_batch(db, batch_size: int = PIPELINE_BATCH_SIZE, now: datetime = None) -> int:
+    # Applies the next batch past the mark inside the caller's transaction and
+    # returns how many ledger rows it covered
+    mark = read_watermark(db, WATERMARK_NAME)
+    query = select(
+        wallet_transactions.c.id,
+        wallet_transactions.c.wallet_id,
+        wallet_transactions.c.amount,
+        wallet_transactions.c.transaction_type,
+        wallet_transactions.c.status,
+        wallet_transactions.c.created_at
+    )
+    rows = db.execute(
+        query.where(wallet_transactions.c.id > mark).order_by(wallet_transactions.c.id).limit(batch_size)
+    ).all()
+    now = now or datetime.utcnow()
+    rows = settled_prefix(rows, now)
+    counted = release_pending(db, WATERMARK_NAME, query) + rows
+    hold_pending(db, WATERMARK_NAME, rows, SPEND_TYPES)
+    if not counted:
+        return 0
+
+    _, wallet_ids, amounts, transaction_types, statuses, _ = (np.asarray(values) for values in zip(*counted))
+    purchases = (
+        np.isin(transaction_types.astype(str), SPEND_TYPES)
+        & (statuses.astype(str) == SETTLED_STATUS)
+        & (amounts.astype(np.float64) < 0)
+    )
+    if purchases.any():
+        wallet_ids = wallet_ids[purchases].astype(np.int64)
+        wallet_owner = dict(db.execute(
+            select(virtual_wallets.c.id, virtual_wallets.c.user_id)
+            .where(virtual_wallets.c.id.in_(np.unique(wallet_ids).tolist()))
+        ).all())
+        spend_users = np.array([wallet_owner.get(wallet_id, -1) for wallet_id in wallet_ids.tolist()], dtype=np.int64)
+        spend_cents = np.round(-amounts[purchases].astype(np.float64) * 100).astype(np.int64)
+
+        rules = db.execute(
+            select(
+                savings_rules.c.id,
+                savings_rules.c.user_id,
+                savings_rules.c.target_goal_id,
+                savings_rules.c.rule_type,
+                savings_rules.c.amount
+            )
+            .where(
+                savings_rules.c.is_active.is_(True),
+                savings_rules.c.rule_type.in_(("roundup", "percentage")),
+                savings_rules.c.user_id.in_(set(wallet_owner.values()))
+            )
+        ).all()
+        if rules:
+            rule_ids, rule_users, goal_ids, rule_types, rule_amounts = zip(*rules)
+            cents = rule_contributions(spend_users, spend_cents, rule_users, rule_types, rule_amounts)
+            apply_contributions(
+                db,
+                [
+                    (rule_id, user_id, goal_id, amount / 100)
+                    for rule_id, user_id, goal_id, amount in zip(rule_ids, rule_users, goal_ids, cents.tolist())
+                    if amount > 0
+                ],
+                now
+            )
+
+    if rows:
+        advance_watermark(db, WATERMARK_NAME, rows[-1].id)
+    return len(rows)
+
+
+def run_pipeline(batch_size: int = PIPELINE_BATCH_SIZE) -> int:
+    processed = 0
+    while True:
+        with SessionLocal() as db:
+            count = process_batch(db, batch_size)
+            db.commit()
+        processed += count
+        if count < batch_size:
+            return processed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply round-up and percentage savings rules to new transactions")
+    parser.add_argument("--batch-size", type=int, default=PIPELINE_BATCH_SIZE)
+    parser.add_argument("--interval", type=float, help="seconds between runs; runs once if omitted")
+    args = parser.parse_args()
+    migrate_watermarks(sync_engine)
+
+    while True:
+        started = time.perf_counter()
+        processed = run_pipeline(args.batch_size)
+        print(f"{datetime.utcnow().isoformat()} processed {processed} transactions "
+              f"in {time.perf_counter() - started:.1f}s")
+        if args.interval is None:
+            break
+        time.sleep(args.interval)
@@ -0,0 +1,297 @@
+import argparse
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import (
+    Boolean, DateTime, Float, Integer, String, bindparam, case, column, func, insert, or_, select, table, update
+)
+
+from database import SessionLocal, sync_engine
+from wallet_ledger import virtual_wallets, wallet_transactions
+
+# Runs fixed-amount SavingsRules: each due rule moves its amount from the
+# user's wallet into the target SavingsGoal once per day, week or month.
+#
+# The next-run index is SavingsRule.next_run_at with its
+# (is_active, next_run_at) index, so it survives restarts and due rules come
+# out of one range scan. Rules are pulled in batches and shared across worker
+# processes by user_id, so one user's wallet is only ever touched by one
+# worker. A rule is claimed for a period by writing the period key in the same
+# transaction that moves the money, which makes reruns and restarts no-ops.
+# Periods missed while the scheduler was down are not backfilled.
+#   python savings_scheduler.py --workers 8 --daemon
+
+savings_rules = table(
+    "savings_rules",
+    column("id", Integer),
+    column("user_id", Integer),
+    column("rule_type", String),
+    column("amount", Float),
+    column("target_goal_id", Integer),
+    column("is_active", Boolean),
+    column("frequency", String),
+    column("next_run_at", DateTime),
+    column("last_period", String),
+)
+
+savings_goals = table(
+    "savings_goals",
+    column("id", Integer),
+    column("user_id", Integer),
+    column("target_amount", Float),
+    column("current_amount", Float),
+    column("auto_save_frequency", String),
+)
+
+FREQUENCIES = ("daily", "weekly", "monthly")
+SCHEDULER_BATCH_SIZE = 2000
+
+
+def period_key(frequency: str, when: datetime) -> str:
+    if frequency == "daily":
+        return when.strftime("%Y-%m-%d")
+    if frequency == "weekly":
+        return when.strftime("%G-W%V")
+    return when.strftime("%Y-%m")
+
+
+def next_run(frequency: str, when: datetime) -> datetime:
+    # Start of the period after the one `when` falls in
+    day = datetime(when.year, when.month, when.day)
+    if frequency == "daily":
+        return day + timedelta(days=1)
+    if frequency == "weekly":
+        return day + timedelta(days=7 - day.weekday())
+    return datetime(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+def due_rules(db, now: datetime, limit: int, shard: int = 0, shards: int = 1):
+    query = (
+        select(
+            savings_rules.c.id,
+            savings_rules.c.user_id,
+            savings_rules.c.amount,
+            savings_rules.c.target_goal_id,
+            savings_rules.c.frequency
+        )
+        .where(
+            savings_rules.c.is_active.is_(True),
+            savings_rules.c.next_run_at <= now,
+            savings_rules.c.rule_type == "fixed"
+        )
+        .order_by(savings_rules.c.next_run_at, savings_rules.c.id)
+        .limit(limit)
+    )
+    if shards > 1:
+        query = query.where(savings_rules.c.user_id % shards == shard)
+    return db.execute(query).all()
+
+
+def rule_frequency(frequency) -> str:
+    # Unknown frequencies run monthly, as setup_auto_savings does
+    return frequency if frequency in FREQUENCIES else "monthly"
+
+
+def run_batch(db, rules, now: datetime) -> dict:
+    # Claims the rules for the current period and moves the money for those
+    # claimed, inside the caller's transaction. A rule stored with an unknown
+    # frequency is rewritten as monthly so it leaves the due range.
+    claimed = set()
+    mysql = db.get_bind().dialect.name == "mysql"
+    for frequency in FREQUENCIES:
+        ids = [rule.id for rule in rules if rule_frequency(rule.frequency) == frequency]
+        if not ids:
+            continue
+        period = period_key(frequency, now)
+        unclaimed = (
+            savings_rules.c.id.in_(ids),
+            or_(savings_rules.c.last_period.is_(None), savings_rules.c.last_period != period)
+        )
+        claim = (
+            update(savings_rules)
+            .values(last_period=period, next_run_at=next_run(frequency, now), frequency=frequency)
+        )
+        if mysql:
+            # No UPDATE ... RETURNING: lock the unclaimed rows, then claim
+            # exactly those. A rule another worker holds is read again once
+            # its transaction ends.
+            ids_now = db.scalars(select(savings_rules.c.id).where(*unclaimed).with_for_update()).all()
+            if ids_now:
+                db.execute(claim.where(savings_rules.c.id.in_(ids_now)))
+            claimed.update(ids_now)
+        else:
+            claimed.update(db.scalars(claim.where(*unclaimed).returning(savings_rules.c.id)))
+        # Rules already run this period only need moving along the index
+        db.execute(
+            update(savings_rules)
+            .where(savings_rules.c.id.in_(ids), savings_rules.c.next_run_at <= now)
+            .values(next_run_at=next_run(frequency, now), frequency=frequency)
+        )
+    return apply_contributions(
+        db,
+        [(rule.id, rule.user_id, rule.target_goal_id, rule.amount) for rule in rules if rule.id in claimed],
+        now
+    )
+
+
+def apply_contributions(db, contributions, now: datetime, transaction_type: str = "savings") -> dict:
+    # contributions: [(rule_id, user_id, goal_id, amount)]. Moves each amount
+    # from the user's wallet into the goal inside the caller's transaction,
+    # skipping any the wallet can't cover and capping at the goal's target,
+    # and deactivates rules whose goal is reached. One ledger row per
+    # contribution; everything is written with bulk statements.
+    stats = {"saved": 0, "insufficient": 0, "finished": 0}
+    contributions = sorted(contributions)
+    if not contributions:
+        return stats
+
+    wallets = {
+        user_id: [wallet_id, balance]
+        for wallet_id, user_id, balance in db.execute(
+            select(virtual_wallets.c.id, virtual_wallets.c.user_id, virtual_wallets.c.balance)
+            .where(
+                virtual_wallets.c.user_id.in_({user_id for _, user_id, _, _ in contributions}),
+                virtual_wallets.c.status == "active"
+            )
+            .order_by(virtual_wallets.c.id)
+            .with_for_update()
+        )
+    }
+    goals = {
+        goal_id: [current_amount or 0.0, target_amount]
+        for goal_id, current_amount, target_amount in db.execute(
+            select(savings_goals.c.id, savings_goals.c.current_amount, savings_goals.c.target_amount)
+            .where(savings_goals.c.id.in_({goal_id for _, _, goal_id, _ in contributions}))
+            .order_by(savings_goals.c.id)
+            .with_for_update()
+        )
+    }
+
+    debits, credits, entries, finished = {}, {}, [], []
+    for rule_id, user_id, goal_id, requested in contributions:
+        wallet, goal = wallets.get(user_id), goals.get(goal_id)
+        if goal is None or goal[0] >= goal[1]:
+            finished.append(rule_id)
+            continue
+        # Never save past the goal's target
+        amount = round(min(requested, goal[1] - goal[0]), 2)
+        if amount <= 0:
+            continue
+        if wallet is None or wallet[1] < amount:
+            stats["insufficient"] += 1
+            continue
+        wallet[1] -= amount
+        goal[0] += amount
+        debits[wallet[0]] = debits.get(wallet[0], 0.0) + amount
+        credits[goal_id] = credits.get(goal_id, 0.0) + amount
+        entries.append({
+            "wallet_id": wallet[0],
+            "amount": -amount,
+            "transaction_type": transaction_type,
+            "description": f"Auto-save to goal {goal_id}",
+            "status": "completed",
+            "reference": uuid.uuid4().hex,
+            "counterparty_wallet_id": None,
+            "created_at": now
+        })
+        stats["saved"] += 1
+        if goal[0] >= goal[1]:
+            finished.append(rule_id)
+
+    if debits:
+        db.execute(
+            update(virtual_wallets)
+            .where(virtual_wallets.c.id == bindparam("wallet_id"))
+            .values(balance=virtual_wallets.c.balance - bindparam("debit", type_=Float)),
+            [{"wallet_id": wallet_id, "debit": round(debit, 2)} for wallet_id, debit in debits.items()]
+        )
+        db.execute(
+            update(savings_goals)
+            .where(savings_goals.c.id == bindparam("goal_id"))
+            .values(current_amount=func.coalesce(savings_goals.c.current_amount, 0) + bindparam("credit", type_=Float)),
+            [{"goal_id": goal_id, "credit": round(credit, 2)} for goal_id, credit in credits.items()]
+        )
+        db.execute(insert(wallet_transactions), entries)
+    if finished:
+        db.execute(update(savings_rules).where(savings_rules.c.id.in_(finished)).values(is_active=False))
+        stats["finished"] = len(finished)
+    return stats
+
+
+def run_shard(shard: int, shards: int, now: datetime, batch_size: int = SCHEDULER_BATCH_SIZE) -> dict:
+    # Connections don't survive a fork, so a worker process starts with a fresh pool
+    sync_engine.dispose(close=False)
+    totals = {"saved": 0, "insufficient": 0, "finished": 0}
+    while True:
+        with SessionLocal() as db:
+            rules = due_rules(db, now, batch_size, shard, shards)
+            if rules:
+                for key, value in run_batch(db, rules, now).items():
+                    totals[key] += value
+            db.commit()
+        if len(rules) < batch_size:
+            return totals
+
+
+def run_scheduler(now: datetime = None, workers: int = 1, batch_size: int = SCHEDULER_BATCH_SIZE) -> dict:
+    now = now or datetime.utcnow()
+    if workers <= 1:
+        return run_shard(0, 1, now, batch_size)
+    totals = {"saved": 0, "insufficient": 0, "finished": 0}
+    with ProcessPoolExecutor(workers) as pool:
+        for stats in pool.map(run_shard, range(workers), [workers] * workers, [now] * workers, [batch_size] * workers):
+            for key, value in stats.items():
+                totals[key] += value
+    return totals
+
+
+def backfill_schedule(db, now: datetime) -> int:
+    # Schedules fixed rules written before the scheduler existed, using their
+    # goal's frequency; anything not in FREQUENCIES becomes monthly
+    goal_frequency = (
+        select(savings_goals.c.auto_save_frequency)
+        .where(savings_goals.c.id == savings_rules.c.target_goal_id)
+        .scalar_subquery()
+    )
+    frequency = func.lower(func.trim(func.coalesce(savings_rules.c.frequency, goal_frequency)))
+    result = db.execute(
+        update(savings_rules)
+        .where(savings_rules.c.rule_type == "fixed", savings_rules.c.next_run_at.is_(None))
+        .values(frequency=case((frequency.in_(FREQUENCIES), frequency), else_="monthly"), next_run_at=now)
+    )
+    db.commit()
+    return result.rowcount
+
+
+def next_due_at(db):
+    return db.scalar(
+        select(func.min(savings_rules.c.next_run_at))
+        .where(savings_rules.c.is_active.is_(True), savings_rules.c.rule_type == "fixed")
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run due automatic savings rules")
+    parser.add_argument("--workers", type=int, default=1, help="processes, each owning a user_id shard")
+    parser.add_argument("--batch-size", type=int, default=SCHEDULER_BATCH_SIZE)
+    parser.add_argument("--backfill", action="store_true", help="schedule fixed rules that have no next run yet")
+    parser.add_argument("--daemon", action="store_true", help="keep running, waking when the next rule is due")
+    parser.add_argument("--max-sleep", type=float, default=3600)
+    args = parser.parse_args()
+
+    if args.backfill:
+        with SessionLocal() as db:
+            print(f"Scheduled {backfill_schedule(db, datetime.utcnow())} rules")
+
+    while True:
+        started = time.perf_counter()
+        stats = run_scheduler(workers=args.workers, batch_size=args.batch_size)
+        print(f"{datetime.utcnow().isoformat()} saved {stats['saved']}, insufficient funds {stats['insufficient']}, "
+              f"rules finished {stats['finished']} in {time.perf_counter() - started:.1f}s")
+        if not args.daemon:
+            break
+        with SessionLocal() as db:
+            due_at = next_due_at(db)
+        wait = args.max_sleep if due_at is None else (due_at - datetime.utcnow()).total_seconds()
+        time.sleep(min(max(wait, 1.0), args.max_sleep))
@@ -0,0 +1,30 @@
+import heapq
+
+# Settle-up planner. Given each participant's net balance in cents (positive =
+# is owed money, negative = owes money) it produces a list of transfers that
+# zeroes every balance. Greedily matching the largest debtor with the largest
+# creditor needs at most n - 1 transfers and runs in O(n log n).
+
+
+def plan_settlement(balances: dict) -> list:
+    # Returns [(from_user_id, to_user_id, cents)]
+    if sum(balances.values()) != 0:
+        raise ValueError("Balances must add up to zero")
+
+    creditors = [(-cents, user_id) for user_id, cents in balances.items() if cents > 0]
+    debtors = [(cents, user_id) for user_id, cents in balances.items() if cents < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+
+    transfers = []
+    while creditors and debtors:
+        credit, creditor = heapq.heappop(creditors)
+        debt, debtor = heapq.heappop(debtors)
+        cents = min(-credit, -debt)
+        transfers.append((debtor, creditor, cents))
+
+        if -credit > cents:
+            heapq.heappush(creditors, (credit + cents, creditor))
+        if -debt > cents:
+            heapq.heappush(debtors, (debt + cents, debtor))
+    return transfers
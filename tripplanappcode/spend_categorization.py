@@ -0,0 +1,237 @@
+import argparse
+import re
+import time
+from datetime import date, datetime
+from functools import lru_cache
+from sqlalchemy import (
+    Date, DateTime, Float, Integer, String, and_, bindparam, column, insert, select, table, tuple_, update
+)
+
+from database import SessionLocal, sync_engine
+from wallet_ledger import (
+    SETTLED_STATUS, advance_watermark, hold_pending, migrate_watermarks, read_watermark, release_pending,
+    settled_prefix, virtual_wallets, wallet_transactions,
+)
+
+# Streaming spend categorization. Card payments from the wallet ledger and
+# each participant's share of trip expenses are read past their high-water
+# marks, mapped to a budget category from their description, and added to
+# per-(user, category, month) totals in spend_aggregates. The budget
+# analysis endpoint reads those totals with one indexed join. Both marks stop
+# short of rows an earlier uncommitted write could still land before (see
+# wallet_ledger.settled_prefix); pending payments the ledger mark passes are
+# counted in the run after they settle.
+#   python spend_categorization.py --interval 60
+
+spend_aggregates = table(
+    "spend_aggregates",
+    column("user_id", Integer),
+    column("category", String),
+    column("month", Date),
+    column("spent", Float),
+    column("transaction_count", Integer),
+    column("updated_at", DateTime),
+)
+
+expenses = table(
+    "expenses",
+    column("id", Integer),
+    column("description", String),
+    column("amount", Float),
+    column("paid_by", Integer),
+    column("created_at", DateTime),
+)
+
+payment_requests = table(
+    "payment_requests",
+    column("expense_id", Integer),
+    column("user_id", Integer),
+    column("amount", Float),
+)
+
+# Budget categories are matched to these by name, case-insensitively
+CATEGORY_KEYWORDS = {
+    "transportation": (
+        "gas", "fuel", "uber", "lyft", "taxi", "train", "flight", "airline", "parking",
+        "toll", "bus", "rental car", "car rental", "ferry", "metro",
+    ),
+    "accommodation": ("hotel", "motel", "airbnb", "hostel", "lodging", "inn", "campsite", "camping", "resort"),
+    "food": (
+        "restaurant", "cafe", "coffee", "grocery", "groceries", "dinner", "lunch", "breakfast",
+        "food", "bar", "pizza", "burger", "snack",
+    ),
+    "activities": (
+        "museum", "park", "tour", "tours", "ticket", "tickets", "concert", "show", "hike", "ski",
+        "admission", "entrance",
+    ),
+}
+OTHER_CATEGORY = "other"
+CATEGORIES = (*CATEGORY_KEYWORDS, OTHER_CATEGORY)
+
+SPEND_TYPES = ("payment",)
+LEDGER_WATERMARK = "spend_categorization"
+EXPENSE_WATERMARK = "spend_categorization_expenses"
+CATEGORIZATION_BATCH_SIZE = 20_000
+
+
+def month_key(when) -> date:
+    # The first day of the month as a date, so the same month always has the same key
+    return date(when.year, when.month, 1)
+
+
+@lru_cache(maxsize=100_000)
+def categorize(description: str) -> str:
+    # Merchant descriptions repeat a lot, so they are only matched once.
+    # Keywords match whole words, so "dinner" isn't an "inn".
+    text = " ".join(re.findall(r"[a-z0-9]+", (description or "").lower()))
+    padded = f" {text} "
+    for category, keywords in CATEGORY_KEYWORDS.items():
+        if any(f" {keyword} " in padded for keyword in keywords):
+            return category
+    return OTHER_CATEGORY
+
+
+def add_spend(totals: dict, user_id: int, category: str, month: date, cents: int):
+    key = (user_id, category, month)
+    spent, count = totals.get(key, (0, 0))
+    totals[key] = (spent + cents, count + 1)
+
+
+def ledger_spend(db, batch_size: int, now: datetime = None):
+    # Spend totals from the next batch of card payments; advances the mark
+    mark = read_watermark(db, LEDGER_WATERMARK)
+    query = (
+        select(
+            wallet_transactions.c.id,
+            virtual_wallets.c.user_id,
+            wallet_transactions.c.amount,
+            wallet_transactions.c.transaction_type,
+            wallet_transactions.c.status,
+            wallet_transactions.c.description,
+            wallet_transactions.c.created_at
+        )
+        .join(virtual_wallets, virtual_wallets.c.id == wallet_transactions.c.wallet_id)
+    )
+    rows = db.execute(
+        query.where(wallet_transactions.c.id > mark).order_by(wallet_transactions.c.id).limit(batch_size)
+    ).all()
+    now = now or datetime.utcnow()
+    rows = settled_prefix(rows, now)
+    counted = release_pending(db, LEDGER_WATERMARK, query) + rows
+    hold_pending(db, LEDGER_WATERMARK, rows, SPEND_TYPES)
+    totals = {}
+    for row in counted:
+        if row.transaction_type in SPEND_TYPES and row.status == SETTLED_STATUS and row.amount < 0:
+            # Undated rows count as old, so they go in this month
+            add_spend(totals, row.user_id, categorize(row.description), month_key(row.created_at or now),
+                      round(-row.amount * 100))
+    if rows:
+        advance_watermark(db, LEDGER_WATERMARK, rows[-1].id)
+    return totals, len(rows)
+
+
+def expense_spend(db, batch_size: int, now: datetime = None):
+    # Spend totals from the next batch of trip expenses, split into each
+    # participant's share: their payment request, and whatever the payer
+    # didn't request from anyone else
+    mark = read_watermark(db, EXPENSE_WATERMARK)
+    rows = db.execute(
+        select(expenses.c.id, expenses.c.description, expenses.c.amount, expenses.c.paid_by, expenses.c.created_at)
+        .where(expenses.c.id > mark)
+        .order_by(expenses.c.id)
+        .limit(batch_size)
+    ).all()
+    rows = settled_prefix(rows, now)
+    totals = {}
+    if not rows:
+        return totals, 0
+
+    requests = {}
+    for expense_id, user_id, amount in db.execute(
+        select(payment_requests.c.expense_id, payment_requests.c.user_id, payment_requests.c.amount)
+        .where(payment_requests.c.expense_id.in_([row.id for row in rows]))
+    ):
+        requests.setdefault(expense_id, []).append((user_id, round(amount * 100)))
+    for row in rows:
+        category, month = categorize(row.description), month_key(row.created_at)
+        shares = requests.get(row.id, [])
+        for user_id, cents in shares:
+            add_spend(totals, user_id, category, month, cents)
+        payer_cents = round(row.amount * 100) - sum(cents for _, cents in shares)
+        if payer_cents > 0:
+            add_spend(totals, row.paid_by, category, month, payer_cents)
+    advance_watermark(db, EXPENSE_WATERMARK, rows[-1].id)
+    return totals, len(rows)
+
+
+def apply_spend(db, totals: dict):
+    # Adds {(user_id, category, month): (cents, count)} to spend_aggregates with
+    # one bulk UPDATE for existing rows and one bulk INSERT for new ones
+    if not totals:
+        return
+    keys = list(totals)
+    existing = set()
+    for start in range(0, len(keys), 5000):
+        existing.update(db.execute(
+            select(spend_aggregates.c.user_id, spend_aggregates.c.category, spend_aggregates.c.month)
+            .where(tuple_(
+                spend_aggregates.c.user_id, spend_aggregates.c.category, spend_aggregates.c.month
+            ).in_(keys[start:start + 5000]))
+        ).tuples())
+
+    now = datetime.utcnow()
+    updates, inserts = [], []
+    for (user_id, category, month), (cents, count) in totals.items():
+        if (user_id, category, month) in existing:
+            updates.append({"key_user_id": user_id, "key_category": category, "key_month": month,
+                            "added_spent": cents / 100, "added_count": count})
+        else:
+            inserts.append({"user_id": user_id, "category": category, "month": month,
+                            "spent": cents / 100, "transaction_count": count, "updated_at": now})
+    if updates:
+        db.execute(
+            update(spend_aggregates)
+            .where(and_(
+                spend_aggregates.c.user_id == bindparam("key_user_id"),
+                spend_aggregates.c.category == bindparam("key_category"),
+                spend_aggregates.c.month == bindparam("key_month", type_=Date)
+            ))
+            .values(
+                spent=spend_aggregates.c.spent + bindparam("added_spent", type_=Float),
+                transaction_count=spend_aggregates.c.transaction_count + bindparam("added_count", type_=Integer),
+                updated_at=now
+            ),
+            updates
+        )
+    if inserts:
+        db.execute(insert(spend_aggregates), inserts)
+
+
+def run_categorization(batch_size: int = CATEGORIZATION_BATCH_SIZE) -> int:
+    processed = 0
+    for source in (ledger_spend, expense_spend):
+        while True:
+            with SessionLocal() as db:
+                totals, count = source(db, batch_size)
+                apply_spend(db, totals)
+                db.commit()
+            processed += count
+            if count < batch_size:
+                break
+    return processed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Categorize new spending into monthly budget totals")
+    parser.add_argument("--batch-size", type=int, default=CATEGORIZATION_BATCH_SIZE)
+    parser.add_argument("--interval", type=float, help="seconds between runs; runs once if omitted")
+    args = parser.parse_args()
+    migrate_watermarks(sync_engine)
+
+    while True:
+        started = time.perf_counter()
+        processed = run_categorization(args.batch_size)
+        print(f"{datetime.utcnow().isoformat()} categorized {processed} rows in {time.perf_counter() - started:.1f}s")
+        if args.interval is None:
+            break
+        time.sleep(args.interval)
@@ -0,0 +1,174 @@
+import re
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import select
+
+from spend_categorization import CATEGORIES, categorize
+from wallet_ledger import SETTLED_STATUS, virtual_wallets, wallet_transactions
+
+# Per-user spending features for savings recommendations, computed with numpy
+# over the last HISTORY_DAYS of card payments. Each user's recent payments are
+# cached with the id of the newest one; a request only fetches rows past that
+# id, so new transactions extend the cache instead of forcing a reload, and
+# the features are recomputed in memory only when rows arrive or the day
+# rolls over.
+
+HISTORY_DAYS = 90
+WINDOWS = (7, 30, 90)
+SPEND_TYPES = ("payment",)
+SMALL_PURCHASE = 10.0
+# A merchant is recurring when it's been paid at least this many times at a
+# steady interval between RECURRING_INTERVAL days
+RECURRING_MIN_COUNT = 3
+RECURRING_INTERVAL = (6, 35)
+RECURRING_MAX_JITTER = 0.25
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+
+
+def merchant_key(description: str) -> str:
+    # "UBER *TRIP 8841" and "Uber trip 1203" are the same merchant
+    return " ".join(re.findall(r"[a-z]+", (description or "").lower())[:3]) or "unknown"
+
+
+def compute_features(amounts, timestamps, descriptions, now: datetime) -> dict:
+    # amounts are positive spend, timestamps datetimes, descriptions strings,
+    # all for one user's payments in the history window
+    amounts = np.asarray(amounts, dtype=np.float64)
+    features = {
+        "transactions": int(len(amounts)),
+        "windows": {},
+        "weekday_spend": dict.fromkeys(WEEKDAYS, 0.0),
+        "weekend_share": 0.0,
+        "small_purchases_per_week": 0.0,
+        "small_purchase_spend_per_week": 0.0,
+        "recurring_merchants": [],
+    }
+    if not len(amounts):
+        for days in WINDOWS:
+            features["windows"][f"{days}d"] = {category: {"count": 0, "amount": 0.0} for category in CATEGORIES}
+        return features
+
+    seconds = np.array([timestamp.timestamp() for timestamp in timestamps])
+    age_days = (now.timestamp() - seconds) / 86400
+    category_index = np.array([CATEGORIES.index(categorize(description)) for description in descriptions])
+
+    # Count and amount per category over each rolling window
+    for days in WINDOWS:
+        inside = age_days <= days
+        counts = np.bincount(category_index[inside], minlength=len(CATEGORIES))
+        spent = np.bincount(category_index[inside], weights=amounts[inside], minlength=len(CATEGORIES))
+        features["windows"][f"{days}d"] = {
+            category: {"count": int(counts[i]), "amount": round(float(spent[i]), 2)}
+            for i, category in enumerate(CATEGORIES)
+        }
+
+    # Weekday pattern over the whole history
+    weekdays = np.array([timestamp.weekday() for timestamp in timestamps])
+    by_weekday = np.bincount(weekdays, weights=amounts, minlength=7)
+    features["weekday_spend"] = {day: round(float(total), 2) for day, total in zip(WEEKDAYS, by_weekday)}
+    features["weekend_share"] = round(float(by_weekday[5:].sum() / amounts.sum()), 3)
+
+    # Small purchases in the last 30 days, per week
+    recent_small = (age_days <= 30) & (amounts < SMALL_PURCHASE)
+    features["small_purchases_per_week"] = round(float(recent_small.sum() * 7 / 30), 2)
+    features["small_purchase_spend_per_week"] = round(float(amounts[recent_small].sum() * 7 / 30), 2)
+
+    # Recurring merchants: steady gaps between consecutive payments
+    merchants, merchant_index = np.unique(
+        np.array([merchant_key(description) for description in descriptions], dtype=object).astype(str),
+        return_inverse=True
+    )
+    order = np.lexsort((seconds, merchant_index))
+    sorted_merchants, sorted_days = merchant_index[order], seconds[order] / 86400
+    gaps = np.diff(sorted_days)
+    same = sorted_merchants[1:] == sorted_merchants[:-1]
+    payments = np.bincount(merchant_index, minlength=len(merchants))
+    gap_merchants = sorted_merchants[1:][same]
+    gap_values = gaps[same]
+    gap_count = np.bincount(gap_merchants, minlength=len(merchants))
+    gap_sum = np.bincount(gap_merchants, weights=gap_values, minlength=len(merchants))
+    gap_squares = np.bincount(gap_merchants, weights=gap_values ** 2, minlength=len(merchants))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_gap = gap_sum / gap_count
+        jitter = np.sqrt(np.maximum(gap_squares / gap_count - mean_gap ** 2, 0)) / mean_gap
+    spend = np.bincount(merchant_index, weights=amounts, minlength=len(merchants))
+    recurring = np.flatnonzero(
+        (payments >= RECURRING_MIN_COUNT)
+        & (mean_gap >= RECURRING_INTERVAL[0]) & (mean_gap <= RECURRING_INTERVAL[1])
+        & (jitter <= RECURRING_MAX_JITTER)
+    )
+    features["recurring_merchants"] = sorted(
+        (
+            {
+                "merchant": str(merchants[i]),
+                "payments": int(payments[i]),
+                "interval_days": round(float(mean_gap[i]), 1),
+                "average_amount": round(float(spend[i] / payments[i]), 2),
+            }
+            for i in recurring
+        ),
+        key=lambda merchant: -merchant["average_amount"]
+    )
+    return features
+
+
+class _History:
+    def __init__(self):
+        self.last_id = 0
+        self.rows = []          # (id, amount, created_at, description), oldest first
+        self.features = None
+        self.computed_for = None
+
+
+class SpendingProfileCache:
+    # Least recently used users are dropped once max_users is reached
+    def __init__(self, max_users: int = 50_000):
+        self.max_users = max_users
+        self._histories = OrderedDict()
+
+    def __len__(self):
+        return len(self._histories)
+
+    def invalidate(self, user_id: int):
+        self._histories.pop(user_id, None)
+
+    async def features(self, db, user_id: int, now: datetime = None) -> dict:
+        now = now or datetime.utcnow()
+        history = self._histories.pop(user_id, None) or _History()
+        self._histories[user_id] = history
+        while len(self._histories) > self.max_users:
+            self._histories.popitem(last=False)
+
+        query = (
+            select(
+                wallet_transactions.c.id,
+                wallet_transactions.c.amount,
+                wallet_transactions.c.created_at,
+                wallet_transactions.c.description
+            )
+            .join(virtual_wallets, virtual_wallets.c.id == wallet_transactions.c.wallet_id)
+            .where(
+                virtual_wallets.c.user_id == user_id,
+                wallet_transactions.c.transaction_type.in_(SPEND_TYPES),
+                wallet_transactions.c.status == SETTLED_STATUS,
+                wallet_transactions.c.amount < 0,
+                wallet_transactions.c.id > history.last_id
+            )
+            .order_by(wallet_transactions.c.id)
+        )
+        if not history.last_id:
+            query = query.where(wallet_transactions.c.created_at >= now - timedelta(days=HISTORY_DAYS))
+        # Another request for the same user may have extended the history meanwhile
+        new_rows = [row for row in (await db.execute(query)).all() if row.id > history.last_id]
+
+        if new_rows or history.computed_for != now.date():
+            cutoff = now - timedelta(days=HISTORY_DAYS)
+            history.rows = [row for row in history.rows if row[2] >= cutoff]
+            history.rows.extend((row.id, -row.amount, row.created_at, row.description) for row in new_rows)
+            if new_rows:
+                history.last_id = new_rows[-1].id
+            _, amounts, timestamps, descriptions = zip(*history.rows) if history.rows else ((), (), (), ())
+            history.features = compute_features(amounts, timestamps, descriptions, now)
+            history.computed_for = now.date()
+        return history.features
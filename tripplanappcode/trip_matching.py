@@ -0,0 +1,169 @@
+import bisect
+import heapq
+from collections import defaultdict
+import numpy as np
+
+# Scoring weights used by calculate_user_compatibility
+INTEREST_WEIGHT = 0.7
+RATING_WEIGHT = 0.3
+MAX_RATING = 5.0
+COMPATIBILITY_THRESHOLD = 0.6
+
+
+def parse_interests(raw):
+    # Interests are stored as comma-separated strings on User
+    if not raw:
+        return []
+    return [tag.strip().lower() for tag in raw.split(",") if tag.strip()]
+
+
+# Every known user's interests are kept as a row of a 0/1 matrix so a user
+# can be scored against any set of candidates in one pass
+class CompatibilityEngine:
+    def __init__(self, initial_capacity: int = 1024, initial_tags: int = 64):
+        self._tags = {}      # interest tag -> column
+        self._rows = {}      # user_id -> row
+        self._raw = {}       # user_id -> interests string the row was built from
+        self._matrix = np.zeros((initial_capacity, initial_tags), dtype=np.uint8)
+        self._ratings = np.zeros(initial_capacity, dtype=np.float64)
+
+    def __contains__(self, user_id):
+        return user_id in self._rows
+
+    def _tag_column(self, tag: str) -> int:
+        column = self._tags.get(tag)
+        if column is None:
+            column = len(self._tags)
+            self._tags[tag] = column
+            if column >= self._matrix.shape[1]:
+                grown = np.zeros((self._matrix.shape[0], self._matrix.shape[1] * 2), dtype=np.uint8)
+                grown[:, :self._matrix.shape[1]] = self._matrix
+                self._matrix = grown
+        return column
+
+    def _user_row(self, user_id: int) -> int:
+        row = self._rows.get(user_id)
+        if row is None:
+            row = len(self._rows)
+            self._rows[user_id] = row
+            if row >= self._matrix.shape[0]:
+                self._matrix = np.concatenate([self._matrix, np.zeros_like(self._matrix)])
+                self._ratings = np.concatenate([self._ratings, np.zeros_like(self._ratings)])
+        return row
+
+    def upsert_user(self, user_id: int, interests: str, rating: float):
+        row = self._user_row(user_id)
+        self._ratings[row] = MAX_RATING if rating is None else rating
+        if self._raw.get(user_id) == interests:
+            return
+        self._raw[user_id] = interests
+        self._matrix[row, :] = 0
+        for tag in parse_interests(interests):
+            self._matrix[row, self._tag_column(tag)] = 1
+
+    def interest_vector(self, interests: str) -> np.ndarray:
+        # Tags nobody else has can't contribute to an intersection, so they are dropped
+        vector = np.zeros(self._matrix.shape[1], dtype=np.int32)
+        for tag in set(parse_interests(interests)):
+            column = self._tags.get(tag)
+            if column is not None:
+                vector[column] = 1
+        return vector
+
+    def score(self, interests: str, rating: float, candidate_ids) -> np.ndarray:
+        rows = np.fromiter((self._rows[user_id] for user_id in candidate_ids), dtype=np.int64)
+        common_interests = self._matrix[rows] @ self.interest_vector(interests)
+        rating = MAX_RATING if rating is None else rating
+        rating_diff = np.abs(self._ratings[rows] - rating)
+        return common_interests * INTEREST_WEIGHT + (MAX_RATING - rating_diff) * RATING_WEIGHT
+
+    def top_k(self, interests: str, rating: float, candidate_ids, k: int,
+              threshold: float = COMPATIBILITY_THRESHOLD):
+        # Returns [(score, position in candidate_ids)] best first
+        candidate_ids = list(candidate_ids)
+        if not candidate_ids:
+            return []
+        scores = self.score(interests, rating, candidate_ids)
+        passing = np.flatnonzero(scores > threshold)
+        return heapq.nlargest(k, ((float(scores[i]), int(i)) for i in passing))
+
+
+# Inverted index from interest tag to the users holding it, plus each
+# creator's trips. Used to prune candidates before anything is loaded from the
+# database; the database query still applies the authoritative filters, so a
+# stale posting can only widen the candidate set.
+class InterestIndex:
+    def __init__(self):
+        self._postings = defaultdict(set)   # tag -> user ids
+        self._user_tags = {}                # user_id -> frozenset of tags
+        self._user_ratings = {}             # user_id -> rating
+        self._by_rating = []                # sorted [(rating, user_id)]
+        self._trips = defaultdict(set)      # creator_id -> trip ids
+        self._trip_creator = {}             # trip_id -> creator_id
+
+    def index_user(self, user_id: int, interests: str, rating: float):
+        tags = frozenset(parse_interests(interests))
+        previous = self._user_tags.get(user_id, frozenset())
+        for tag in previous - tags:
+            self._postings[tag].discard(user_id)
+            if not self._postings[tag]:
+                del self._postings[tag]
+        for tag in tags - previous:
+            self._postings[tag].add(user_id)
+        self._user_tags[user_id] = tags
+
+        rating = MAX_RATING if rating is None else rating
+        old_rating = self._user_ratings.get(user_id)
+        if old_rating != rating:
+            if old_rating is not None:
+                position = bisect.bisect_left(self._by_rating, (old_rating, user_id))
+                del self._by_rating[position]
+            bisect.insort(self._by_rating, (rating, user_id))
+            self._user_ratings[user_id] = rating
+
+    def remove_user(self, user_id: int):
+        for tag in self._user_tags.pop(user_id, ()):
+            self._postings[tag].discard(user_id)
+            if not self._postings[tag]:
+                del self._postings[tag]
+        rating = self._user_ratings.pop(user_id, None)
+        if rating is not None:
+            del self._by_rating[bisect.bisect_left(self._by_rating, (rating, user_id))]
+
+    def index_trip(self, trip_id: int, creator_id: int):
+        previous = self._trip_creator.get(trip_id)
+        if previous is not None and previous != creator_id:
+            self._trips[previous].discard(trip_id)
+        self._trip_creator[trip_id] = creator_id
+        self._trips[creator_id].add(trip_id)
+
+    def remove_trip(self, trip_id: int):
+        creator_id = self._trip_creator.pop(trip_id, None)
+        if creator_id is not None:
+            self._trips[creator_id].discard(trip_id)
+            if not self._trips[creator_id]:
+                del self._trips[creator_id]
+
+    def candidate_creators(self, interests: str, rating: float,
+                           threshold: float = COMPATIBILITY_THRESHOLD):
+        candidates = set()
+        for tag in set(parse_interests(interests)):
+            candidates |= self._postings.get(tag, set())
+
+        # With no interests in common the score is (MAX_RATING - rating_diff) * RATING_WEIGHT,
+        # which clears the threshold only when rating_diff < margin
+        margin = MAX_RATING - threshold / RATING_WEIGHT
+        if margin > 0:
+            rating = MAX_RATING if rating is None else rating
+            lo = bisect.bisect_right(self._by_rating, (rating - margin, float("inf")))
+            hi = bisect.bisect_left(self._by_rating, (rating + margin, float("-inf")))
+            candidates.update(user_id for _, user_id in self._by_rating[lo:hi])
+        return candidates
+
+    def candidate_trips(self, interests: str, rating: float, exclude_user_id: int = None,
+                        threshold: float = COMPATIBILITY_THRESHOLD):
+        trip_ids = set()
+        for creator_id in self.candidate_creators(interests, rating, threshold):
+            if creator_id != exclude_user_id:
+                trip_ids |= self._trips.get(creator_id, set())
+        return trip_ids
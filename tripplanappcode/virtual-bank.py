@@ -1,8 +1,16 @@
-from fastapi import FastAPI, Depends, HTTPException
-from sqlalchemy import Column, Integer, Float, String, DateTime, ForeignKey
+from fastapi import FastAPI, Depends, HTTPException, Header
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Column, Integer, Float, String, DateTime, ForeignKey, Index, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime
-import stripe
+from typing import Optional
 import uuid
+from expense_splits import to_cents
+from database import SessionLocal, get_db
+from wallet_export import EXPORT_FORMATS, encode_chunks, iter_chunks, missing_dependency
+from rewards_accrual import tier_for
+from response_cache import response_cache, user_scope
+import wallet_ledger
 
 # Virtual Wallet Model
 class VirtualWallet(Base):
@@ -23,18 +31,53 @@ class WalletTransaction(Base):
     transaction_type = Column(String)  # deposit, withdrawal, transfer, payment
     description = Column(String)
     status = Column(String)
+    reference = Column(String, index=True)  # shared by both sides of a transfer
+    counterparty_wallet_id = Column(Integer, ForeignKey("virtual_wallets.id"))
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        Index("ix_wallet_transactions_wallet_id_id", "wallet_id", "id"),
+        Index("ix_wallet_transactions_wallet_id_created_at", "wallet_id", "created_at"),
+    )
+
+# Ledger checkpoints: the wallet's balance including every transaction up to transaction_id
+class WalletCheckpoint(Base):
+    __tablename__ = "wallet_checkpoints"
+    id = Column(Integer, primary_key=True)
+    wallet_id = Column(Integer, ForeignKey("virtual_wallets.id"), nullable=False)
+    transaction_id = Column(Integer, nullable=False)
+    as_of = Column(DateTime, nullable=False)  # created_at of the newest included transaction
+    balance = Column(Float, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_wallet_checkpoints_wallet_id_transaction_id", "wallet_id", "transaction_id"),
+        Index("ix_wallet_checkpoints_wallet_id_as_of", "wallet_id", "as_of"),
+    )
+
 # Rewards System
 class WalletRewards(Base):
     __tablename__ = "wallet_rewards"
     id = Column(Integer, primary_key=True)
-    wallet_id = Column(Integer, ForeignKey("virtual_wallets.id"))
+    wallet_id = Column(Integer, ForeignKey("virtual_wallets.id"), unique=True, index=True)
     points = Column(Float, default=0.0)
     level = Column(String)  # bronze, silver, gold
     last_updated = Column(DateTime, default=datetime.utcnow)
 
-async def create_virtual_wallet(user_id: int):
+# How far each background job (rewards_accrual.py, savings_pipeline.py) has read the transaction ledger
+class LedgerWatermark(Base):
+    __tablename__ = "ledger_watermarks"
+    name = Column(String, primary_key=True)
+    last_transaction_id = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+# Pending transactions a background job has read past, re-checked each run until they settle
+class LedgerPending(Base):
+    __tablename__ = "ledger_pending"
+    name = Column(String, primary_key=True)
+    transaction_id = Column(Integer, ForeignKey("wallet_transactions.id"), primary_key=True)
+
+async def create_virtual_wallet(db: AsyncSession, user_id: int):
     # Generate unique virtual card number
     card_number = f"4242-TRIP-{uuid.uuid4().hex[:8].upper()}"
     
@@ -44,78 +87,215 @@ async def create_virtual_wallet(user_id: int):
         status="active"
     )
     db.add(wallet)
-    db.commit()
+    await db.commit()
     return wallet
 
 @app.post("/api/wallet/add-funds")
-async def add_funds(data: dict, current_user: User = Depends(get_current_user)):
-    try:
-        wallet = db.query(VirtualWallet).filter(
-            VirtualWallet.user_id == current_user.id
-        ).first()
-        
-        # Create Stripe payment intent for funding
-        payment_intent = stripe.PaymentIntent.create(
-            amount=int(data["amount"] * 100),
-            currency="usd",
-            metadata={"wallet_id": wallet.id}
-        )
-        
-        # Record transaction
-        transaction = WalletTransaction(
-            wallet_id=wallet.id,
-            amount=data["amount"],
-            transaction_type="deposit",
-            status="pending"
+async def add_funds(
+    data: dict,
+    idempotency_key: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    async def handler(scoped_key):
+        try:
+            wallet = await db.scalar(select(VirtualWallet).where(
+                VirtualWallet.user_id == current_user.id
+            ))
+            
+            # Create Stripe payment intent for funding
+            payment_intent = await payment_gateway.create_payment_intent(
+                amount_cents=to_cents(data["amount"]),
+                currency="usd",
+                metadata={"wallet_id": wallet.id},
+                idempotency_key=scoped_key
+            )
+            
+            # Record transaction
+            transaction = WalletTransaction(
+                wallet_id=wallet.id,
+                amount=data["amount"],
+                transaction_type="deposit",
+                status="pending"
+            )
+            db.add(transaction)
+            await db.commit()
+            
+            return {"client_secret": payment_intent["client_secret"]}
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    return await run_idempotent("add-funds", idempotency_key, current_user.id, data, handler)
+
+# Upper bound on legs in one batch transfer request
+MAX_BATCH_LEGS = 500
+
+async def apply_wallet_transfers(db: AsyncSession, legs, transaction_type="transfer"):
+    # legs: [(sender_user_id, recipient_user_id, amount)]. All legs are applied
+    # together in the caller's transaction, which is left uncommitted.
+    user_ids = {user_id for sender_id, recipient_id, _ in legs for user_id in (sender_id, recipient_id)}
+    wallets = {
+        wallet.user_id: wallet
+        for wallet in await db.execute(
+            select(VirtualWallet.id, VirtualWallet.user_id, VirtualWallet.card_number).where(
+                VirtualWallet.user_id.in_(user_ids)
+            )
         )
-        db.add(transaction)
-        db.commit()
-        
-        return {"client_secret": payment_intent.client_secret}
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    }
+    missing = user_ids - wallets.keys()
+    if missing:
+        raise ValueError(f"No wallet for users {sorted(missing)}")
+
+    return await wallet_ledger.transfer_batch(
+        db,
+        [(wallets[sender_id].id, wallets[recipient_id].id, amount) for sender_id, recipient_id, amount in legs],
+        transaction_type,
+        [
+            (
+                f"Transfer to {wallets[recipient_id].card_number[-4:]}",
+                f"Transfer from {wallets[sender_id].card_number[-4:]}"
+            )
+            for sender_id, recipient_id, _ in legs
+        ]
+    )
 
 @app.post("/api/wallet/transfer")
-async def transfer_funds(data: dict, current_user: User = Depends(get_current_user)):
-    sender_wallet = db.query(VirtualWallet).filter(
-        VirtualWallet.user_id == current_user.id
-    ).first()
-    
-    if sender_wallet.balance < data["amount"]:
-        raise HTTPException(status_code=400, detail="Insufficient funds")
-    
-    # Process transfer
-    sender_wallet.balance -= data["amount"]
-    
-    recipient_wallet = db.query(VirtualWallet).filter(
-        VirtualWallet.user_id == data["recipient_id"]
-    ).first()
-    recipient_wallet.balance += data["amount"]
+async def transfer_funds(data: dict, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+    wallets = {
+        wallet.user_id: wallet
+        for wallet in await db.execute(
+            select(VirtualWallet.id, VirtualWallet.user_id, VirtualWallet.card_number).where(
+                VirtualWallet.user_id.in_([current_user.id, data["recipient_id"]])
+            )
+        )
+    }
+    sender_wallet = wallets.get(current_user.id)
+    recipient_wallet = wallets.get(data["recipient_id"])
+    if sender_wallet is None or recipient_wallet is None:
+        raise HTTPException(status_code=404, detail="Wallet not found")
     
-    # Record transactions
-    transaction = WalletTransaction(
-        wallet_id=sender_wallet.id,
-        amount=-data["amount"],
-        transaction_type="transfer",
-        description=f"Transfer to {recipient_wallet.card_number[-4:]}"
-    )
-    db.add(transaction)
-    db.commit()
+    # Process transfer; the balance check happens inside the debit itself
+    try:
+        await wallet_ledger.transfer(
+            db,
+            sender_wallet.id,
+            recipient_wallet.id,
+            data["amount"],
+            description_out=f"Transfer to {recipient_wallet.card_number[-4:]}",
+            description_in=f"Transfer from {sender_wallet.card_number[-4:]}"
+        )
+    except ValueError as e:
+        await db.rollback()
+        raise HTTPException(status_code=400, detail=str(e))
+    await db.commit()
+    await response_cache.invalidate(user_scope(current_user.id), user_scope(data["recipient_id"]))
     
     return {"message": "Transfer successful"}
 
+@app.post("/api/wallet/transfer/batch")
+async def batch_transfer_funds(
+    data: dict,
+    idempotency_key: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    # data: {"transfers": [{"recipient_id": ..., "amount": ...}, ...]}, all paid
+    # from the current user's wallet. Either every leg goes through or none do.
+    transfers = data.get("transfers") or []
+    if not transfers:
+        raise HTTPException(status_code=400, detail="No transfers given")
+    if len(transfers) > MAX_BATCH_LEGS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_LEGS} transfers per batch")
+    for position, leg in enumerate(transfers):
+        if not isinstance(leg, dict) or "recipient_id" not in leg or "amount" not in leg:
+            raise HTTPException(status_code=400, detail=f"Transfer {position} needs a recipient_id and an amount")
+        if isinstance(leg["recipient_id"], bool) or not isinstance(leg["recipient_id"], int):
+            raise HTTPException(status_code=400, detail=f"Transfer {position}: recipient_id must be an integer")
+        try:
+            wallet_ledger.transfer_cents(leg["amount"])
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Transfer {position}: {e}")
+
+    async def handler(scoped_key):
+        try:
+            references = await apply_wallet_transfers(
+                db,
+                [(current_user.id, leg["recipient_id"], leg["amount"]) for leg in transfers]
+            )
+        except ValueError as e:
+            await db.rollback()
+            raise HTTPException(status_code=400, detail=str(e))
+        await db.commit()
+        await response_cache.invalidate(
+            user_scope(current_user.id), *(user_scope(leg["recipient_id"]) for leg in transfers)
+        )
+        return {"message": "Transfers successful", "references": references}
+
+    return await run_idempotent("wallet-batch-transfer", idempotency_key, current_user.id, data, handler)
+
+@app.get("/api/wallet/balance")
+async def get_wallet_balance(
+    at: Optional[datetime] = None,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    wallet_id = await db.scalar(select(VirtualWallet.id).where(VirtualWallet.user_id == current_user.id))
+    if wallet_id is None:
+        raise HTTPException(status_code=404, detail="Wallet not found")
+    return {
+        "balance": await wallet_ledger.balance(db, wallet_id, at),
+        "as_of": (at or datetime.utcnow()).isoformat()
+    }
+
+@app.get("/api/wallet/transactions/export")
+async def export_wallet_transactions(
+    format: str = "csv",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {sorted(EXPORT_FORMATS)}")
+    package = missing_dependency(format)
+    if package is not None:
+        raise HTTPException(status_code=501, detail=f"{format} export needs {package}, which isn't installed")
+    wallet_id = await db.scalar(select(VirtualWallet.id).where(VirtualWallet.user_id == current_user.id))
+    if wallet_id is None:
+        raise HTTPException(status_code=404, detail="Wallet not found")
+
+    # The stream outlives the request's session, so it opens its own. It's a
+    # plain generator, which StreamingResponse iterates in the threadpool.
+    def generate():
+        with SessionLocal() as stream_db:
+            yield from encode_chunks(iter_chunks(stream_db, wallet_id, start, end), format)
+
+    return StreamingResponse(
+        generate(),
+        media_type=EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="wallet-transactions.{format}"'}
+    )
+
 @app.get("/api/wallet/rewards")
-async def get_rewards(current_user: User = Depends(get_current_user)):
-    wallet = db.query(VirtualWallet).filter(
-        VirtualWallet.user_id == current_user.id
-    ).first()
+async def get_rewards(db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+    async def compute():
+        wallet = await db.scalar(select(VirtualWallet).where(
+            VirtualWallet.user_id == current_user.id
+        ))
+        if wallet is None:
+            raise HTTPException(status_code=404, detail="Wallet not found")
     
-    rewards = db.query(WalletRewards).filter(
-        WalletRewards.wallet_id == wallet.id
-    ).first()
+        # Points are accrued in the background by rewards_accrual.py; a wallet
+        # starts at zero until its first qualifying transaction is picked up
+        rewards = await db.scalar(select(WalletRewards).where(
+            WalletRewards.wallet_id == wallet.id
+        ))
+        points = rewards.points if rewards is not None else 0.0
     
-    return {
-        "points": rewards.points,
-        "level": rewards.level,
-        "cash_value": rewards.points * 0.01  # 1 point = $0.01
-    }
+        return {
+            "points": points,
+            "level": rewards.level if rewards is not None else tier_for(points),
+            "cash_value": points * 0.01  # 1 point = $0.01
+        }
+
+    return await response_cache.get_or_compute("wallet-rewards", [user_scope(current_user.id)], compute)
@@ -1,8 +1,16 @@
 from fastapi import FastAPI, Depends, HTTPException
-from sqlalchemy import Column, Integer, Float, String, Boolean, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, Float, String, Boolean, Date, DateTime, ForeignKey, Index, and_, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import relationship
 from datetime import datetime, timedelta
+import asyncio
 import json
+import math
+from database import get_db, migrate_date_column, sync_engine
+from savings_scheduler import FREQUENCIES
+from spend_categorization import month_key
+from spending_analytics import SpendingProfileCache
+from response_cache import response_cache, user_scope
 
 app = FastAPI()
 
@@ -27,8 +35,22 @@ class BudgetCategory(Base):
     user_id = Column(Integer, ForeignKey("users.id"))
     name = Column(String)
     monthly_budget = Column(Float)
-    current_spent = Column(Float, default=0.0)
-    month = Column(DateTime)
+    current_spent = Column(Float, default=0.0)  # superseded by SpendAggregate
+    month = Column(Date)  # first day of the month, see spend_categorization.month_key
+
+    __table_args__ = (
+        Index("ix_budget_categories_user_id_month", "user_id", "month"),
+    )
+
+# Spending per user, category and month, kept up to date by spend_categorization.py
+class SpendAggregate(Base):
+    __tablename__ = "spend_aggregates"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    month = Column(Date, primary_key=True)
+    category = Column(String, primary_key=True)
+    spent = Column(Float, default=0.0)
+    transaction_count = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
 
 # Smart Savings Rules
 class SavingsRule(Base):
@@ -39,9 +61,31 @@ class SavingsRule(Base):
     amount = Column(Float)
     target_goal_id = Column(Integer, ForeignKey("savings_goals.id"))
     is_active = Column(Boolean, default=True)
+    frequency = Column(String)  # daily, weekly, monthly; fixed rules only
+    next_run_at = Column(DateTime)  # when savings_scheduler.py runs it next
+    last_period = Column(String)  # period key of the last run, e.g. 2024-05 or 2024-W19
+
+    __table_args__ = (
+        Index("ix_savings_rules_active_next_run_at", "is_active", "next_run_at"),
+    )
+
+def budget_month(value):
+    # BudgetCategory.month used to be a DateTime stamped with when the budget
+    # was set; keep just its month so it lines up with SpendAggregate.month
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    return month_key(value)
+
+@app.on_event("startup")
+async def migrate_budget_months():
+    # A no-op once the column holds first-of-month dates
+    await asyncio.to_thread(migrate_date_column, sync_engine, BudgetCategory.__tablename__, "month", budget_month)
 
 @app.post("/api/savings/create-goal")
-async def create_savings_goal(goal_data: dict, current_user: User = Depends(get_current_user)):
+async def create_savings_goal(goal_data: dict, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
     try:
         new_goal = SavingsGoal(
             user_id=current_user.id,
@@ -53,18 +97,19 @@ async def create_savings_goal(goal_data: dict, current_user: User = Depends(get_
             auto_save_frequency=goal_data["frequency"]
         )
         db.add(new_goal)
-        db.commit()
+        await db.commit()
 
         if goal_data["autoSave"]:
             # Calculate and set up automatic savings
-            setup_auto_savings(new_goal.id, goal_data)
+            await setup_auto_savings(db, new_goal.id, goal_data)
+        await response_cache.invalidate(user_scope(current_user.id))
 
         return {"message": "Savings goal created successfully", "goal_id": new_goal.id}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-def setup_auto_savings(goal_id: int, goal_data: dict):
-    goal = db.query(SavingsGoal).filter(SavingsGoal.id == goal_id).first()
+async def setup_auto_savings(db: AsyncSession, goal_id: int, goal_data: dict):
+    goal = await db.get(SavingsGoal, goal_id)
     remaining_days = (goal.deadline - datetime.utcnow()).days
     
     if goal_data["frequency"] == "daily":
@@ -74,91 +119,170 @@ def setup_auto_savings(goal_id: int, goal_data: dict):
     else:  # monthly
         amount_per_save = goal.target_amount / (remaining_days / 30)
 
+    # The first save happens on the scheduler's next pass
     savings_rule = SavingsRule(
         user_id=goal.user_id,
         rule_type="fixed",
         amount=amount_per_save,
-        target_goal_id=goal_id
+        target_goal_id=goal_id,
+        frequency=goal_data["frequency"] if goal_data["frequency"] in FREQUENCIES else "monthly",
+        next_run_at=datetime.utcnow()
     )
     db.add(savings_rule)
-    db.commit()
+    await db.commit()
 
-@app.post("/api/budget/set-category")
-async def set_budget_category(category_data: dict, current_user: User = Depends(get_current_user)):
-    category = BudgetCategory(
+@app.post("/api/savings/rules")
+async def create_savings_rule(rule_data: dict, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+    # Round-up and percentage rules save from every card purchase; they are
+    # applied in batches by savings_pipeline.py
+    if rule_data.get("ruleType") not in ("roundup", "percentage"):
+        raise HTTPException(status_code=400, detail="ruleType must be roundup or percentage")
+    try:
+        amount = float(rule_data.get("amount") or (1.0 if rule_data["ruleType"] == "roundup" else 0))
+        goal_id = int(rule_data["goalId"])
+    except KeyError:
+        raise HTTPException(status_code=400, detail="goalId is required")
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="amount must be a number and goalId an integer")
+    if not math.isfinite(amount) or amount <= 0 or (rule_data["ruleType"] == "percentage" and amount > 100):
+        raise HTTPException(status_code=400, detail="Invalid amount")
+
+    goal = await db.get(SavingsGoal, goal_id)
+    if goal is None or goal.user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Savings goal not found")
+
+    rule = SavingsRule(
         user_id=current_user.id,
-        name=category_data["name"],
-        monthly_budget=category_data["budget"],
-        month=datetime.utcnow().replace(day=1)
+        rule_type=rule_data["ruleType"],
+        amount=amount,
+        target_goal_id=goal.id
     )
-    db.add(category)
-    db.commit()
+    db.add(rule)
+    await db.commit()
+    await response_cache.invalidate(user_scope(current_user.id))
+    return {"message": "Savings rule created successfully", "rule_id": rule.id}
+
+@app.post("/api/budget/set-category")
+async def set_budget_category(category_data: dict, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+    month = month_key(datetime.utcnow())
+    category = await db.scalar(select(BudgetCategory).where(
+        BudgetCategory.user_id == current_user.id,
+        BudgetCategory.month == month,
+        BudgetCategory.name == category_data["name"]
+    ))
+    if category is None:
+        category = BudgetCategory(user_id=current_user.id, name=category_data["name"], month=month)
+        db.add(category)
+    category.monthly_budget = category_data["budget"]
+    await db.commit()
+    await response_cache.invalidate(user_scope(current_user.id))
     return {"message": "Budget category set successfully"}
 
 @app.get("/api/budget/analysis")
-async def get_budget_analysis(current_user: User = Depends(get_current_user)):
-    categories = db.query(BudgetCategory).filter(
-        BudgetCategory.user_id == current_user.id,
-        BudgetCategory.month == datetime.utcnow().replace(day=1)
-    ).all()
+async def get_budget_analysis(db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+    # Cached per user; budget writes invalidate it, new spend shows up within the TTL
+    month = month_key(datetime.utcnow())
+
+    async def compute():
+        # Budgets joined to this month's spend aggregates, both read off the (user_id, month) prefix
+        categories = await db.execute(
+            select(BudgetCategory.name, BudgetCategory.monthly_budget, func.coalesce(SpendAggregate.spent, 0.0))
+            .outerjoin(SpendAggregate, and_(
+                SpendAggregate.user_id == BudgetCategory.user_id,
+                SpendAggregate.month == BudgetCategory.month,
+                SpendAggregate.category == func.lower(BudgetCategory.name)
+            ))
+            .where(BudgetCategory.user_id == current_user.id, BudgetCategory.month == month)
+            .order_by(BudgetCategory.name)
+        )
     
-    analysis = []
-    for category in categories:
-        percentage_used = (category.current_spent / category.monthly_budget) * 100
-        status = "on_track" if percentage_used <= 100 else "over_budget"
+        analysis = []
+        for name, budget, spent in categories:
+            percentage_used = (spent / budget) * 100 if budget else 0.0
+            status = "on_track" if percentage_used <= 100 else "over_budget"
         
-        analysis.append({
-            "name": category.name,
-            "budget": category.monthly_budget,
-            "spent": category.current_spent,
-            "percentage_used": percentage_used,
-            "status": status
-        })
+            analysis.append({
+                "name": name,
+                "budget": budget,
+                "spent": spent,
+                "percentage_used": percentage_used,
+                "status": status
+            })
     
-    return analysis
+        return analysis
+
+    return await response_cache.get_or_compute("budget-analysis", [user_scope(current_user.id)], compute, month)
 
 @app.get("/api/savings/recommendations")
-async def get_savings_recommendations(current_user: User = Depends(get_current_user)):
-    # Analyze spending patterns
-    spending_patterns = analyze_spending_patterns(current_user.id)
+async def get_savings_recommendations(db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+    async def compute():
+        # Analyze spending patterns
+        spending_patterns = await analyze_spending_patterns(db, current_user.id)
     
-    # Generate personalized recommendations
-    recommendations = []
+        # Generate personalized recommendations
+        recommendations = []
     
-    # Check for high-frequency small purchases
-    if spending_patterns["daily_coffee"] > 4:
-        recommendations.append({
-            "type": "reduction",
-            "category": "daily_expenses",
-            "potential_savings": spending_patterns["daily_coffee"] * 2,
-            "message": "Reducing daily coffee purchases could save you significant money"
-        })
+        # Check for high-frequency small purchases
+        if spending_patterns["small_purchases_per_week"] > 4:
+            recommendations.append({
+                "type": "reduction",
+                "category": "daily_expenses",
+                "potential_savings": round(spending_patterns["small_purchase_spend_per_week"] / 2, 2),
+                "message": f"You make about {spending_patterns['small_purchases_per_week']:.0f} small purchases a week; "
+                           "halving them would save you significant money"
+            })
     
-    # Check for optimal saving frequency
-    active_goals = db.query(SavingsGoal).filter(
-        SavingsGoal.user_id == current_user.id,
-        SavingsGoal.current_amount < SavingsGoal.target_amount
-    ).all()
+        # Check for the category that grew most against its usual month
+        monthly = spending_patterns["windows"]["30d"]
+        quarterly = spending_patterns["windows"]["90d"]
+        for category, recent in monthly.items():
+            usual = quarterly[category]["amount"] / 3
+            if usual > 0 and recent["amount"] > usual * 1.25 and recent["amount"] - usual >= 20:
+                recommendations.append({
+                    "type": "reduction",
+                    "category": category,
+                    "potential_savings": round(recent["amount"] - usual, 2),
+                    "message": f"You spent {recent['amount']:.2f} on {category} this month, above your usual {usual:.2f}"
+                })
     
-    for goal in active_goals:
-        remaining_amount = goal.target_amount - goal.current_amount
-        days_to_deadline = (goal.deadline - datetime.utcnow()).days
-        if days_to_deadline > 0:
-            optimal_frequency = remaining_amount / days_to_deadline
+        # Check for subscriptions and other recurring payments
+        for merchant in spending_patterns["recurring_merchants"][:3]:
+            monthly_cost = merchant["average_amount"] * 30 / merchant["interval_days"]
             recommendations.append({
-                "type": "frequency",
-                "goal": goal.name,
-                "optimal_frequency": optimal_frequency,
-                "message": f"To reach your goal '{goal.name}', save {optimal_frequency:.2f} per day."
+                "type": "recurring",
+                "merchant": merchant["merchant"],
+                "potential_savings": round(monthly_cost, 2),
+                "message": f"You pay {merchant['merchant']} about every {merchant['interval_days']:.0f} days "
+                           f"({monthly_cost:.2f} a month); cancel it if you no longer use it"
             })
     
-    return recommendations
-
-def analyze_spending_patterns(user_id: int):
-    # Placeholder function to analyze spending patterns
-    # In a real application, this would involve complex data analysis
-    return {
-        "daily_coffee": 5,
-        "weekly_dining": 3,
-        "monthly_shopping": 2
-    }
\ No newline at end of file
+        # Check for optimal saving frequency
+        active_goals = (await db.scalars(select(SavingsGoal).where(
+            SavingsGoal.user_id == current_user.id,
+            SavingsGoal.current_amount < SavingsGoal.target_amount
+        ))).all()
+    
+        for goal in active_goals:
+            remaining_amount = goal.target_amount - goal.current_amount
+            days_to_deadline = (goal.deadline - datetime.utcnow()).days
+            if days_to_deadline > 0:
+                optimal_frequency = remaining_amount / days_to_deadline
+                recommendations.append({
+                    "type": "frequency",
+                    "goal": goal.name,
+                    "optimal_frequency": optimal_frequency,
+                    "message": f"To reach your goal '{goal.name}', save {optimal_frequency:.2f} per day."
+                })
+    
+        return recommendations
+
+    # Keyed by day as well, since the per-day targets change with the date
+    return await response_cache.get_or_compute(
+        "savings-recommendations", [user_scope(current_user.id)], compute, datetime.utcnow().date()
+    )
+
+# Recent spending per user, extended with new transactions as they arrive
+spending_profiles = SpendingProfileCache(max_users=50_000)
+
+async def analyze_spending_patterns(db: AsyncSession, user_id: int):
+    return await spending_profiles.features(db, user_id)
\ No newline at end of file
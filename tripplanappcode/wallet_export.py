@@ -0,0 +1,189 @@
+import argparse
+import csv
+import importlib.util
+import io
+import sys
+from datetime import datetime
+from sqlalchemy import select, tuple_
+
+from wallet_ledger import wallet_transactions
+
+# Wallet transaction history export. Rows are read in keyset-ordered chunks on
+# (wallet_id, created_at, id), which the ix_wallet_transactions_wallet_id_created_at
+# index serves for both the ordering and date-range filters, and each chunk is
+# encoded and handed on before the next is read, so memory stays flat however
+# long the history is. The same generators back the streaming endpoint in
+# virtual-bank.py, which runs them in the threadpool so neither the reads nor
+# the Parquet encoding hold up the event loop, and the offline CLI:
+#   python wallet_export.py --wallet-id 42 --start 2024-01-01 --format parquet -o wallet-42.parquet
+
+EXPORT_CHUNK_SIZE = 5000
+EXPORT_FORMATS = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+EXPORT_COLUMNS = [
+    "id", "wallet_id", "created_at", "amount", "transaction_type",
+    "status", "description", "reference", "counterparty_wallet_id",
+]
+
+# Formats that need an optional package, and the package
+FORMAT_DEPENDENCIES = {"parquet": "pyarrow"}
+
+_ordering = (wallet_transactions.c.wallet_id, wallet_transactions.c.created_at, wallet_transactions.c.id)
+
+
+def missing_dependency(export_format: str):
+    # The package an export format needs but isn't installed, if any
+    package = FORMAT_DEPENDENCIES.get(export_format)
+    if package is not None and importlib.util.find_spec(package) is None:
+        return package
+    return None
+
+
+def chunk_query(wallet_id: int = None, start: datetime = None, end: datetime = None,
+                after: tuple = None, chunk_size: int = EXPORT_CHUNK_SIZE):
+    # One chunk of rows, starting after the (wallet_id, created_at, id) of the
+    # previous chunk's last row; `end` is exclusive
+    query = select(*(wallet_transactions.c[name] for name in EXPORT_COLUMNS))
+    if wallet_id is not None:
+        query = query.where(wallet_transactions.c.wallet_id == wallet_id)
+    if start is not None:
+        query = query.where(wallet_transactions.c.created_at >= start)
+    if end is not None:
+        query = query.where(wallet_transactions.c.created_at < end)
+    if after is not None:
+        query = query.where(tuple_(*_ordering) > tuple_(*after))
+    return query.order_by(*_ordering).limit(chunk_size)
+
+
+def _last_key(chunk):
+    last = chunk[-1]
+    return last.wallet_id, last.created_at, last.id
+
+
+def iter_chunks(db, wallet_id: int = None, start: datetime = None, end: datetime = None,
+                chunk_size: int = EXPORT_CHUNK_SIZE):
+    after = None
+    while True:
+        chunk = db.execute(chunk_query(wallet_id, start, end, after, chunk_size)).all()
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            return
+        after = _last_key(chunk)
+
+
+def csv_encode(chunk, header: bool = False) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(EXPORT_COLUMNS)
+    for row in chunk:
+        writer.writerow(
+            value.isoformat() if isinstance(value, datetime) else value
+            for value in row
+        )
+    return buffer.getvalue().encode()
+
+
+class _ByteSink(io.RawIOBase):
+    # File object for ParquetWriter that hands written bytes back to the caller
+    # after every row group; tell() keeps counting so the footer offsets are right
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+class ParquetEncoder:
+    # One Parquet row group per chunk. Needs pyarrow, which is only imported
+    # when a Parquet export is asked for.
+    def __init__(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self.schema = pa.schema([
+            ("id", pa.int64()),
+            ("wallet_id", pa.int64()),
+            ("created_at", pa.timestamp("us")),
+            ("amount", pa.float64()),
+            ("transaction_type", pa.string()),
+            ("status", pa.string()),
+            ("description", pa.string()),
+            ("reference", pa.string()),
+            ("counterparty_wallet_id", pa.int64()),
+        ])
+        self._sink = _ByteSink()
+        self._writer = pq.ParquetWriter(self._sink, self.schema, compression="zstd")
+
+    def encode(self, chunk) -> bytes:
+        columns = list(zip(*chunk))
+        self._writer.write_table(self._pa.Table.from_arrays(
+            [self._pa.array(values, type=field.type) for values, field in zip(columns, self.schema)],
+            schema=self.schema
+        ))
+        return self._sink.drain()
+
+    def close(self) -> bytes:
+        self._writer.close()
+        return self._sink.drain()
+
+
+def encode_chunks(chunks, export_format: str):
+    # Bytes of the export, one piece per chunk of rows
+    if export_format == "parquet":
+        encoder = ParquetEncoder()
+        for chunk in chunks:
+            yield encoder.encode(chunk)
+        yield encoder.close()
+    else:
+        header = True
+        for chunk in chunks:
+            yield csv_encode(chunk, header)
+            header = False
+        if header:
+            yield csv_encode([], header)
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Export wallet transactions to CSV or Parquet")
+    parser.add_argument("--wallet-id", type=int, help="every wallet if omitted")
+    parser.add_argument("--start", type=datetime.fromisoformat, help="inclusive, ISO date or datetime")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="exclusive, ISO date or datetime")
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="csv")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+    parser.add_argument("-o", "--output", help="file to write; stdout if omitted")
+    args = parser.parse_args()
+
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    stats = {"rows": 0}
+
+    def counted(chunks):
+        for chunk in chunks:
+            stats["rows"] += len(chunk)
+            yield chunk
+
+    with SessionLocal() as db:
+        for data in encode_chunks(
+            counted(iter_chunks(db, args.wallet_id, args.start, args.end, args.chunk_size)), args.format
+        ):
+            output.write(data)
+    if args.output:
+        output.close()
+    print(f"Exported {stats['rows']} transactions", file=sys.stderr)
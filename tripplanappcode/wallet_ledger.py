@@ -0,0 +1,363 @@
+import math
+import uuid
+from datetime import datetime, timedelta
+from collections import defaultdict
+from sqlalchemy import (
+    DateTime, Float, Integer, String, case, column, delete, func, insert, inspect, or_, select, table, text, update
+)
+
+from expense_splits import to_cents
+
+# Wallet money movement as plain SQL statements, so the web handlers, offline
+# jobs and benchmarks all share one implementation. The tables are declared by
+# the VirtualWallet, WalletTransaction and WalletCheckpoint models in
+# virtual-bank.py.
+#
+# The WalletTransaction ledger is the source of truth for balances. A
+# checkpoint records a wallet's balance including every transaction up to
+# transaction_id, so a balance is the latest checkpoint plus the completed
+# rows after it. VirtualWallet.balance is a running projection kept for the
+# atomic overdraft check in transfer() and reconciled by ledger_compaction.py.
+
+virtual_wallets = table(
+    "virtual_wallets",
+    column("id"),
+    column("user_id"),
+    column("balance"),
+    column("card_number"),
+    column("status"),
+)
+
+wallet_transactions = table(
+    "wallet_transactions",
+    column("id", Integer),
+    column("wallet_id", Integer),
+    column("amount", Float),
+    column("transaction_type", String),
+    column("description", String),
+    column("status", String),
+    column("reference", String),
+    column("counterparty_wallet_id", Integer),
+    column("created_at", DateTime),
+)
+
+wallet_checkpoints = table(
+    "wallet_checkpoints",
+    column("id"),
+    column("wallet_id"),
+    column("transaction_id"),
+    column("as_of"),
+    column("balance"),
+    column("created_at"),
+)
+
+# How far each background consumer of the ledger (rewards accrual, savings
+# rules) has read it, by transaction id
+ledger_watermarks = table(
+    "ledger_watermarks",
+    column("name", String),
+    column("last_transaction_id", Integer),
+    column("updated_at", DateTime),
+)
+
+# Pending rows a consumer's mark has moved past, to count once they settle
+ledger_pending = table(
+    "ledger_pending",
+    column("name", String),
+    column("transaction_id", Integer),
+)
+
+# Where the rewards accrual mark was kept before the consumers shared one table
+LEGACY_WATERMARK_TABLE = "rewards_watermarks"
+
+# Only settled rows move a balance
+SETTLED_STATUS = "completed"
+
+# Ids are handed out before commit, so a row can become visible after one
+# with a higher id. Consumers reading past a watermark only go as far as rows
+# older than CONSUMER_SETTLE_SECONDS, by which time every earlier write has
+# committed. Pending rows don't hold the mark: hold_pending lists the ones a
+# consumer would count, and release_pending hands them back once settled.
+CONSUMER_SETTLE_SECONDS = 60
+
+
+class InsufficientFunds(ValueError):
+    pass
+
+
+class WalletUnavailable(ValueError):
+    pass
+
+
+def transfer_cents(amount) -> int:
+    # A transfer amount in dollars as integer cents; anything that isn't a
+    # positive number of whole cents is refused rather than rounded
+    if isinstance(amount, bool) or not isinstance(amount, (int, float)) or not math.isfinite(amount):
+        raise ValueError("Transfer amount must be a number")
+    cents = to_cents(amount)
+    if cents / 100 != amount:
+        raise ValueError("Transfer amount must be a whole number of cents")
+    if cents <= 0:
+        raise ValueError("Transfer amount must be positive")
+    return cents
+
+
+async def transfer(db, sender_wallet_id: int, recipient_wallet_id: int, amount: float,
+                   transaction_type: str = "transfer", description_out: str = None,
+                   description_in: str = None) -> str:
+    # Moves amount between two wallets inside the caller's transaction and
+    # returns the reference shared by both ledger rows. The debit is a
+    # conditional UPDATE, so the balance check and the write are one atomic
+    # step; both rows are updated in wallet id order so that opposing
+    # transfers lock them in the same order and can't deadlock.
+    amount = transfer_cents(amount) / 100
+    if sender_wallet_id == recipient_wallet_id:
+        raise ValueError("Can't transfer to the same wallet")
+
+    debit = (
+        update(virtual_wallets)
+        .where(
+            virtual_wallets.c.id == sender_wallet_id,
+            virtual_wallets.c.status == "active",
+            virtual_wallets.c.balance >= amount
+        )
+        .values(balance=virtual_wallets.c.balance - amount)
+    )
+    credit = (
+        update(virtual_wallets)
+        .where(virtual_wallets.c.id == recipient_wallet_id, virtual_wallets.c.status == "active")
+        .values(balance=virtual_wallets.c.balance + amount)
+    )
+    steps = [(sender_wallet_id, debit), (recipient_wallet_id, credit)]
+    for wallet_id, statement in sorted(steps, key=lambda step: step[0]):
+        result = await db.execute(statement)
+        if result.rowcount != 1:
+            if wallet_id == sender_wallet_id:
+                raise InsufficientFunds("Insufficient funds")
+            raise WalletUnavailable("Recipient wallet is not available")
+
+    # Double entry: one row per side, tied together by the reference
+    reference = uuid.uuid4().hex
+    created_at = datetime.utcnow()
+    await db.execute(insert(wallet_transactions), [
+        {
+            "wallet_id": sender_wallet_id,
+            "amount": -amount,
+            "transaction_type": transaction_type,
+            "description": description_out,
+            "status": "completed",
+            "reference": reference,
+            "counterparty_wallet_id": recipient_wallet_id,
+            "created_at": created_at
+        },
+        {
+            "wallet_id": recipient_wallet_id,
+            "amount": amount,
+            "transaction_type": transaction_type,
+            "description": description_in,
+            "status": "completed",
+            "reference": reference,
+            "counterparty_wallet_id": sender_wallet_id,
+            "created_at": created_at
+        }
+    ])
+    return reference
+
+
+async def transfer_batch(db, legs, transaction_type: str = "transfer", descriptions=None) -> list:
+    # legs: [(sender_wallet_id, recipient_wallet_id, amount)], from any number
+    # of source wallets; descriptions is an optional parallel list of
+    # (description_out, description_in). Every wallet's net change is applied
+    # by one conditional UPDATE and the ledger rows by one bulk INSERT, inside
+    # the caller's transaction. On error some wallets may already be updated,
+    # so the caller must roll back. Net changes are summed in cents, so a
+    # wallet's delta is exact however many legs touch it.
+    legs = [
+        (sender_wallet_id, recipient_wallet_id, transfer_cents(amount))
+        for sender_wallet_id, recipient_wallet_id, amount in legs
+    ]
+    net = defaultdict(int)
+    for sender_wallet_id, recipient_wallet_id, cents in legs:
+        if sender_wallet_id == recipient_wallet_id:
+            raise ValueError("Can't transfer to the same wallet")
+        net[sender_wallet_id] -= cents
+        net[recipient_wallet_id] += cents
+    if not net:
+        return []
+
+    delta = case(
+        {wallet_id: cents / 100 for wallet_id, cents in net.items()},
+        value=virtual_wallets.c.id
+    )
+    result = await db.execute(
+        update(virtual_wallets)
+        .where(
+            virtual_wallets.c.id.in_(net.keys()),
+            virtual_wallets.c.status == "active",
+            virtual_wallets.c.balance + delta >= 0
+        )
+        .values(balance=virtual_wallets.c.balance + delta)
+    )
+    if result.rowcount != len(net):
+        active = await db.scalar(select(func.count()).where(
+            virtual_wallets.c.id.in_(net.keys()), virtual_wallets.c.status == "active"
+        ))
+        if active != len(net):
+            raise WalletUnavailable("A wallet in the batch is not available")
+        raise InsufficientFunds("Insufficient funds")
+
+    references = []
+    rows = []
+    created_at = datetime.utcnow()
+    for index, (sender_wallet_id, recipient_wallet_id, cents) in enumerate(legs):
+        amount = cents / 100
+        description_out, description_in = descriptions[index] if descriptions else (None, None)
+        reference = uuid.uuid4().hex
+        references.append(reference)
+        rows.append({
+            "wallet_id": sender_wallet_id,
+            "amount": -amount,
+            "transaction_type": transaction_type,
+            "description": description_out,
+            "status": "completed",
+            "reference": reference,
+            "counterparty_wallet_id": recipient_wallet_id,
+            "created_at": created_at
+        })
+        rows.append({
+            "wallet_id": recipient_wallet_id,
+            "amount": amount,
+            "transaction_type": transaction_type,
+            "description": description_in,
+            "status": "completed",
+            "reference": reference,
+            "counterparty_wallet_id": sender_wallet_id,
+            "created_at": created_at
+        })
+    await db.execute(insert(wallet_transactions), rows)
+    return references
+
+
+def read_watermark(db, name: str) -> int:
+    # Locks the consumer's mark for the rest of the transaction, so two
+    # copies of a job can't process the same batch
+    mark = db.scalar(
+        select(ledger_watermarks.c.last_transaction_id)
+        .where(ledger_watermarks.c.name == name)
+        .with_for_update()
+    )
+    if mark is None:
+        db.execute(insert(ledger_watermarks).values(name=name, last_transaction_id=0, updated_at=datetime.utcnow()))
+        return 0
+    return mark
+
+
+def settled_prefix(rows, now: datetime = None, settle_seconds: float = CONSUMER_SETTLE_SECONDS):
+    # The leading rows (in id order, with created_at) a watermark may move
+    # past; rows without a created_at count as old
+    settled_before = (now or datetime.utcnow()) - timedelta(seconds=settle_seconds)
+    for count, row in enumerate(rows):
+        if row.created_at is not None and row.created_at > settled_before:
+            return rows[:count]
+    return rows
+
+
+def hold_pending(db, name: str, rows, hold_types):
+    # Lists the pending rows of hold_types (rows need id, status and
+    # transaction_type) that the consumer's mark is about to move past
+    held = [
+        {"name": name, "transaction_id": row.id}
+        for row in rows
+        if row.status == "pending" and row.transaction_type in hold_types
+    ]
+    if held:
+        db.execute(insert(ledger_pending), held)
+
+
+def release_pending(db, name: str, query) -> list:
+    # The consumer's held rows that are no longer pending, fetched with its
+    # own `query` over wallet_transactions, and taken off its list. Rows that
+    # failed come back too; consumers only count settled ones.
+    ids = db.scalars(
+        select(ledger_pending.c.transaction_id)
+        .select_from(ledger_pending.outerjoin(
+            wallet_transactions, wallet_transactions.c.id == ledger_pending.c.transaction_id
+        ))
+        .where(
+            ledger_pending.c.name == name,
+            or_(wallet_transactions.c.status.is_(None), wallet_transactions.c.status != "pending")
+        )
+    ).all()
+    rows = []
+    for start in range(0, len(ids), 5000):
+        chunk = ids[start:start + 5000]
+        db.execute(delete(ledger_pending).where(
+            ledger_pending.c.name == name, ledger_pending.c.transaction_id.in_(chunk)
+        ))
+        rows.extend(db.execute(query.where(wallet_transactions.c.id.in_(chunk))).all())
+    return rows
+
+
+def migrate_watermarks(engine) -> bool:
+    # Moves the marks in LEGACY_WATERMARK_TABLE into ledger_watermarks, by a
+    # rename or, if create_all already made the new table, by copying the
+    # names it lacks. Safe to run on every start; True if anything moved.
+    with engine.begin() as connection:
+        tables = set(inspect(connection).get_table_names())
+        if LEGACY_WATERMARK_TABLE not in tables:
+            return False
+        if ledger_watermarks.name not in tables:
+            connection.execute(text(f"ALTER TABLE {LEGACY_WATERMARK_TABLE} RENAME TO {ledger_watermarks.name}"))
+            return True
+        legacy = table(LEGACY_WATERMARK_TABLE, *(column(c.name) for c in ledger_watermarks.c))
+        connection.execute(insert(ledger_watermarks).from_select(
+            [c.name for c in ledger_watermarks.c],
+            select(*legacy.c).where(legacy.c.name.not_in(select(ledger_watermarks.c.name)))
+        ))
+        connection.execute(text(f"DROP TABLE {LEGACY_WATERMARK_TABLE}"))
+    return True
+
+
+def advance_watermark(db, name: str, transaction_id: int):
+    db.execute(
+        update(ledger_watermarks)
+        .where(ledger_watermarks.c.name == name)
+        .values(last_transaction_id=transaction_id, updated_at=datetime.utcnow())
+    )
+
+
+def checkpoint_query(wallet_id: int, at: datetime = None):
+    # Latest checkpoint for the wallet, or the latest one taken no later than `at`
+    query = (
+        select(wallet_checkpoints.c.transaction_id, wallet_checkpoints.c.balance, wallet_checkpoints.c.as_of)
+        .where(wallet_checkpoints.c.wallet_id == wallet_id)
+        .order_by(wallet_checkpoints.c.transaction_id.desc())
+        .limit(1)
+    )
+    if at is not None:
+        query = query.where(wallet_checkpoints.c.as_of <= at)
+    return query
+
+
+def tail_sum_query(wallet_id: int, after_transaction_id: int, at: datetime = None, since: datetime = None):
+    query = select(func.coalesce(func.sum(wallet_transactions.c.amount), 0)).where(
+        wallet_transactions.c.wallet_id == wallet_id,
+        wallet_transactions.c.id > after_transaction_id,
+        wallet_transactions.c.status == SETTLED_STATUS
+    )
+    if at is not None:
+        query = query.where(wallet_transactions.c.created_at <= at)
+    if since is not None:
+        # Rows after a checkpoint are never older than it (see ledger_compaction.py),
+        # which keeps a historical read to a short created_at range scan
+        query = query.where(wallet_transactions.c.created_at >= since)
+    return query
+
+
+async def balance(db, wallet_id: int, at: datetime = None) -> float:
+    # Current balance, or the balance as of `at`, from the nearest checkpoint
+    # plus the ledger rows after it
+    checkpoint = (await db.execute(checkpoint_query(wallet_id, at))).first()
+    after_transaction_id, opening_balance, as_of = checkpoint if checkpoint else (0, 0.0, None)
+    since = as_of if at is not None else None
+    return opening_balance + await db.scalar(tail_sum_query(wallet_id, after_transaction_id, at, since))